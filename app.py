@@ -1,16 +1,165 @@
+import hashlib
+import pathlib
+
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from openpyxl import load_workbook
+
+PREVIEW_ROWS = 500
+# Above this size CSV parsing goes through Arrow's multithreaded reader
+ARROW_CSV_MIN_SIZE = 50 * 1024 * 1024
+# Rows used to decide column dtypes before the real read
+DTYPE_SAMPLE_ROWS = 100
+# String columns with fewer unique values than this share of rows become categories
+CATEGORY_MAX_RATIO = 0.5
+# Parsed previews are kept here as Parquet so reruns skip CSV/XLSX parsing
+CACHE_DIR = pathlib.Path("/tmp/volerex_cache")
 
 st.title("Volerex Data Extraction")
 
 uploaded_file = st.file_uploader("Last opp Excel- eller CSV-fil", type=["csv", "xlsx"])
 
-if uploaded_file:
-    if uploaded_file.name.endswith('.csv'):
-        df = pd.read_csv(uploaded_file)
+
+def infer_dtypes(sample):
+    """Pick compact dtypes for each column based on a sample of rows"""
+    dtypes = {}
+    for col in sample.columns:
+        values = sample[col]
+        if pd.api.types.is_bool_dtype(values):
+            continue
+        if pd.api.types.is_integer_dtype(values):
+            dtypes[col] = "Int32"
+        # Floats stay float64 here: a sample can't show that the other rows fit float32 exactly, and
+        # compact_dataframe downcasts them afterwards only where nothing is lost
+        elif pd.api.types.is_object_dtype(values) and len(values):
+            if values.nunique() / len(values) < CATEGORY_MAX_RATIO:
+                dtypes[col] = "category"
+    return dtypes
+
+
+def compact_dataframe(df):
+    """Downcast numeric columns and turn repeated strings into categories"""
+    for col in df.columns:
+        values = df[col]
+        if pd.api.types.is_bool_dtype(values):
+            continue
+        if pd.api.types.is_integer_dtype(values):
+            df[col] = pd.to_numeric(values, downcast='integer')
+        elif pd.api.types.is_float_dtype(values):
+            df[col] = pd.to_numeric(values, downcast='float')
+        elif pd.api.types.is_object_dtype(values) and len(values):
+            if values.nunique() / len(values) < CATEGORY_MAX_RATIO:
+                df[col] = values.astype('category')
+    return df
+
+
+def read_header(file):
+    """Read only the column names of the uploaded file"""
+    file.seek(0)
+    if file.name.endswith('.csv'):
+        return list(pd.read_csv(file, nrows=0).columns)
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        header = next(wb.active.iter_rows(max_row=1, values_only=True), ())
+        return list(header)
+    finally:
+        wb.close()
+
+
+def read_csv_preview(file, nrows, usecols):
+    """Read the first nrows of a CSV file, using Arrow for large uploads"""
+    file.seek(0)
+    dtypes = infer_dtypes(pd.read_csv(file, nrows=DTYPE_SAMPLE_ROWS, usecols=usecols))
+    file.seek(0)
+    if file.size <= ARROW_CSV_MIN_SIZE:
+        try:
+            return pd.read_csv(file, nrows=nrows, usecols=usecols, dtype=dtypes)
+        except (ValueError, TypeError):
+            # Rows past the sample didn't fit the inferred dtypes
+            file.seek(0)
+            return pd.read_csv(file, nrows=nrows, usecols=usecols)
+    reader = pa_csv.open_csv(file, convert_options=pa_csv.ConvertOptions(include_columns=usecols))
+    batches = []
+    row_count = 0
+    for batch in reader:
+        batches.append(batch)
+        row_count += batch.num_rows
+        if row_count >= nrows:
+            break
+    table = pa.Table.from_batches(batches, schema=reader.schema)
+    df = table.slice(0, nrows).to_pandas()
+    try:
+        return df.astype(dtypes)
+    except (ValueError, TypeError):
+        return df
+
+
+def read_excel_preview(file, nrows, usecols):
+    """Read the first nrows of the first sheet without loading the whole workbook"""
+    file.seek(0)
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return pd.DataFrame()
+        indices = [i for i, name in enumerate(header) if name in usecols]
+        data = []
+        for row in rows:
+            data.append([row[i] if i < len(row) else None for i in indices])
+            if len(data) >= nrows:
+                break
+        df = pd.DataFrame(data, columns=[header[i] for i in indices])
+    finally:
+        wb.close()
+    try:
+        return df.astype(infer_dtypes(df.head(DTYPE_SAMPLE_ROWS)))
+    except (ValueError, TypeError):
+        return df
+
+
+def read_preview(file, usecols):
+    if file.name.endswith('.csv'):
+        df = read_csv_preview(file, PREVIEW_ROWS, usecols)
     else:
-        df = pd.read_excel(uploaded_file)
+        df = read_excel_preview(file, PREVIEW_ROWS, usecols)
+    return compact_dataframe(df)
+
+
+@st.cache_data(show_spinner=False)
+def load_preview(content_key, usecols, _file):
+    """Load the preview from the Parquet cache, parsing the upload only on a miss"""
+    columns_key = hashlib.blake2b('|'.join(map(str, usecols)).encode(), digest_size=8).hexdigest()
+    cache_path = CACHE_DIR / f"{content_key}_{columns_key}.parquet"
+    if cache_path.exists():
+        return pd.read_parquet(cache_path)
+    df = read_preview(_file, usecols)
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(cache_path, compression='zstd')
+    except (OSError, ValueError, TypeError, pa.ArrowException) as e:
+        print(f"Could not cache preview as Parquet: {e}")
+    return df
 
-    st.subheader("Forhåndsvisning av data:")
-    st.write(df)
 
+if uploaded_file:
+    # Hashed on every run: different files can share a name and size
+    content_hash = hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest()
+    header_key = f"header_{content_hash}"
+    if header_key not in st.session_state:
+        st.session_state[header_key] = read_header(uploaded_file)
+    columns = st.session_state[header_key]
+
+    selected_columns = st.sidebar.multiselect("Kolonner", columns, default=columns)
+
+    if selected_columns:
+        df = load_preview(content_hash, selected_columns, uploaded_file)
+
+        st.subheader("Forhåndsvisning av data:")
+        memory_kb = df.memory_usage(deep=True).sum() / 1024
+        st.caption(f"Viser de første {len(df)} radene ({memory_kb:.1f} KB i minnet)")
+        st.write(df)
+    else:
+        st.info("Velg minst én kolonne i sidepanelet.")
@@ -1,3 +0,0 @@
-from auth_dummy import get_authorized_user, User
-
-# rest of your code...
@@ -1,11 +1,85 @@
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
-from typing import Optional
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict
+from typing import List, Optional
+import asyncio
+import functools
+import hashlib
 import imaplib
-from datetime import datetime
+import re
+import threading
+import orjson
+import time
 from app.auth import AuthorizedUser
+from app.libs.clock import now_iso
+from app.libs.imap_pool import imap_pool
 
-router = APIRouter(prefix="/config", tags=["Configuration"])
+# Global email settings (stored in secrets) live under /config, per-user IMAP
+# settings under /email-config. Both are served from this module.
+router = APIRouter()
+config_router = APIRouter(prefix="/config", tags=["Configuration"], default_response_class=ORJSONResponse)
+email_config_router = APIRouter(prefix="/email-config", tags=["Email Configuration"], default_response_class=ORJSONResponse)
+
+# Cache for the GET endpoints so polling doesn't hit secrets and storage every time
+EMAIL_CONFIG_CACHE_TTL = 60  # seconds
+# Browsers keep the response but revalidate with If-None-Match on every use, so an
+# update is visible immediately while unchanged polls get an empty 304
+EMAIL_CONFIG_CACHE_CONTROL = "private, no-cache"
+_email_config_cache = {"value": None, "expires": 0.0}
+_user_email_config_cache = {}  # user id -> (expires, EmailConfigResponse)
+_email_config_cache_lock = threading.Lock()
+
+def invalidate_email_config_cache():
+    """Drop the cached global email configuration so the next GET reads it fresh"""
+    with _email_config_cache_lock:
+        _email_config_cache["expires"] = 0.0
+
+# Parses the count out of a "INBOX (MESSAGES 123)" STATUS reply
+_STATUS_MESSAGES_RE = re.compile(rb'MESSAGES (\d+)')
+
+# Last "email_config" blob this process read or wrote, so reads can skip the storage
+# GET. Trusted for one cache TTL; writes always start from a fresh read.
+_stored_email_config = (0.0, {})
+
+def _load_email_config_data() -> dict:
+    """Read the global email config blob, reusing the copy this process last saw"""
+    global _stored_email_config
+    expires, data = _stored_email_config
+    if time.monotonic() >= expires:
+        data = db.storage.json.get("email_config", default={})
+        _stored_email_config = (time.monotonic() + EMAIL_CONFIG_CACHE_TTL, data)
+    return dict(data)
+
+def _save_email_config_data(data: dict):
+    """Write the global email config blob and drop the cached GET response"""
+    global _stored_email_config
+    db.storage.json.put("email_config", data)
+    _stored_email_config = (time.monotonic() + EMAIL_CONFIG_CACHE_TTL, dict(data))
+    invalidate_email_config_cache()
+
+@functools.lru_cache(maxsize=4096)
+def email_config_key(user_id: str) -> str:
+    """Storage key for a user's email config: a short hash instead of the raw user id"""
+    return "ec_" + hashlib.blake2b(user_id.encode(), digest_size=8).hexdigest()
+
+def _legacy_email_config_key(user_id: str) -> str:
+    return f"email_config_{user_id}"
+
+def load_user_email_config(user_id: str) -> dict:
+    """Read a user's email config, moving it over from the legacy key on first access"""
+    config_data = db.storage.json.get(email_config_key(user_id), default={})
+    if config_data:
+        return config_data
+    legacy_data = db.storage.json.get(_legacy_email_config_key(user_id), default={})
+    if legacy_data:
+        db.storage.json.put(email_config_key(user_id), legacy_data)
+        db.storage.json.put(_legacy_email_config_key(user_id), {})
+    return legacy_data
+
+def invalidate_user_email_config_cache(user_id: str):
+    """Drop the cached email configuration for a user"""
+    with _email_config_cache_lock:
+        _user_email_config_cache.pop(user_id, None)
 
 class EmailConfigUpdate(BaseModel):
     """Model for updating email configuration"""
@@ -16,16 +90,26 @@ class EmailConfigUpdate(BaseModel):
     use_ssl: bool = True
     enabled: bool = True
 
+class EmailConfigRequest(BaseModel):
+    """Model for updating or testing a user's email configuration"""
+    username: str
+    password: Optional[str] = None  # Optional for updates
+    imap_server: str
+    port: int = 993
+
 class EmailConfigResponse(BaseModel):
     """Model for email configuration response (without password)"""
+    model_config = ConfigDict(frozen=True, extra='ignore')
+
     imap_server: Optional[str] = None
     username: Optional[str] = None
-    port: int = 993
+    port: Optional[int] = 993
     use_ssl: bool = True
     enabled: bool = True
     is_configured: bool = False
     last_test: Optional[str] = None
     test_status: Optional[str] = None
+    last_updated: Optional[str] = None
 
 class TestConnectionRequest(BaseModel):
     """Model for testing email connection"""
@@ -34,6 +118,8 @@ class TestConnectionRequest(BaseModel):
     password: str
     port: Optional[int] = 993
     use_ssl: bool = True
+    fallback_servers: List[str] = []  # Tried concurrently with imap_server
+    include_count: bool = False  # Also report the number of messages in the inbox
 
 class TestConnectionResponse(BaseModel):
     """Model for test connection response"""
@@ -41,21 +127,34 @@ class TestConnectionResponse(BaseModel):
     message: str
     details: Optional[str] = None
 
-@router.get("/email", response_model=EmailConfigResponse)
-async def get_email_config(user: AuthorizedUser):
-    """Get current email configuration (without sensitive data)"""
-    try:
+def _conditional_config_response(request: Request, response: Response, payload: EmailConfigResponse):
+    """Return 304 when the client already has this config, otherwise tag the payload with an ETag"""
+    etag = '"' + hashlib.md5(orjson.dumps(payload.model_dump())).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": EMAIL_CONFIG_CACHE_CONTROL}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return payload
+
+def _read_email_config() -> EmailConfigResponse:
+    """Build the global email config response, served from the in-process cache when fresh"""
+    if time.monotonic() < _email_config_cache["expires"]:
+        return _email_config_cache["value"]
+    with _email_config_cache_lock:
+        if time.monotonic() < _email_config_cache["expires"]:
+            return _email_config_cache["value"]
+        
         # Get configuration from secrets
         imap_server = db.secrets.get("EMAIL_IMAP_SERVER")
         username = db.secrets.get("EMAIL_USERNAME")
         password = db.secrets.get("EMAIL_PASSWORD")
         
         # Get additional config from storage
-        config_data = db.storage.json.get("email_config", default={})
+        config_data = _load_email_config_data()
         
         is_configured = bool(imap_server and username and password)
         
-        return EmailConfigResponse(
+        response = EmailConfigResponse.model_construct(
             imap_server=imap_server,
             username=username,
             port=config_data.get("port", 993),
@@ -65,10 +164,20 @@ async def get_email_config(user: AuthorizedUser):
             last_test=config_data.get("last_test"),
             test_status=config_data.get("test_status")
         )
+        _email_config_cache["value"] = response
+        _email_config_cache["expires"] = time.monotonic() + EMAIL_CONFIG_CACHE_TTL
+        return response
+
+@config_router.get("/email", response_model=EmailConfigResponse)
+async def get_email_config(request: Request, response: Response, user: AuthorizedUser):
+    """Get current email configuration (without sensitive data)"""
+    try:
+        payload = _read_email_config()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting email config: {str(e)}")
+    return _conditional_config_response(request, response, payload)
 
-@router.put("/email", response_model=EmailConfigResponse)
+@config_router.put("/email", response_model=EmailConfigResponse)
 async def update_email_config(config: EmailConfigUpdate, user: AuthorizedUser):
     """Update email configuration"""
     try:
@@ -83,13 +192,13 @@ async def update_email_config(config: EmailConfigUpdate, user: AuthorizedUser):
             "use_ssl": config.use_ssl,
             "enabled": config.enabled,
             "updated_by": user.sub,
-            "updated_at": datetime.now().isoformat()
+            "updated_at": now_iso()
         }
-        db.storage.json.put("email_config", config_data)
+        _save_email_config_data(config_data)
         
         print(f"Email configuration updated by user {user.sub}")
         
-        return EmailConfigResponse(
+        return EmailConfigResponse.model_construct(
             imap_server=config.imap_server,
             username=config.username,
             port=config.port,
@@ -101,86 +210,103 @@ async def update_email_config(config: EmailConfigUpdate, user: AuthorizedUser):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error updating email config: {str(e)}")
 
-@router.post("/email/test", response_model=TestConnectionResponse)
-async def test_email_connection(test_config: TestConnectionRequest, user: AuthorizedUser):
-    """Test email connection with provided settings"""
-    try:
-        print(f"Testing email connection to {test_config.imap_server} for {test_config.username}")
-        
-        # Attempt to connect to IMAP server
-        if test_config.use_ssl:
-            mail = imaplib.IMAP4_SSL(test_config.imap_server, test_config.port)
-        else:
-            mail = imaplib.IMAP4(test_config.imap_server, test_config.port)
-        
-        # Try to login
-        mail.login(test_config.username, test_config.password)
-        
-        # Try to select inbox
-        status, messages = mail.select('inbox')
+def _probe_server(server: str, test_config: TestConnectionRequest) -> Optional[int]:
+    """Log in to one IMAP server and return the inbox message count if it was requested"""
+    # Reuse a pooled session for this account when one is available
+    with imap_pool.connection(
+        server,
+        test_config.port,
+        test_config.username,
+        test_config.password,
+        use_ssl=test_config.use_ssl
+    ) as mail:
+        # A single NOOP is enough to prove the session is live
+        status, _ = mail.noop()
         if status != 'OK':
-            raise Exception(f"Failed to select inbox: {status}")
-        
-        # Get inbox info
-        inbox_count = len(messages[0].split()) if messages[0] else 0
-        
-        # Close connection
-        mail.close()
-        mail.logout()
-        
-        # Update test status in storage
-        config_data = db.storage.json.get("email_config", default={})
-        config_data.update({
-            "last_test": datetime.now().isoformat(),
-            "test_status": "success"
-        })
-        db.storage.json.put("email_config", config_data)
-        
-        print(f"Email connection test successful. Inbox has {inbox_count} messages.")
-        
-        return TestConnectionResponse(
-            success=True,
-            message=f"Connection successful! Inbox contains {inbox_count} messages.",
-            details=f"Successfully connected to {test_config.imap_server} as {test_config.username}"
-        )
-        
-    except imaplib.IMAP4.error as e:
-        error_msg = f"IMAP error: {str(e)}"
-        print(f"Email connection test failed: {error_msg}")
+            raise Exception(f"NOOP failed: {status}")
+        if not test_config.include_count:
+            return None
         
-        # Update test status in storage
-        config_data = db.storage.json.get("email_config", default={})
-        config_data.update({
-            "last_test": datetime.now().isoformat(),
-            "test_status": "failed"
-        })
-        db.storage.json.put("email_config", config_data)
+        # STATUS returns just the count instead of making the server open the mailbox
+        status, data = mail.status('INBOX', '(MESSAGES)')
+        if status != 'OK':
+            raise Exception(f"Failed to get inbox status: {status}")
         
-        return TestConnectionResponse(
-            success=False,
-            message="Connection failed",
-            details=error_msg
+        match = _STATUS_MESSAGES_RE.search(data[0] or b'')
+        if not match:
+            raise Exception(f"Unexpected inbox status response: {data[0]!r}")
+        return int(match.group(1))
+
+def _format_probe_error(error: BaseException) -> str:
+    if isinstance(error, imaplib.IMAP4.error):
+        return f"IMAP error: {str(error)}"
+    return f"Connection error: {str(error)}"
+
+def _store_test_status(test_status: str):
+    """Update test status in storage"""
+    # Read fresh rather than from the cached copy, which could undo another worker's config update
+    config_data = db.storage.json.get("email_config", default={})
+    config_data.update({
+        "last_test": now_iso(),
+        "test_status": test_status
+    })
+    _save_email_config_data(config_data)
+
+@config_router.post("/email/test", response_model=TestConnectionResponse)
+async def test_email_connection(test_config: TestConnectionRequest, user: AuthorizedUser):
+    """Test email connection with provided settings"""
+    candidate_servers = [test_config.imap_server] + [
+        server for server in test_config.fallback_servers if server != test_config.imap_server
+    ]
+    print(f"Testing email connection to {', '.join(candidate_servers)} for {test_config.username}")
+    
+    # Probe all candidates concurrently so the wall time is the slowest probe, not the sum
+    results = await asyncio.gather(
+        *[asyncio.to_thread(_probe_server, server, test_config) for server in candidate_servers],
+        return_exceptions=True
+    )
+    
+    for server, result in zip(candidate_servers, results):
+        if not isinstance(result, BaseException):
+            inbox_count = result
+            try:
+                await asyncio.to_thread(_store_test_status, "success")
+            except Exception as e:
+                print(f"Failed to store email test status: {e}")
+            
+            if inbox_count is None:
+                print("Email connection test successful.")
+                message = "Connection successful!"
+            else:
+                print(f"Email connection test successful. Inbox has {inbox_count} messages.")
+                message = f"Connection successful! Inbox contains {inbox_count} messages."
+            
+            return TestConnectionResponse(
+                success=True,
+                message=message,
+                details=f"Successfully connected to {server} as {test_config.username}"
+            )
+    
+    if len(candidate_servers) == 1:
+        error_msg = _format_probe_error(results[0])
+    else:
+        error_msg = "; ".join(
+            f"{server}: {_format_probe_error(result)}" for server, result in zip(candidate_servers, results)
         )
-        
+    print(f"Email connection test failed: {error_msg}")
+    
+    try:
+        await asyncio.to_thread(_store_test_status, "failed")
     except Exception as e:
-        error_msg = f"Connection error: {str(e)}"
-        print(f"Email connection test failed: {error_msg}")
-        
-        # Update test status in storage
-        config_data = db.storage.json.get("email_config", default={})
-        config_data.update({
-            "last_test": datetime.now().isoformat(),
-            "test_status": "failed"
-        })
-        db.storage.json.put("email_config", config_data)
-        
-        return TestConnectionResponse(
-            success=False,
-            message="Connection failed",
-            details=error_msg
-        )
+        print(f"Failed to store email test status: {e}")
+    
+    return TestConnectionResponse(
+        success=False,
+        message="Connection failed",
+        details=error_msg
+    )
 
-@router.delete("/email")
+@config_router.delete("/email")
 async def clear_email_config(user: AuthorizedUser):
     """Clear email configuration"""
     try:
@@ -193,7 +319,7 @@ async def clear_email_config(user: AuthorizedUser):
             pass  # Secrets might not exist
         
         # Clear storage config
-        db.storage.json.put("email_config", {})
+        _save_email_config_data({})
         
         print(f"Email configuration cleared by user {user.sub}")
         
@@ -201,3 +327,120 @@ async def clear_email_config(user: AuthorizedUser):
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error clearing email config: {str(e)}")
+
+# --- Per-user email configuration ---
+
+def _read_user_email_config(user_id: str) -> EmailConfigResponse:
+    """Build a user's email config response, served from the in-process cache when fresh"""
+    cached = _user_email_config_cache.get(user_id)
+    if cached and time.monotonic() < cached[0]:
+        return cached[1]
+    with _email_config_cache_lock:
+        cached = _user_email_config_cache.get(user_id)
+        if cached and time.monotonic() < cached[0]:
+            return cached[1]
+        
+        config_data = load_user_email_config(user_id)
+        
+        response = EmailConfigResponse.model_construct(
+            is_configured=bool(config_data.get("username") and config_data.get("password") and config_data.get("imap_server")),
+            username=config_data.get("username"),
+            imap_server=config_data.get("imap_server"),
+            port=config_data.get("port", 993),
+            last_updated=config_data.get("last_updated")
+        )
+        _user_email_config_cache[user_id] = (time.monotonic() + EMAIL_CONFIG_CACHE_TTL, response)
+        return response
+
+@email_config_router.get("/", response_model=EmailConfigResponse)
+async def get_user_email_config(request: Request, response: Response, user: AuthorizedUser):
+    """
+    Get current email configuration for the user
+    """
+    try:
+        payload = _read_user_email_config(user.sub)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error getting email config: {str(e)}")
+    return _conditional_config_response(request, response, payload)
+
+@email_config_router.post("/", response_model=EmailConfigResponse)
+async def update_user_email_config(config: EmailConfigRequest, user: AuthorizedUser):
+    """
+    Update email configuration for the user
+    """
+    try:
+        # Only read the stored config when we need it to preserve the password
+        if config.password:
+            password = config.password
+        else:
+            password = load_user_email_config(user.sub).get("password")
+        
+        config_data = {
+            "username": config.username,
+            "password": password,
+            "imap_server": config.imap_server,
+            "port": config.port,
+            "last_updated": now_iso()
+        }
+        
+        # Ensure we have a password (either new or existing)
+        if not config_data["password"]:
+            raise HTTPException(status_code=400, detail="Password is required for new configurations")
+        
+        db.storage.json.put(email_config_key(user.sub), config_data)
+        invalidate_user_email_config_cache(user.sub)
+        
+        return EmailConfigResponse.model_construct(
+            is_configured=True,
+            username=config.username,
+            imap_server=config.imap_server,
+            port=config.port,
+            last_updated=config_data["last_updated"]
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error updating email config: {str(e)}")
+
+@email_config_router.delete("/")
+async def clear_user_email_config(user: AuthorizedUser):
+    """
+    Clear email configuration for the user
+    """
+    try:
+        db.storage.json.put(email_config_key(user.sub), {})
+        # Blank the legacy key too so a config that was never migrated doesn't come back
+        db.storage.json.put(_legacy_email_config_key(user.sub), {})
+        invalidate_user_email_config_cache(user.sub)
+        return {"message": "Email configuration cleared"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error clearing email config: {str(e)}")
+
+def _run_user_connection_test(config: EmailConfigRequest) -> TestConnectionResponse:
+    """Blocking IMAP test, run off the event loop"""
+    try:
+        # Test IMAP connection, reusing a pooled session for this account
+        with imap_pool.connection(config.imap_server, config.port, config.username, config.password) as mail:
+            status, _ = mail.noop()
+            if status != 'OK':
+                raise Exception(f"NOOP failed: {status}")
+        
+        return TestConnectionResponse(
+            success=True,
+            message="Connection successful"
+        )
+    except Exception as e:
+        return TestConnectionResponse(
+            success=False,
+            message=f"Connection failed: {str(e)}"
+        )
+
+@email_config_router.post("/test", response_model=TestConnectionResponse)
+async def test_user_email_connection(config: EmailConfigRequest, user: AuthorizedUser):
+    """
+    Test email connection with provided credentials
+    """
+    return await asyncio.to_thread(_run_user_connection_test, config)
+
+router.include_router(config_router)
+router.include_router(email_config_router)
@@ -1,19 +1,35 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import List, Optional
+import asyncio
+import functools
+import hashlib
 import imaplib
+import json
+import threading
+import time
+import orjson
 import email
 import email.header
+from email.parser import BytesHeaderParser
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 import base64
 import uuid
 import re
-from datetime import datetime
 from app.auth import AuthorizedUser
+from app.libs.clock import now_iso
+from app.libs.document_index import DocumentIndex, scan_documents
+from app.libs.extraction_cache import pdf_cache_key, get_cached_result, put_cached_result
+from app.libs.imap_pool import imap_pool
+from app.libs.imap_fetch import parse_fetch_response, message_parts, is_pdf_part, fetch_parts
+from app.libs.json_store import get_json_document, put_json_document
+from app.libs.pdf_text import extract_pdf_text, extract_pdf_text_parallel
+from app.libs.prompt_tokens import truncate_to_tokens
 from app.libs.document_processor import store_processed_document, sanitize_storage_key as lib_sanitize_storage_key
 from app.libs.template_matcher import AITemplateMatcher
 from app.libs.email_template_matcher import EmailTemplateMatcher
+from app.apis.template_manager import PdfTemplate, TEMPLATES_STORAGE_KEY as TEMPLATE_MANAGER_STORAGE_KEY, get_templates_version
 
 router = APIRouter(
     prefix="/email",
@@ -107,6 +123,12 @@ async def update_webhook_email_config(config_update: WebhookEmailConfigUpdate, u
         # Get existing user-specific configuration
         current_config = db.storage.json.get(f"webhook_email_config_{user.sub}", default={})
         
+        # A different mailbox has its own UIDs, so start its new-email tracking over
+        if (config_update.imap_server not in (None, current_config.get("imap_server"))
+                or config_update.username not in (None, current_config.get("username"))):
+            current_config.pop("last_uid", None)
+            current_config.pop("uid_validity", None)
+        
         # Update configuration fields
         if config_update.imap_server is not None:
             current_config["imap_server"] = config_update.imap_server
@@ -125,8 +147,7 @@ async def update_webhook_email_config(config_update: WebhookEmailConfigUpdate, u
             print(f"Webhook password updated for user {user.sub}")
         
         # Add timestamp
-        from datetime import datetime
-        current_config["last_updated"] = datetime.now().isoformat()
+        current_config["last_updated"] = now_iso()
         
         # Save updated configuration
         db.storage.json.put(f"webhook_email_config_{user.sub}", current_config)
@@ -163,10 +184,6 @@ async def test_webhook_connection(user: AuthorizedUser):
                 details="Please configure IMAP server, username and password first"
             )
         
-        # Add missing import
-        from datetime import datetime
-        import ssl
-        
         server = config["imap_server"]
         username = config["username"]
         password = config["password"]
@@ -175,26 +192,16 @@ async def test_webhook_connection(user: AuthorizedUser):
         
         print(f"Testing connection to {server}:{port} with user {username}")
         
-        if use_ssl:
-            mail = imaplib.IMAP4_SSL(server, port)
-        else:
-            mail = imaplib.IMAP4(server, port)
-        
-        # Test login
-        mail.login(username, password)
-        
-        # Test selecting inbox
-        status, folders = mail.list()
-        mail.select('inbox')
+        # Log in (or reuse a pooled session) and test selecting inbox
+        with imap_pool.connection(server, port, username, password, use_ssl=use_ssl, owner=user.sub) as mail:
+            status, folders = mail.list()
+            mail.select('inbox')
         
         # Get folder count
         folder_count = len(folders) if folders else 0
         
-        mail.close()
-        mail.logout()
-        
         # Update config with test result
-        config["last_test"] = datetime.now().isoformat()
+        config["last_test"] = now_iso()
         config["test_status"] = "success"
         db.storage.json.put(f"webhook_email_config_{user.sub}", config)
         
@@ -209,7 +216,7 @@ async def test_webhook_connection(user: AuthorizedUser):
         print(error_msg)
         
         # Update config with test result
-        config["last_test"] = datetime.now().isoformat()
+        config["last_test"] = now_iso()
         config["test_status"] = "failed"
         db.storage.json.put(f"webhook_email_config_{user.sub}", config)
         
@@ -223,7 +230,7 @@ async def test_webhook_connection(user: AuthorizedUser):
         print(error_msg)
         
         # Update config with test result
-        config["last_test"] = datetime.now().isoformat()
+        config["last_test"] = now_iso()
         config["test_status"] = "failed"
         db.storage.json.put(f"webhook_email_config_{user.sub}", config)
         
@@ -258,32 +265,198 @@ async def get_email_status():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting email status: {str(e)}")
 
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9._-]')
+# Deletes every ASCII character other than letters, digits and ._-; keys are nearly always ASCII,
+# and str.translate with a small table beats a regex substitution on them
+_SANITIZE_ASCII_TABLE = {c: None for c in range(128) if not (chr(c).isalnum() or chr(c) in '._-')}
+
 def sanitize_storage_key(key: str) -> str:
     """Sanitize storage key to only allow alphanumeric and ._- symbols"""
-    return re.sub(r'[^a-zA-Z0-9._-]', '', key)
+    if key.isascii():
+        return key.translate(_SANITIZE_ASCII_TABLE)
+    return _SANITIZE_RE.sub('', key)
+
+def _decode_header_parts(s) -> str:
+    # Not email.header.make_header: it puts spaces around encoded words, e.g. '"=?utf-8?b?w5hyamFu?="'
+    # would come out as '" Ørjan "'
+    return ''.join(
+        part.decode(encoding or 'utf-8') if isinstance(part, bytes) else part
+        for part, encoding in email.header.decode_header(s)
+    )
+
+@functools.lru_cache(maxsize=1024)
+def _decode_encoded_words(s: str) -> str:
+    return _decode_header_parts(s)
 
 def decode_mime_words(s):
     """Decode MIME encoded words in email headers"""
     try:
-        decoded_parts = email.header.decode_header(s)
-        decoded_string = ''
-        for part, encoding in decoded_parts:
-            if isinstance(part, bytes):
-                decoded_string += part.decode(encoding or 'utf-8')
-            else:
-                decoded_string += part
-        return decoded_string
+        if not isinstance(s, str):
+            return _decode_header_parts(s)
+        # Plain headers have no encoded words to decode
+        if '=?' not in s:
+            return s
+        # The same senders and subjects come back across emails, so decoded values are memoized
+        return _decode_encoded_words(s)
     except Exception:
         return s
 
+_header_parser = BytesHeaderParser()
+
+# Messages requested per IMAP FETCH command when checking for new emails
+FETCH_BATCH_SIZE = 20
+# Concurrent binary uploads when storing an email's PDF attachments
+PDF_UPLOAD_CONCURRENCY = 4
+# Bytes of the text body decoded for template matching and the stored snippet
+EMAIL_CONTENT_MAX_BYTES = 8192
+
+def open_mailbox(owner: str, imap_server: str, port: int, username: str, password: str, use_ssl: bool = True):
+    """Check out a logged-in connection from the pool and select the inbox"""
+    mail = imap_pool.acquire(imap_server, port, username, password, use_ssl=use_ssl, owner=owner)
+    try:
+        mail.select('inbox')
+    except Exception:
+        imap_pool.discard(mail)
+        raise
+    return mail
+
+def fetch_messages(mail, message_uids: List[bytes]) -> List[tuple]:
+    """Fetch headers and MIME structure (not bodies) of messages, one UID FETCH per batch of uids"""
+    messages = []
+    for start in range(0, len(message_uids), FETCH_BATCH_SIZE):
+        batch = message_uids[start:start + FETCH_BATCH_SIZE]
+        # PEEK leaves the messages unread until we decide to keep them
+        status, data = mail.uid('FETCH', b','.join(batch), '(BODY.PEEK[HEADER] BODYSTRUCTURE)')
+        if status != 'OK':
+            print(f"Failed to fetch emails {batch}: {status}")
+            continue
+        responses = parse_fetch_response(data, by_uid=True)
+        for msg_id in batch:
+            items = responses.get(msg_id, {})
+            if 'BODY[HEADER]' in items and 'BODYSTRUCTURE' in items:
+                messages.append((msg_id, items['BODY[HEADER]'], items['BODYSTRUCTURE']))
+    return messages
+
+async def store_pdf_parts(mail, msg_id: bytes, safe_doc_id: str, pdf_parts: List[dict], first_content: bytes) -> tuple:
+    """
+    Store an email's PDF parts as they are downloaded, a few uploads at a time.
+    
+    first_content is the already fetched first PDF; the others are fetched one by one
+    so only the PDFs waiting for an upload slot are held in memory. Returns the storage
+    info of the stored PDFs and the content of the first one, for template matching.
+    """
+    semaphore = asyncio.Semaphore(PDF_UPLOAD_CONCURRENCY)
+    
+    async def upload(key: str, content: bytes):
+        try:
+            await asyncio.to_thread(db.storage.binary.put, key, content)
+            print(f"Stored PDF: {key}")
+        finally:
+            semaphore.release()
+    
+    pdf_info = []
+    uploads = []
+    match_content = None
+    try:
+        for position, part in enumerate(pdf_parts):
+            await semaphore.acquire()
+            if position == 0:
+                content = first_content
+            else:
+                payloads = await asyncio.to_thread(fetch_parts, mail, msg_id, [part])
+                content = payloads[part['part']]
+            if not content:
+                semaphore.release()
+                continue
+            print(f"Found PDF attachment: {part['filename']}")
+            if match_content is None:
+                match_content = content
+            index = len(pdf_info)
+            attachment_key = f"email_pdfs.{safe_doc_id}.{index}.{sanitize_storage_key(part['filename'])}"
+            pdf_info.append({'index': index, 'filename': part['filename'], 'storage_key': attachment_key, 'size': len(content)})
+            uploads.append(asyncio.create_task(upload(attachment_key, content)))
+    except BaseException:
+        # Wait for the uploads already started, so none is left running unawaited, then remove
+        # the PDFs they stored: the email is fetched and stored again by the next check
+        outcomes = await asyncio.gather(*uploads, return_exceptions=True)
+        for info, outcome in zip(pdf_info, outcomes):
+            if not isinstance(outcome, BaseException):
+                try:
+                    await asyncio.to_thread(db.storage.binary.delete, info['storage_key'])
+                except Exception as e:
+                    print(f"Error removing PDF {info['storage_key']}: {e}")
+        raise
+    
+    await asyncio.gather(*uploads)
+    return pdf_info, match_content
+
+# Metadata fields copied into the per-user document index for listing
+INDEX_SUMMARY_FIELDS = ('id', 'sender', 'subject', 'received_date', 'pdf_count', 'status', 'error_message')
+
+def email_documents_index_key(user_id: str) -> str:
+    return f"email_documents_index_{sanitize_storage_key(user_id)}"
+
+def scan_email_documents(user_id: str):
+    """The user's stored email document metadata, found by scanning storage"""
+    for metadata in scan_documents("email_documents."):
+        if metadata.get('user_id') == user_id:
+            yield metadata
+
+email_documents_index = DocumentIndex(email_documents_index_key, scan_email_documents, INDEX_SUMMARY_FIELDS)
+
+def load_email_documents_index(user_id: str) -> dict:
+    """Get the user's document summaries keyed by id"""
+    return email_documents_index.load(user_id)
+
+def update_email_documents_index(user_id: str, documents: List[dict]):
+    """Add or replace the index entries for the given document metadata"""
+    email_documents_index.update(user_id, documents)
+
+def record_email_check(new_emails_count: int, checked_at: str):
+    """Stamp the last check time and add to the processed total in the email status"""
+    current_status = db.storage.json.get("email_status", default={"total_processed": 0})
+    updated_status = {
+        "last_check": checked_at,
+        "total_processed": current_status.get("total_processed", 0) + new_emails_count,
+        "enabled": True
+    }
+    db.storage.json.put("email_status", updated_status)
+
+def mailbox_uid_validity(mail) -> Optional[str]:
+    """UIDVALIDITY reported by the last SELECT; UIDs from another validity are meaningless"""
+    typ, data = mail.response('UIDVALIDITY')
+    values = [value for value in data if value]
+    return values[-1].decode() if values else None
+
+def next_last_uid(last_uid: int, uids: List[int], failed_uids: List[int]) -> int:
+    """Highest handled UID below the first failure, so failed emails are searched again next check"""
+    first_failure = min(failed_uids, default=None)
+    return max((uid for uid in uids if first_failure is None or uid < first_failure), default=last_uid)
+
+def save_last_uid(user_id: str, uid_validity: Optional[str], last_uid: int):
+    """Remember the last handled UID in the user's webhook config, re-read so concurrent edits aren't lost"""
+    config_key = f"webhook_email_config_{user_id}"
+    config = db.storage.json.get(config_key, default={})
+    config["uid_validity"] = uid_validity
+    config["last_uid"] = last_uid
+    db.storage.json.put(config_key, config)
+
+@functools.lru_cache(maxsize=1)
+def get_template_matchers() -> tuple:
+    """Build the PDF and email template matchers once per process"""
+    return AITemplateMatcher(), EmailTemplateMatcher()
+
 @router.post("/check", response_model=EmailCheckResponse)
 async def check_emails(user: AuthorizedUser):
     """
     Check for new emails and process PDF attachments with automatic template matching
     """
+    mail = None
+    # One timestamp for everything this check stores
+    checked_at = now_iso()
     try:
         # Get webhook email configuration from user-specific storage
-        config = db.storage.json.get(f"webhook_email_config_{user.sub}", default={})
+        config = await asyncio.to_thread(db.storage.json.get, f"webhook_email_config_{user.sub}", default={})
         
         if not config.get("imap_server") or not config.get("username") or not config.get("password"):
             raise HTTPException(status_code=500, detail="Webhook email configuration incomplete")
@@ -294,121 +467,115 @@ async def check_emails(user: AuthorizedUser):
         port = config.get("port", 993)
         use_ssl = config.get("use_ssl", True)
         
-        # Connect to IMAP server
+        # Connect to IMAP server (blocking I/O runs in worker threads)
         print(f"Connecting to IMAP server: {imap_server}:{port} with user {email_user}")
-        if use_ssl:
-            mail = imaplib.IMAP4_SSL(imap_server, port)
-        else:
-            mail = imaplib.IMAP4(imap_server, port)
-        mail.login(email_user, webhook_password)
-        mail.select('inbox')
+        mail = await asyncio.to_thread(open_mailbox, user.sub, imap_server, port, email_user, webhook_password, use_ssl)
         
-        # Search for unread emails
-        status, messages = mail.search(None, 'UNSEEN')
+        # Search for unread emails newer than the last one handled, unless the mailbox's UIDs were reset
+        uid_validity = mailbox_uid_validity(mail)
+        last_uid = config.get("last_uid", 0) if uid_validity and config.get("uid_validity") == uid_validity else 0
+        status, messages = await asyncio.to_thread(mail.uid, 'SEARCH', None, f'UID {last_uid + 1}:* UNSEEN')
         if status != 'OK':
             raise HTTPException(status_code=500, detail="Failed to search for emails")
         
-        message_ids = messages[0].split()
+        # "N:*" always matches the newest message, even when its UID is below N
+        message_ids = [uid for uid in messages[0].split() if int(uid) > last_uid]
+        failed_uids = []
         processed_documents = []
+        stored_metadata = []
+        seen_ids = []
         new_emails_count = 0
         
         print(f"Found {len(message_ids)} unread emails")
         
-        # Initialize AI template matcher
-        template_matcher = AITemplateMatcher()
+        # AI and email template matchers, shared across checks
+        template_matcher, email_template_matcher = get_template_matchers()
         
-        # Initialize email template matcher
-        email_template_matcher = EmailTemplateMatcher()
+        # Fetch headers and MIME structure of all unread emails in a few batched round-trips
+        fetched_messages = await asyncio.to_thread(fetch_messages, mail, message_ids)
         
-        for msg_id in message_ids:
+        for msg_id, email_headers, bodystructure in fetched_messages:
             try:
-                # Fetch email
-                status, msg_data = mail.fetch(msg_id, '(RFC822)')
-                if status != 'OK':
-                    continue
-                    
-                # Parse email
-                email_body = msg_data[0][1]
-                email_message = email.message_from_bytes(email_body)
+                # Parse email headers; only the header block was fetched, so skip body parsing
+                email_message = _header_parser.parsebytes(email_headers)
                 
                 # Extract basic info
                 sender = decode_mime_words(email_message.get('From', 'Unknown'))
                 subject = decode_mime_words(email_message.get('Subject', 'No Subject'))
                 date_str = email_message.get('Date', '')
                 
+                # Emails without PDFs are skipped without downloading their bodies and stay unread
+                parts = message_parts(bodystructure)
+                pdf_parts = [part for part in parts if is_pdf_part(part)]
+                if not pdf_parts:
+                    continue
+                
                 print(f"Processing email from {sender}, subject: {subject}")
                 
                 # Generate unique document ID
                 doc_id = str(uuid.uuid4())
+                safe_doc_id = sanitize_storage_key(doc_id)
                 
-                # Extract PDF attachments
-                pdf_attachments = []
+                # Download the text body used for template matching together with the first PDF
+                text_part = next((part for part in parts if part['content_type'] == 'text/plain' and not is_pdf_part(part)), None)
+                wanted_parts = [pdf_parts[0], text_part] if text_part else [pdf_parts[0]]
+                payloads = await asyncio.to_thread(fetch_parts, mail, msg_id, wanted_parts)
                 
-                def extract_attachments(msg, attachments_list):
-                    for part in msg.walk():
-                        if part.get_content_disposition() == 'attachment':
-                            filename = part.get_filename()
-                            if filename and filename.lower().endswith('.pdf'):
-                                try:
-                                    content = part.get_payload(decode=True)
-                                    if content:
-                                        attachments_list.append({
-                                            'filename': filename,
-                                            'content': content
-                                        })
-                                        print(f"Found PDF attachment: {filename}")
-                                except Exception as e:
-                                    print(f"Error extracting attachment {filename}: {e}")
+                # The start of the body is enough for matching and the stored snippet, so don't
+                # decode long quoted reply histories
+                email_content = ""
+                if text_part:
+                    email_text = payloads[text_part['part']][:EMAIL_CONTENT_MAX_BYTES]
+                    try:
+                        email_content = email_text.decode(text_part['charset'] or 'utf-8', errors='ignore')
+                    except LookupError:
+                        email_content = email_text.decode('utf-8', errors='ignore')
                 
-                extract_attachments(email_message, pdf_attachments)
+                # Store the PDFs right away instead of keeping them all until the metadata is written
+                pdf_info, first_pdf = await store_pdf_parts(mail, msg_id, safe_doc_id, pdf_parts, payloads[pdf_parts[0]['part']])
+                del payloads
                 
                 # Only process emails with PDF attachments
-                if pdf_attachments:
+                if pdf_info:
                     new_emails_count += 1
                     
-                    # Extract email content for template matching
-                    email_content = ""
-                    for part in email_message.walk():
-                        if part.get_content_type() == "text/plain":
-                            try:
-                                email_content = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                                break
-                            except Exception:
-                                continue
-                    
-                    # First try email template matching (for email-based processing)
-                    email_template_match = None
+                    # Email template matching (for email-based processing) and PDF template
+                    # matching (for PDF-based processing) are independent, so run them together
                     email_template_confidence = 0
+                    pdf_template_match = None
+                    pdf_confidence_score = 0
+                    pdf_matching_reasoning = ""
                     
-                    if email_content:
+                    async def match_email_template():
+                        if not email_content:
+                            return None
                         print("Running email template matching...")
-                        email_template_match = email_template_matcher.find_best_template_for_email(
+                        return await asyncio.to_thread(
+                            email_template_matcher.find_best_template_for_email,
                             email_content=email_content,
                             email_subject=subject,
                             email_sender=sender
                         )
-                        
-                        if email_template_match:
-                            email_template_confidence = email_template_match.confidence_score
-                            print(f"Email template match: {email_template_match.template_name} (confidence: {email_template_confidence:.2f})")
-                        else:
-                            print("No email template match found")
                     
-                    # Then try PDF template matching (for PDF-based processing)
-                    pdf_template_match = None
-                    pdf_confidence_score = 0
-                    pdf_matching_reasoning = ""
+                    print("Running PDF template matching...")
+                    email_template_match, pdf_match_result = await asyncio.gather(
+                        match_email_template(),
+                        asyncio.to_thread(template_matcher.match_template_for_pdf, first_pdf)
+                    )
+                    
+                    if email_template_match:
+                        email_template_confidence = email_template_match.confidence_score
+                        print(f"Email template match: {email_template_match.template_name} (confidence: {email_template_confidence:.2f})")
+                    elif email_content:
+                        print("No email template match found")
                     
-                    if pdf_attachments:
-                        print("Running PDF template matching...")
-                        pdf_match_result = template_matcher.match_template_for_pdf(pdf_attachments[0]['content'])
-                        if pdf_match_result:
-                            pdf_template_match = pdf_match_result.template_id
-                            pdf_confidence_score = pdf_match_result.confidence
-                            pdf_matching_reasoning = pdf_match_result.reasoning
-                            print(f"PDF template match: {pdf_template_match} (confidence: {pdf_confidence_score}%)")
-                        else:
-                            print("No PDF template match found")
+                    if pdf_match_result:
+                        pdf_template_match = pdf_match_result.template_id
+                        pdf_confidence_score = pdf_match_result.confidence
+                        pdf_matching_reasoning = pdf_match_result.reasoning
+                        print(f"PDF template match: {pdf_template_match} (confidence: {pdf_confidence_score}%)")
+                    else:
+                        print("No PDF template match found")
                     
                     # Determine best processing approach
                     processing_type = "unknown"
@@ -464,9 +631,9 @@ async def check_emails(user: AuthorizedUser):
                         'id': doc_id,
                         'sender': sender,
                         'subject': subject,
-                        'received_date': datetime.now().isoformat(),
+                        'received_date': checked_at,
                         'original_date': date_str,
-                        'pdf_count': len(pdf_attachments),
+                        'pdf_count': len(pdf_info),
                         'status': initial_status,
                         'processed_at': None,
                         'user_id': user.sub,
@@ -489,57 +656,56 @@ async def check_emails(user: AuthorizedUser):
                             'match_found': pdf_template_match is not None,
                             'template_id': pdf_template_match,
                             'confidence': pdf_confidence_score
-                        } if pdf_template_match else None
+                        } if pdf_template_match else None,
+                        'pdfs': pdf_info
                     }
                     
-                    # Store metadata
-                    metadata_key = f"email_documents.{sanitize_storage_key(doc_id)}"
-                    db.storage.json.put(metadata_key, email_metadata)
-                    
-                    # Store PDF attachments
-                    pdf_info = []
-                    for i, attachment in enumerate(pdf_attachments):
-                        attachment_key = f"email_pdfs.{sanitize_storage_key(doc_id)}.{i}.{sanitize_storage_key(attachment['filename'])}"
-                        db.storage.binary.put(attachment_key, attachment['content'])
-                        print(f"Stored PDF: {attachment_key}")
-                        pdf_info.append({'index': i, 'filename': attachment['filename'], 'storage_key': attachment_key, 'size': len(attachment['content'])})
-                    
-                    # Update metadata with PDF info
-                    email_metadata['pdfs'] = pdf_info
-                    db.storage.json.put(metadata_key, email_metadata)
+                    # Store the metadata that points at the stored PDFs in one write
+                    metadata_key = f"email_documents.{safe_doc_id}"
+                    await asyncio.to_thread(put_json_document, metadata_key, email_metadata)
+                    stored_metadata.append(email_metadata)
                     
                     processed_documents.append(EmailDocument(
                         id=doc_id,
                         sender=sender,
                         subject=subject,
                         received_date=email_metadata['received_date'],
-                        pdf_count=len(pdf_attachments),
+                        pdf_count=len(pdf_info),
                         status=initial_status
                     ))
                     
-                    print(f"Processed email {doc_id} with {len(pdf_attachments)} PDF attachments")
-                
-                # Mark email as read
-                mail.store(msg_id, '+FLAGS', '\\Seen')
+                    print(f"Processed email {doc_id} with {len(pdf_info)} PDF attachments")
+                    
+                    # Marked as read together after the loop
+                    seen_ids.append(msg_id)
                 
             except Exception as e:
                 print(f"Error processing email {msg_id}: {e}")
+                failed_uids.append(int(msg_id))
                 continue
         
-        # Close IMAP connection
-        mail.close()
-        mail.logout()
+        if stored_metadata:
+            await asyncio.to_thread(update_email_documents_index, user.sub, stored_metadata)
+        
+        # Mark all processed emails as read in one STORE
+        if seen_ids:
+            await asyncio.to_thread(mail.uid, 'STORE', b','.join(seen_ids), '+FLAGS', '\\Seen')
+        
+        # Emails whose structure couldn't be fetched count as failed too
+        fetched_uids = {msg_id for msg_id, _, _ in fetched_messages}
+        failed_uids.extend(int(uid) for uid in message_ids if uid not in fetched_uids)
+        new_last_uid = next_last_uid(last_uid, [int(uid) for uid in message_ids], failed_uids)
+        if new_last_uid != config.get("last_uid") or uid_validity != config.get("uid_validity"):
+            await asyncio.to_thread(save_last_uid, user.sub, uid_validity, new_last_uid)
+        
+        # Hand the connection back to the pool for the next check
+        await asyncio.to_thread(imap_pool.release, mail)
+        mail = None
         
         print(f"Email check completed. Processed {new_emails_count} emails with PDFs")
         
         # Update email status tracking
-        current_status = db.storage.json.get("email_status", default={"total_processed": 0})
-        updated_status = {
-            "last_check": datetime.now().isoformat(),
-            "total_processed": current_status.get("total_processed", 0) + new_emails_count,
-            "enabled": True
-        }
-        db.storage.json.put("email_status", updated_status)
+        await asyncio.to_thread(record_email_check, new_emails_count, checked_at)
         
         return EmailCheckResponse(
             message=f"Successfully checked emails. Found {new_emails_count} new emails with PDF attachments.",
@@ -555,32 +721,18 @@ async def check_emails(user: AuthorizedUser):
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Failed to check emails: {str(e)}") from e
+    finally:
+        # A connection still checked out here may be mid-command, so don't pool it
+        if mail is not None:
+            await asyncio.to_thread(imap_pool.discard, mail)
 
 @router.get("/documents", response_model=List[EmailDocument])
 async def list_email_documents(user: AuthorizedUser):
     """List all email documents for the current user"""
     try:
-        # Get all email documents for this user
-        all_files = db.storage.json.list()
-        documents = []
-        
-        for file in all_files:
-            if file.name.startswith("email_documents."):
-                try:
-                    metadata = db.storage.json.get(file.name)
-                    if metadata.get('user_id') == user.sub:
-                        documents.append(EmailDocument(
-                            id=metadata['id'],
-                            sender=metadata['sender'],
-                            subject=metadata['subject'],
-                            received_date=metadata['received_date'],
-                            pdf_count=metadata['pdf_count'],
-                            status=metadata['status'],
-                            error_message=metadata.get('error_message')
-                        ))
-                except Exception as e:
-                    print(f"Error reading document metadata {file.name}: {e}")
-                    continue
+        # Get all email documents for this user from their index
+        index = await asyncio.to_thread(load_email_documents_index, user.sub)
+        documents = [EmailDocument(**summary) for summary in index.values()]
         
         # Sort by received date, newest first
         documents.sort(key=lambda x: x.received_date, reverse=True)
@@ -597,29 +749,13 @@ async def list_document_pdfs(document_id: str, user: AuthorizedUser):
     try:
         # Verify document belongs to user
         metadata_key = f"email_documents.{sanitize_storage_key(document_id)}"
-        metadata = db.storage.json.get(metadata_key)
+        metadata = get_json_document(metadata_key)
         
         if not metadata or metadata.get('user_id') != user.sub:
             raise HTTPException(status_code=404, detail="Document not found")
         
-        # Find all PDF files for this document
-        all_files = db.storage.binary.list()
-        pdfs = []
-        
-        prefix = f"email_pdfs.{sanitize_storage_key(document_id)}."
-        for file in all_files:
-            if file.name.startswith(prefix):
-                # Extract filename from storage key
-                parts = file.name.split('.')
-                if len(parts) >= 4:
-                    filename = '.'.join(parts[3:])  # Everything after document_id and index
-                    pdfs.append({
-                        'storage_key': file.name,
-                        'filename': filename,
-                        'size': file.size
-                    })
-        
-        return {'document_id': document_id, 'pdfs': pdfs}
+        # The PDFs were recorded in the metadata when the email was stored
+        return {'document_id': document_id, 'pdfs': metadata.get('pdfs', [])}
         
     except HTTPException:
         raise
@@ -627,171 +763,311 @@ async def list_document_pdfs(document_id: str, user: AuthorizedUser):
         print(f"Error listing document PDFs: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to list document PDFs: {str(e)}") from e
 
-@router.post("/documents/{document_id}/process")
-async def process_email_document(document_id: str, template_id: str, user: AuthorizedUser):
+# PDF extraction templates change rarely; re-read them at most this often, or as soon
+# as this process saves them
+TEMPLATES_CACHE_TTL = 60  # seconds
+_pdf_templates_cache = (0.0, None, {})
+# template id -> (expires, templates version, (PdfTemplate or None, instructions prompt, response format))
+_template_prompt_cache = {}
+_template_prompt_cache_lock = threading.Lock()
+
+def load_pdf_templates() -> dict:
+    """Get the PDF extraction templates dict, reusing the copy read within the cache TTL"""
+    global _pdf_templates_cache
+    expires, version, templates = _pdf_templates_cache
+    current_version = get_templates_version()
+    if time.monotonic() >= expires or version != current_version:
+        templates = db.storage.json.get(TEMPLATE_MANAGER_STORAGE_KEY, default={})
+        _pdf_templates_cache = (time.monotonic() + TEMPLATES_CACHE_TTL, current_version, templates)
+    return templates
+
+def build_instructions_prompt(chosen_template: Optional[PdfTemplate]) -> str:
+    """The part of the extraction prompt that depends only on the template, sent ahead of the document text"""
+    prompt_parts = [
+        "You are an expert data extraction assistant. Your task is to extract structured information from the provided text, which originates from a PDF document.",
+        "The text to parse is delimited by '--- BEGIN TEXT ---' and '--- END TEXT ---'.",
+        "Respond with a valid JSON object."
+    ]
+
+    # Schema and specific instructions based on template or generic
+    if chosen_template and chosen_template.target_fields:
+        prompt_parts.append(f"A specific extraction template named '{chosen_template.name}' has been selected. Focus on extracting the following fields:")
+        field_descriptions = []
+        for field in chosen_template.target_fields:
+            field_desc = f"  - '{field.field_name}'"
+            if field.ai_hint:
+                field_desc += f" (Hint: {field.ai_hint})"
+            field_descriptions.append(field_desc)
+        json_schema_fields = json.dumps(
+            {field.field_name: "string or number or array or null" for field in chosen_template.target_fields},
+            ensure_ascii=False
+        )
+        prompt_parts.append("\n".join(field_descriptions))
+        prompt_parts.append(f"The JSON output should strictly follow this structure: {json_schema_fields}.")
+        prompt_parts.append("If a field is not found or not applicable, use a JSON 'null' value for it.")
+    else:
+        prompt_parts.append("No specific template was selected, or the selected template has no target fields. Perform a generic extraction.")
+        prompt_parts.append("Identify and extract common business document fields such as: OrderNumber, OrderDate, CustomerName, DeliveryAddress, Items (with ProductName, Quantity, UnitPrice, TotalPrice), TotalAmount, Currency, etc.")
+        prompt_parts.append("The JSON output should be a flat object where keys are descriptive names for the data points and values are the extracted information. For lists like 'Items', use an array of objects.")
+        prompt_parts.append("If a commonly expected field is not found, you may omit it or use a JSON 'null' value.")
+
+    return "\n".join(prompt_parts)
+
+_SCHEMA_NAME_RE = re.compile(r'[^a-zA-Z0-9_-]')
+
+# Values a target field may hold; list fields such as order lines can hold objects with any keys
+_FIELD_VALUE_SCHEMA = {
+    "anyOf": [
+        {"type": ["string", "number", "null"]},
+        {"type": "array", "items": {"anyOf": [{"type": ["string", "number", "null"]}, {"type": "object"}]}},
+    ]
+}
+
+def build_response_format(chosen_template: Optional[PdfTemplate]) -> dict:
     """
-    Process an email document with AI extraction and store in unified system
+    OpenAI response_format for a template: a JSON schema with one property per
+    target field. It isn't strict, as strict mode only allows objects with fixed
+    keys and list fields can hold objects with any keys. Without target fields
+    the keys aren't known up front, so fall back to plain JSON mode.
     """
-    try:
-        # Get document metadata
-        metadata_key = f"email_documents.{lib_sanitize_storage_key(document_id)}"
-        metadata = db.storage.json.get(metadata_key)
-        
-        if not metadata:
-            raise HTTPException(status_code=404, detail="Document not found")
-        
-        if metadata.get('user_id') != user.sub:
-            raise HTTPException(status_code=403, detail="Access denied")
-        
-        # Get the first PDF for processing
-        pdf_files = db.storage.binary.list()
-        pdf_key = None
-        pdf_filename = None
-        
-        for file in pdf_files:
-            if file.name.startswith(f"email_pdfs.{lib_sanitize_storage_key(document_id)}."):
-                pdf_key = file.name
-                # Extract filename from storage key
-                parts = file.name.split('.')
-                if len(parts) >= 4:
-                    pdf_filename = parts[-1]  # Last part should be filename
-                break
-        
-        if not pdf_key:
-            raise HTTPException(status_code=404, detail="PDF not found")
-        
-        # Get PDF content
-        pdf_content = db.storage.binary.get(pdf_key)
-        
-        # Get template info
-        template_name = None
-        if template_id:
-            try:
-                from app.apis.template_manager.__init__ import TEMPLATES_STORAGE_KEY as TEMPLATE_MANAGER_STORAGE_KEY
-                all_templates_dict = db.storage.json.get(TEMPLATE_MANAGER_STORAGE_KEY, default={})
-                if template_id in all_templates_dict:
-                    template_name = all_templates_dict[template_id].get('name')
-            except Exception as e:
-                print(f"Error fetching template {template_id}: {e}")
-        
-        # Process with AI (reuse PDF parser logic)
-        import openai
-        import pdfplumber
-        import io
-        import json
-        
-        # Initialize OpenAI client
-        client = openai.OpenAI(api_key=db.secrets.get("OPENAI_API_KEY"))
-        if not client:
-            raise HTTPException(status_code=500, detail="OpenAI client not initialized")
-        
-        # Extract text from PDF
-        raw_text = ""
-        with pdfplumber.open(io.BytesIO(pdf_content)) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    raw_text += page_text + "\n"
-        
-        # Get template and build proper AI prompt (using same logic as pdf_parser)
-        chosen_template = None
-        if template_id:
-            try:
-                from app.apis.template_manager.__init__ import TEMPLATES_STORAGE_KEY as TEMPLATE_MANAGER_STORAGE_KEY
-                from app.apis.template_manager.__init__ import PdfTemplate
-                all_templates_dict = db.storage.json.get(TEMPLATE_MANAGER_STORAGE_KEY, default={})
-                if template_id in all_templates_dict:
-                    chosen_template = PdfTemplate(**all_templates_dict[template_id])
-                    print(f"Using template: {chosen_template.name} (ID: {template_id})")
-                else:
-                    print(f"Template ID {template_id} not found in storage. Proceeding with generic extraction.")
-            except Exception as e:
-                print(f"Error fetching template {template_id}: {e}. Proceeding with generic extraction.")
-        
-        # Base prompt
-        prompt_parts = [
-            "You are an expert data extraction assistant. Your task is to extract structured information from the provided text, which originates from a PDF document.",
-            "The text to parse is delimited by '--- BEGIN TEXT ---' and '--- END TEXT ---'.",
-            "Respond with a valid JSON object."
-        ]
-
-        # Schema and specific instructions based on template or generic
-        if chosen_template and chosen_template.target_fields:
-            prompt_parts.append(f"A specific extraction template named '{chosen_template.name}' has been selected. Focus on extracting the following fields:")
-            field_descriptions = []
-            json_schema_fields = "{"
-            for i, field in enumerate(chosen_template.target_fields):
-                field_desc = f"  - '{field.field_name}'"
-                if field.ai_hint:
-                    field_desc += f" (Hint: {field.ai_hint})"
-                field_descriptions.append(field_desc)
-                json_schema_fields += f'"{field.field_name}": "string or number or array or null"'
-                if i < len(chosen_template.target_fields) - 1:
-                    json_schema_fields += ", "
-            json_schema_fields += "}"
-            prompt_parts.append("\n".join(field_descriptions))
-            prompt_parts.append(f"The JSON output should strictly follow this structure: {json_schema_fields}.")
-            prompt_parts.append("If a field is not found or not applicable, use a JSON 'null' value for it.")
-        else:
-            prompt_parts.append("No specific template was selected, or the selected template has no target fields. Perform a generic extraction.")
-            prompt_parts.append("Identify and extract common business document fields such as: OrderNumber, OrderDate, CustomerName, DeliveryAddress, Items (with ProductName, Quantity, UnitPrice, TotalPrice), TotalAmount, Currency, etc.")
-            prompt_parts.append("The JSON output should be a flat object where keys are descriptive names for the data points and values are the extracted information. For lists like 'Items', use an array of objects.")
-            prompt_parts.append("If a commonly expected field is not found, you may omit it or use a JSON 'null' value.")
-
-        prompt_parts.append("\nText to parse:")
-        prompt_parts.append("--- BEGIN TEXT ---")
-        prompt_parts.append(raw_text[:4000])  # Limit text sent to OpenAI for performance/cost
-        prompt_parts.append("--- END TEXT ---")
-        
-        final_prompt = "\n".join(prompt_parts)
-        
-        print(f"Processing email document with template: {chosen_template.name if chosen_template else 'Generic'}")
-        
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are an AI assistant that extracts structured data from text and returns it as a valid JSON object according to the user's instructions."},
-                {"role": "user", "content": final_prompt}
-            ],
-            response_format={"type": "json_object"}
-        )
+    if not (chosen_template and chosen_template.target_fields):
+        return {"type": "json_object"}
+    field_names = list(dict.fromkeys(field.field_name for field in chosen_template.target_fields))
+    schema = {
+        "type": "object",
+        "properties": {name: _FIELD_VALUE_SCHEMA for name in field_names},
+        # A missing field comes back as null
+        "required": field_names,
+        "additionalProperties": False,
+    }
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": _SCHEMA_NAME_RE.sub('_', chosen_template.name)[:64] or "extraction",
+            "schema": schema,
+            "strict": False,
+        },
+    }
+
+def get_template_prompt(template_id: Optional[str]) -> tuple:
+    """
+    Look up a template and build the instructions prompt and response format for it,
+    memoized per template id.
+    
+    Returns (PdfTemplate, prompt, response_format), or (None, generic prompt, JSON mode)
+    when there is no usable template.
+    """
+    version = get_templates_version()
+    with _template_prompt_cache_lock:
+        cached = _template_prompt_cache.get(template_id)
+    if cached and cached[0] > time.monotonic() and cached[1] == version:
+        return cached[2]
+    
+    chosen_template = None
+    if template_id:
+        try:
+            all_templates_dict = load_pdf_templates()
+        except Exception as e:
+            print(f"Error fetching template {template_id}: {e}. Proceeding with generic extraction.")
+            return None, build_instructions_prompt(None), build_response_format(None)
+        if template_id not in all_templates_dict:
+            # Not cached, so unknown ids can't grow the cache
+            print(f"Template ID {template_id} not found in storage. Proceeding with generic extraction.")
+            return None, build_instructions_prompt(None), build_response_format(None)
+        chosen_template = PdfTemplate(**all_templates_dict[template_id])
+    
+    value = (chosen_template, build_instructions_prompt(chosen_template), build_response_format(chosen_template))
+    with _template_prompt_cache_lock:
+        _template_prompt_cache[template_id] = (time.monotonic() + TEMPLATES_CACHE_TTL, version, value)
+    return value
+
+# Tokens of PDF text sent to OpenAI, about what the earlier 4000-character cut gave on average
+PROMPT_TOKEN_LIMIT = 1000
+# Characters of PDF text extracted for the prompt, comfortably more than PROMPT_TOKEN_LIMIT tokens
+PROMPT_TEXT_LIMIT = PROMPT_TOKEN_LIMIT * 8
+
+@functools.lru_cache(maxsize=1)
+def get_openai_client() -> "openai.AsyncOpenAI":
+    """Build the OpenAI client once per process, importing the SDK on first use"""
+    import openai
+    return openai.AsyncOpenAI(api_key=db.secrets.get("OPENAI_API_KEY"))
+
+EXTRACTION_SYSTEM_PROMPT = "You are an AI assistant that extracts structured data from text and returns it as a valid JSON object according to the user's instructions."
+
+async def request_extraction(client, instructions_prompt: str, text_prompt: str, response_format: dict) -> tuple:
+    """
+    Ask the model to extract data from a document.
+    
+    The system prompt and template instructions come first and are identical across documents
+    of a template, so the provider can serve them from its prompt cache; the document text
+    goes last. Returns the response content (or None) and a usage dict with prompt, cached
+    prompt and completion token counts.
+    """
+    completion = await client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT},
+            {"role": "user", "content": instructions_prompt},
+            {"role": "user", "content": text_prompt}
+        ],
+        response_format=response_format
+    )
+    
+    usage = {}
+    if completion.usage:
+        details = getattr(completion.usage, 'prompt_tokens_details', None)
+        usage = {
+            "prompt_tokens": completion.usage.prompt_tokens,
+            "cached_tokens": getattr(details, 'cached_tokens', None) or 0,
+            "completion_tokens": completion.usage.completion_tokens,
+        }
+        print(f"OpenAI prompt tokens: {usage['prompt_tokens']} ({usage['cached_tokens']} cached)")
+    
+    content = None
+    if completion.choices and completion.choices[0].message:
+        content = completion.choices[0].message.content
+    return content, usage
+
+# Documents processed at once (and so OpenAI calls in flight) per batch request
+PROCESS_BATCH_CONCURRENCY = 8
+
+class ProcessEmailDocumentsRequest(BaseModel):
+    document_ids: List[str]
+    template_id: Optional[str] = None
+
+async def process_document(document_id: str, template_id: Optional[str], user: AuthorizedUser) -> tuple:
+    """
+    Run AI extraction on an email document's first PDF and store the result in the unified system.
+    
+    Returns the response body and the updated document metadata. The caller updates the
+    user's document index, so a batch can do that in one write.
+    """
+    # Get document metadata
+    metadata_key = f"email_documents.{lib_sanitize_storage_key(document_id)}"
+    metadata = await asyncio.to_thread(get_json_document, metadata_key)
+    
+    if not metadata:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    if metadata.get('user_id') != user.sub:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    # Get the first PDF for processing
+    pdfs = metadata.get('pdfs')
+    if not pdfs:
+        raise HTTPException(status_code=404, detail="PDF not found")
+    pdf_key = pdfs[0]['storage_key']
+    pdf_filename = pdfs[0]['filename']
+    
+    # Get PDF content
+    pdf_content = await asyncio.to_thread(db.storage.binary.get, pdf_key)
+    
+    # Get the template and the instructions prompt and response format built for it
+    chosen_template, instructions_prompt, response_format = await asyncio.to_thread(get_template_prompt, template_id)
+    template_name = chosen_template.name if chosen_template else None
+    if chosen_template:
+        print(f"Using template: {chosen_template.name} (ID: {template_id})")
+    
+    # Process with AI (reuse PDF parser logic)
+    client = get_openai_client()
+    if not client:
+        raise HTTPException(status_code=500, detail="OpenAI client not initialized")
+    
+    # Extract just enough text from the PDF for the prompt. The full text is only needed
+    # for storing the document, so extract that in the background (over the page process
+    # pool for long PDFs) while OpenAI runs
+    prompt_text = await asyncio.to_thread(extract_pdf_text, pdf_content, PROMPT_TEXT_LIMIT)
+    prompt_tokens_text = await asyncio.to_thread(truncate_to_tokens, prompt_text, PROMPT_TOKEN_LIMIT)
+    full_text = None
+    if len(prompt_text) >= PROMPT_TEXT_LIMIT:
+        full_text = asyncio.get_running_loop().run_in_executor(None, extract_pdf_text_parallel, pdf_content)
+    
+    # The document text comes last, in its own message
+    text_prompt = "\n".join([
+        "Text to parse:",
+        "--- BEGIN TEXT ---",
+        prompt_tokens_text,  # Limit text sent to OpenAI for performance/cost
+        "--- END TEXT ---"
+    ])
+    
+    print(f"Processing email document with template: {chosen_template.name if chosen_template else 'Generic'}")
+    
+    # The same attachment sent again (forwards, resends) gets the earlier answer
+    # The document text follows from the PDF and PROMPT_TOKEN_LIMIT, so those stand in for it
+    cache_key = pdf_cache_key(pdf_content, instructions_prompt, response_format.get("type", ""), str(PROMPT_TOKEN_LIMIT))
+    cached = await asyncio.to_thread(get_cached_result, cache_key)
+    if cached is not None:
+        print(f"Reusing cached extraction for email document {document_id}")
+        extracted_data, usage = cached["extracted_data"], {"cached_response": True}
+    else:
+        content, usage = await request_extraction(client, instructions_prompt, text_prompt, response_format)
         
         extracted_data = {}
-        if completion.choices and completion.choices[0].message and completion.choices[0].message.content:
+        if content:
             try:
-                extracted_data = json.loads(completion.choices[0].message.content)
-            except json.JSONDecodeError:
+                extracted_data = orjson.loads(content)
+            except orjson.JSONDecodeError as e:
+                # Shouldn't happen with a JSON response format, but don't lose the document over it
+                print(f"Error decoding JSON from OpenAI: {e}")
                 extracted_data = {"AI_Extraction_Error": "Failed to parse AI response"}
-        
-        # Store in unified processed documents system
-        document_id_unified = store_processed_document(
-            source="email",
-            original_filename=pdf_filename or "email_attachment.pdf",
-            template_id=template_id,
-            template_name=template_name,
-            extracted_data=extracted_data,
-            raw_text=raw_text,
-            user_id=user.sub,
-            user_email=user.email if hasattr(user, 'email') else 'unknown@example.com',
-            pdf_storage_key=pdf_key,
-            email_sender=metadata.get('sender'),
-            email_subject=metadata.get('subject'),
-            email_received_date=metadata.get('received_date'),
-            email_address="mottak@digitool.no"
-        )
-        
-        # Update email document status
-        metadata['status'] = 'completed'
-        metadata['processed_at'] = datetime.now().isoformat()
-        db.storage.json.put(metadata_key, metadata)
-        
-        print(f"Processed email document and stored with unified ID: {document_id_unified}")
-        
-        return {
-            "message": "Document processed successfully",
-            "unified_document_id": document_id_unified,
-            "extracted_data": extracted_data
-        }
+            else:
+                await asyncio.to_thread(put_cached_result, cache_key, {"extracted_data": extracted_data})
+    
+    raw_text = await full_text if full_text else prompt_text
+    
+    # Store in unified processed documents system and mark the email document completed,
+    # both writes at once
+    previous_status = (metadata.get('status'), metadata.get('processed_at'))
+    metadata['status'] = 'completed'
+    metadata['processed_at'] = now_iso()
+    metadata['llm_usage'] = usage
+    stored, metadata_written = await asyncio.gather(asyncio.to_thread(
+        store_processed_document,
+        source="email",
+        original_filename=pdf_filename or "email_attachment.pdf",
+        template_id=template_id,
+        template_name=template_name,
+        extracted_data=extracted_data,
+        raw_text=raw_text,
+        user_id=user.sub,
+        user_email=user.email if hasattr(user, 'email') else 'unknown@example.com',
+        pdf_storage_key=pdf_key,
+        email_sender=metadata.get('sender'),
+        email_subject=metadata.get('subject'),
+        email_received_date=metadata.get('received_date'),
+        email_address="mottak@digitool.no"
+    ), asyncio.to_thread(put_json_document, metadata_key, metadata), return_exceptions=True)
+    
+    if isinstance(stored, Exception) and not isinstance(metadata_written, Exception):
+        # Don't leave the document marked completed when its result wasn't stored
+        metadata['status'], metadata['processed_at'] = previous_status
+        try:
+            await asyncio.to_thread(put_json_document, metadata_key, metadata)
+        except Exception as e:
+            print(f"Error restoring status of email document {document_id}: {e}")
+    for outcome in (stored, metadata_written):
+        if isinstance(outcome, Exception):
+            raise outcome
+    document_id_unified = stored
+    
+    print(f"Processed email document and stored with unified ID: {document_id_unified}")
+    
+    return {
+        "message": "Document processed successfully",
+        "unified_document_id": document_id_unified,
+        "extracted_data": extracted_data,
+        "usage": usage
+    }, metadata
+
+@router.post("/documents/{document_id}/process")
+async def process_email_document(document_id: str, template_id: str, user: AuthorizedUser):
+    """
+    Process an email document with AI extraction and store in unified system
+    """
+    try:
+        result, metadata = await process_document(document_id, template_id, user)
+        await asyncio.to_thread(update_email_documents_index, user.sub, [metadata])
+        return result
         
     except HTTPException:
         raise
@@ -801,36 +1077,60 @@ async def process_email_document(document_id: str, template_id: str, user: Autho
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
 
+@router.post("/documents/process")
+async def process_email_documents(request: ProcessEmailDocumentsRequest, user: AuthorizedUser):
+    """
+    Process several email documents with the same template, a few at a time concurrently
+    """
+    semaphore = asyncio.Semaphore(PROCESS_BATCH_CONCURRENCY)
+    
+    async def process_one(document_id: str):
+        async with semaphore:
+            return await process_document(document_id, request.template_id, user)
+    
+    outcomes = await asyncio.gather(*(process_one(document_id) for document_id in request.document_ids), return_exceptions=True)
+    
+    results = []
+    processed_metadata = []
+    for document_id, outcome in zip(request.document_ids, outcomes):
+        if isinstance(outcome, Exception):
+            error = outcome.detail if isinstance(outcome, HTTPException) else f"Processing failed: {str(outcome)}"
+            print(f"Error processing email document {document_id}: {error}")
+            results.append({"document_id": document_id, "success": False, "error": error})
+        else:
+            result, metadata = outcome
+            processed_metadata.append(metadata)
+            results.append({"document_id": document_id, "success": True, **result})
+    
+    try:
+        if processed_metadata:
+            await asyncio.to_thread(update_email_documents_index, user.sub, processed_metadata)
+    except Exception as e:
+        print(f"Error updating email document index: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to update document index: {str(e)}") from e
+    
+    return {"results": results}
+
 
 async def download_pdf(document_id: str, pdf_index: int, user: AuthorizedUser):
     """Download a specific PDF attachment"""
     try:
         # Verify document belongs to user
         metadata_key = f"email_documents.{sanitize_storage_key(document_id)}"
-        metadata = db.storage.json.get(metadata_key)
+        metadata = get_json_document(metadata_key)
         
         if not metadata or metadata.get('user_id') != user.sub:
             raise HTTPException(status_code=404, detail="Document not found")
         
         # Find the PDF file
-        all_files = db.storage.binary.list()
-        prefix = f"email_pdfs.{sanitize_storage_key(document_id)}.{pdf_index}."
-        
-        pdf_file = None
-        for file in all_files:
-            if file.name.startswith(prefix):
-                pdf_file = file
-                break
+        pdf_file = next((pdf for pdf in metadata.get('pdfs', []) if pdf.get('index') == pdf_index), None)
         
         if not pdf_file:
             raise HTTPException(status_code=404, detail="PDF not found")
         
         # Get PDF content
-        pdf_content = db.storage.binary.get(pdf_file.name)
-        
-        # Extract filename
-        parts = pdf_file.name.split('.')
-        filename = '.'.join(parts[3:]) if len(parts) >= 4 else 'document.pdf'
+        pdf_content = db.storage.binary.get(pdf_file['storage_key'])
+        filename = pdf_file.get('filename') or 'document.pdf'
         
         from fastapi.responses import Response
         return Response(
@@ -1,15 +1,36 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
+import time
 import uuid
-from datetime import datetime
 from app.auth import AuthorizedUser
+from app.libs.clock import now_iso
+from app.libs.document_processor import sanitize_storage_key
+from app.libs.json_store import get_json_document, put_json_document, delete_json_document
+from app.libs.regex_safety import find_unsafe_pattern
 
 router = APIRouter(prefix="/email-templates", tags=["Email Templates"])
 
-# Storage key for email templates (separate from PDF templates)
+# Each email template is stored under its own key (separate from PDF templates), with an
+# index of template ids and names, so reading one doesn't read them all.
+# Both are orjson-encoded documents in binary storage (see app.libs.json_store)
+EMAIL_TEMPLATE_KEY_PREFIX = "email_templates."
+EMAIL_TEMPLATES_INDEX_KEY = "email_templates_index"
+# Storage key holding all email templates in one dict. Templates were moved from it to per-template keys,
+# but it's kept up to date on every write, as EmailTemplateMatcher loads the templates from it
 EMAIL_TEMPLATES_STORAGE_KEY = "email_templates"
 
+# Parsed templates served by the list endpoint. Dropped on any write from this process,
+# and re-read after the TTL to pick up writes from elsewhere
+EMAIL_TEMPLATES_CACHE_TTL = 60  # seconds
+_email_templates_version = 0
+_email_templates_cache = {"version": -1, "expires": 0.0, "templates": None}
+
+def invalidate_email_templates_cache():
+    """Make the next list request read the templates from storage again"""
+    global _email_templates_version
+    _email_templates_version += 1
+
 class EmailMatchingCriteria(BaseModel):
     """Criteria for matching emails to templates"""
     sender_domains: List[str] = []  # e.g., ["@statsbygg.no", "@oslobygg.no"]
@@ -69,23 +90,88 @@ class EmailTemplateMatchResult(BaseModel):
     match_reasons: List[str]  # Why this template was matched
     auto_processable: bool  # Whether confidence is high enough for auto-processing
 
+def check_validation_patterns(fields: List[EmailExtractionField]):
+    """Reject extraction fields whose validation pattern doesn't compile or could backtrack catastrophically"""
+    problem = find_unsafe_pattern(((field.field_name, field.validation_pattern) for field in fields), "validation pattern")
+    if problem:
+        raise HTTPException(status_code=400, detail=problem)
+
+def construct_email_template(data: dict) -> EmailTemplate:
+    """Build an EmailTemplate from a stored dict without re-running validation, which it passed when saved"""
+    return EmailTemplate.model_construct(**{
+        **data,
+        'matching_criteria': EmailMatchingCriteria.model_construct(**(data.get('matching_criteria') or {})),
+        'extraction_fields': [EmailExtractionField.model_construct(**field) for field in data.get('extraction_fields') or []],
+    })
+
+def email_template_key(template_id: str) -> str:
+    return f"{EMAIL_TEMPLATE_KEY_PREFIX}{sanitize_storage_key(template_id)}"
+
+def load_email_templates_index() -> Dict[str, str]:
+    """Get template id -> name for all email templates, moving them out of the legacy dict on first use"""
+    index = get_json_document(EMAIL_TEMPLATES_INDEX_KEY)
+    if index is not None:
+        return index
+    
+    index = {}
+    for template_id, template in db.storage.json.get(EMAIL_TEMPLATES_STORAGE_KEY, default={}).items():
+        put_json_document(email_template_key(template_id), template)
+        index[template_id] = template.get('name', '')
+    put_json_document(EMAIL_TEMPLATES_INDEX_KEY, index)
+    return index
+
+def save_email_templates_index(index: Dict[str, str]):
+    put_json_document(EMAIL_TEMPLATES_INDEX_KEY, index)
+
+def save_to_email_templates_dict(template_id: str, template: Optional[dict]):
+    """Store a template in the shared email templates dict read by the matcher, or remove it if template is None"""
+    templates = db.storage.json.get(EMAIL_TEMPLATES_STORAGE_KEY, default={})
+    if template is None:
+        templates.pop(template_id, None)
+    else:
+        templates[template_id] = template
+    db.storage.json.put(EMAIL_TEMPLATES_STORAGE_KEY, templates)
+
+def get_email_template_data(template_id: str) -> Optional[dict]:
+    """Read one email template, or None if there is no template with that id"""
+    template = get_json_document(email_template_key(template_id))
+    # Templates still in the legacy dict are moved to their own keys by the index load
+    if template is None and template_id in load_email_templates_index():
+        template = get_json_document(email_template_key(template_id))
+    return template
+
+def load_email_templates() -> Dict[str, dict]:
+    """Read all email templates, keyed by id"""
+    templates = {}
+    for template_id in load_email_templates_index():
+        template = get_json_document(email_template_key(template_id))
+        if template is not None:
+            templates[template_id] = template
+    return templates
+
 @router.get("/", response_model=List[EmailTemplate])
 async def list_email_templates(user: AuthorizedUser):
     """List all email templates"""
     try:
-        templates_dict = db.storage.json.get(EMAIL_TEMPLATES_STORAGE_KEY, default={})
-        templates = list(templates_dict.values())
+        version = _email_templates_version
+        if _email_templates_cache["version"] == version and time.monotonic() < _email_templates_cache["expires"]:
+            return _email_templates_cache["templates"]
+        
+        templates = list(load_email_templates().values())
         
         # Sort by name
         templates.sort(key=lambda x: x.get('name', '').lower())
         
-        return [EmailTemplate(**template) for template in templates]
+        parsed_templates = [construct_email_template(template) for template in templates]
+        _email_templates_cache.update(version=version, expires=time.monotonic() + EMAIL_TEMPLATES_CACHE_TTL, templates=parsed_templates)
+        return parsed_templates
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error listing email templates: {str(e)}")
 
 @router.post("/", response_model=EmailTemplate)
 async def create_email_template(template_data: EmailTemplateCreate, user: AuthorizedUser):
     """Create a new email template"""
+    check_validation_patterns(template_data.extraction_fields)
     try:
         # Generate unique ID
         template_id = str(uuid.uuid4())
@@ -96,27 +182,28 @@ async def create_email_template(template_data: EmailTemplateCreate, user: Author
                 field.id = str(uuid.uuid4())
         
         # Create template object
+        now = now_iso()
         template = EmailTemplate(
             id=template_id,
             name=template_data.name,
             description=template_data.description,
             matching_criteria=template_data.matching_criteria,
             extraction_fields=template_data.extraction_fields,
-            created_date=datetime.now().isoformat(),
-            updated_date=datetime.now().isoformat(),
+            created_date=now,
+            updated_date=now,
             created_by=user.sub,
             is_active=True,
             usage_count=0
         )
         
-        # Load existing templates
-        templates_dict = db.storage.json.get(EMAIL_TEMPLATES_STORAGE_KEY, default={})
-        
-        # Add new template
-        templates_dict[template_id] = template.dict()
-        
-        # Save back to storage
-        db.storage.json.put(EMAIL_TEMPLATES_STORAGE_KEY, templates_dict)
+        # Store the new template and add it to the index
+        template_dict = template.model_dump(mode="json")
+        put_json_document(email_template_key(template_id), template_dict)
+        save_to_email_templates_dict(template_id, template_dict)
+        index = load_email_templates_index()
+        index[template_id] = template.name
+        save_email_templates_index(index)
+        invalidate_email_templates_cache()
         
         return template
         
@@ -127,12 +214,12 @@ async def create_email_template(template_data: EmailTemplateCreate, user: Author
 async def get_email_template(template_id: str, user: AuthorizedUser):
     """Get specific email template by ID"""
     try:
-        templates_dict = db.storage.json.get(EMAIL_TEMPLATES_STORAGE_KEY, default={})
+        template = get_email_template_data(template_id)
         
-        if template_id not in templates_dict:
+        if template is None:
             raise HTTPException(status_code=404, detail="Email template not found")
         
-        return EmailTemplate(**templates_dict[template_id])
+        return construct_email_template(template)
         
     except HTTPException:
         raise
@@ -142,39 +229,44 @@ async def get_email_template(template_id: str, user: AuthorizedUser):
 @router.put("/_{template_id}", response_model=EmailTemplate)
 async def update_email_template(template_id: str, update_data: EmailTemplateUpdate, user: AuthorizedUser):
     """Update existing email template"""
+    if update_data.extraction_fields is not None:
+        check_validation_patterns(update_data.extraction_fields)
     try:
-        templates_dict = db.storage.json.get(EMAIL_TEMPLATES_STORAGE_KEY, default={})
+        # Get existing template
+        existing_template = get_email_template_data(template_id)
         
-        if template_id not in templates_dict:
+        if existing_template is None:
             raise HTTPException(status_code=404, detail="Email template not found")
         
-        # Get existing template
-        existing_template = templates_dict[template_id]
-        
         # Update fields if provided
         if update_data.name is not None:
             existing_template['name'] = update_data.name
         if update_data.description is not None:
             existing_template['description'] = update_data.description
         if update_data.matching_criteria is not None:
-            existing_template['matching_criteria'] = update_data.matching_criteria.dict()
+            existing_template['matching_criteria'] = update_data.matching_criteria.model_dump(mode="json")
         if update_data.extraction_fields is not None:
             # Generate IDs for new fields
             for field in update_data.extraction_fields:
                 if not field.id:
                     field.id = str(uuid.uuid4())
-            existing_template['extraction_fields'] = [field.dict() for field in update_data.extraction_fields]
+            existing_template['extraction_fields'] = [field.model_dump(mode="json") for field in update_data.extraction_fields]
         if update_data.is_active is not None:
             existing_template['is_active'] = update_data.is_active
             
         # Update timestamp
-        existing_template['updated_date'] = datetime.now().isoformat()
+        existing_template['updated_date'] = now_iso()
         
         # Save back to storage
-        templates_dict[template_id] = existing_template
-        db.storage.json.put(EMAIL_TEMPLATES_STORAGE_KEY, templates_dict)
+        put_json_document(email_template_key(template_id), existing_template)
+        save_to_email_templates_dict(template_id, existing_template)
+        if update_data.name is not None:
+            index = load_email_templates_index()
+            index[template_id] = update_data.name
+            save_email_templates_index(index)
+        invalidate_email_templates_cache()
         
-        return EmailTemplate(**existing_template)
+        return construct_email_template(existing_template)
         
     except HTTPException:
         raise
@@ -185,16 +277,17 @@ async def update_email_template(template_id: str, update_data: EmailTemplateUpda
 async def delete_email_template(template_id: str, user: AuthorizedUser):
     """Delete email template"""
     try:
-        templates_dict = db.storage.json.get(EMAIL_TEMPLATES_STORAGE_KEY, default={})
+        index = load_email_templates_index()
         
-        if template_id not in templates_dict:
+        if template_id not in index:
             raise HTTPException(status_code=404, detail="Email template not found")
         
-        # Remove template
-        del templates_dict[template_id]
-        
-        # Save back to storage
-        db.storage.json.put(EMAIL_TEMPLATES_STORAGE_KEY, templates_dict)
+        # Remove template from the index, then its own key
+        del index[template_id]
+        save_email_templates_index(index)
+        delete_json_document(email_template_key(template_id))
+        save_to_email_templates_dict(template_id, None)
+        invalidate_email_templates_cache()
         
         return {"message": "Email template deleted successfully"}
         
@@ -214,11 +307,11 @@ async def test_email_template_match(
     """Test how well an email matches against a specific template"""
     try:
         # Get template
-        templates_dict = db.storage.json.get(EMAIL_TEMPLATES_STORAGE_KEY, default={})
-        if template_id not in templates_dict:
+        template_data = get_email_template_data(template_id)
+        if template_data is None:
             raise HTTPException(status_code=404, detail="Email template not found")
         
-        template = EmailTemplate(**templates_dict[template_id])
+        template = construct_email_template(template_data)
         
         # Perform matching logic
         from app.libs.email_template_matcher import EmailTemplateMatcher
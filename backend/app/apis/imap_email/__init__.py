@@ -1,7 +1,8 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import List, Optional
-import imaplib
+import asyncio
+import functools
 import email
 import email.header
 from email.mime.multipart import MIMEMultipart
@@ -9,8 +10,16 @@ from email.mime.base import MIMEBase
 import base64
 import uuid
 import re
-from datetime import datetime
+import time
 from app.auth import AuthorizedUser
+from app.libs.clock import now_iso
+from app.libs.document_index import DocumentIndex, scan_documents
+from app.libs.imap_pool import imap_pool
+from app.libs.json_store import get_json_document, put_json_document
+from app.libs.pdf_text import extract_pdf_text, extract_pdf_text_parallel
+from app.libs.imap_fetch import parse_fetch_response, parse_envelope, message_parts, is_pdf_part, fetch_message_parts
+from app.apis.config import load_user_email_config
+from app.apis.template_manager import PdfTemplate, TEMPLATES_STORAGE_KEY as TEMPLATE_MANAGER_STORAGE_KEY, get_templates_version
 from app.libs.document_processor import store_processed_document, sanitize_storage_key as lib_sanitize_storage_key
 from app.libs.template_matcher import AITemplateMatcher
 from app.libs.email_template_matcher import EmailTemplateMatcher
@@ -20,6 +29,9 @@ router = APIRouter(
     tags=["IMAP Email Processing"]
 )
 
+# Log out pooled IMAP sessions when the app stops
+router.add_event_handler("shutdown", imap_pool.discard_all)
+
 class ImapEmailDocument(BaseModel):
     id: str
     sender: str
@@ -48,7 +60,7 @@ async def get_imap_email_status(user: AuthorizedUser):
     """
     try:
         # Get configuration from storage
-        config_data = db.storage.json.get(f"email_config_{user.sub}", default={})
+        config_data = load_user_email_config(user.sub)
         
         is_configured = bool(
             config_data.get("username") and 
@@ -73,54 +85,75 @@ async def get_imap_email_status(user: AuthorizedUser):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting IMAP email status: {str(e)}")
 
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9._-]')
+# Deletes every ASCII character other than letters, digits and ._-; keys are nearly always ASCII,
+# and str.translate with a small table beats a regex substitution on them
+_SANITIZE_ASCII_TABLE = {c: None for c in range(128) if not (chr(c).isalnum() or chr(c) in '._-')}
+
 def sanitize_storage_key(key: str) -> str:
     """Sanitize storage key to only allow alphanumeric and ._- symbols"""
-    return re.sub(r'[^a-zA-Z0-9._-]', '', key)
+    if key.isascii():
+        return key.translate(_SANITIZE_ASCII_TABLE)
+    return _SANITIZE_RE.sub('', key)
+
+def _decode_header_parts(s) -> str:
+    # Not email.header.make_header: it puts spaces around encoded words, e.g. '"=?utf-8?b?w5hyamFu?="'
+    # would come out as '" Ørjan "'
+    return ''.join(
+        part.decode(encoding or 'utf-8') if isinstance(part, bytes) else part
+        for part, encoding in email.header.decode_header(s)
+    )
+
+@functools.lru_cache(maxsize=1024)
+def _decode_encoded_words(s: str) -> str:
+    return _decode_header_parts(s)
 
 def decode_mime_words(s):
     """Decode MIME encoded words in email headers"""
     try:
-        decoded_parts = email.header.decode_header(s)
-        decoded_string = ''
-        for part, encoding in decoded_parts:
-            if isinstance(part, bytes):
-                decoded_string += part.decode(encoding or 'utf-8')
-            else:
-                decoded_string += part
-        return decoded_string
+        if not isinstance(s, str):
+            return _decode_header_parts(s)
+        # Plain headers have no encoded words to decode
+        if '=?' not in s:
+            return s
+        # The same senders and subjects come back across emails, so decoded values are memoized
+        return _decode_encoded_words(s)
     except Exception:
         return s
 
+# Metadata fields copied into the per-user document index for listing
+INDEX_SUMMARY_FIELDS = ('id', 'sender', 'subject', 'received_date', 'pdf_count', 'status', 'error_message')
+
+def imap_documents_index_key(user_id: str) -> str:
+    return sanitize_storage_key(f"email_docs_index_{user_id}")
+
+def scan_imap_documents(user_id: str):
+    """The user's stored IMAP document metadata, found by scanning storage"""
+    for metadata in scan_documents(sanitize_storage_key(f"email_doc_{user_id}_")):
+        if metadata.get('source') == 'imap':
+            yield metadata
+
+imap_documents_index = DocumentIndex(imap_documents_index_key, scan_imap_documents, INDEX_SUMMARY_FIELDS)
+
+def load_imap_documents_index(user_id: str) -> dict:
+    """Get the user's IMAP document summaries keyed by id"""
+    return imap_documents_index.load(user_id)
+
+def update_imap_documents_index(user_id: str, documents: List[dict]):
+    """Add or replace the index entries for the given document metadata"""
+    imap_documents_index.update(user_id, documents)
+
 @router.get("/documents", response_model=List[ImapEmailDocument])
 async def list_imap_email_documents(user: AuthorizedUser):
     """
     List all IMAP email documents for the current user
     """
     try:
-        # Get all IMAP email documents for this user
-        all_files = db.storage.json.list()
-        documents = []
-        
-        for file in all_files:
-            if file.name.startswith(f"email_doc_{user.sub}_"):
-                try:
-                    metadata = db.storage.json.get(file.name)
-                    if metadata.get('source') == 'imap':
-                        documents.append(ImapEmailDocument(
-                            id=metadata['id'],
-                            sender=metadata['sender'],
-                            subject=metadata['subject'],
-                            received_date=metadata['received_date'],
-                            pdf_count=metadata['pdf_count'],
-                            status=metadata['status'],
-                            error_message=metadata.get('error_message')
-                        ))
-                except Exception as e:
-                    print(f"Error reading IMAP document metadata {file.name}: {e}")
-                    continue
+        # Read the user's document index instead of scanning all of storage
+        documents = list((await asyncio.to_thread(load_imap_documents_index, user.sub)).values())
         
         # Sort by received date, newest first
-        documents.sort(key=lambda x: x.received_date, reverse=True)
+        documents.sort(key=lambda x: x['received_date'], reverse=True)
         
         return documents
         
@@ -128,6 +161,26 @@ async def list_imap_email_documents(user: AuthorizedUser):
         print(f"Error listing IMAP email documents: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to list IMAP email documents: {str(e)}")
 
+def document_pdfs(user_id: str, document_id: str, metadata: dict) -> List[dict]:
+    """PDFs of an IMAP document as recorded in its metadata, or found by a storage scan for older documents"""
+    if 'pdfs' in metadata:
+        return metadata['pdfs']
+    
+    pdfs = []
+    prefix = sanitize_storage_key(f"pdf_{user_id}_{document_id}_")
+    for file in db.storage.binary.list():
+        if file.name.startswith(prefix):
+            # Extract index from storage key
+            parts = file.name.split('_')
+            if len(parts) >= 4:
+                index = parts[-1]  # Last part should be index
+                pdfs.append({
+                    'storage_key': file.name,
+                    'index': index,
+                    'size': file.size
+                })
+    return pdfs
+
 @router.get("/documents/{document_id}/pdfs")
 async def list_imap_document_pdfs(document_id: str, user: AuthorizedUser):
     """
@@ -136,27 +189,13 @@ async def list_imap_document_pdfs(document_id: str, user: AuthorizedUser):
     try:
         # Verify document belongs to user
         metadata_key = sanitize_storage_key(f"email_doc_{user.sub}_{document_id}")
-        metadata = db.storage.json.get(metadata_key)
+        metadata = get_json_document(metadata_key)
         
         if not metadata or metadata.get('source') != 'imap':
             raise HTTPException(status_code=404, detail="IMAP document not found")
         
         # Find all PDF files for this document
-        all_files = db.storage.binary.list()
-        pdfs = []
-        
-        prefix = f"pdf_{user.sub}_{document_id}_"
-        for file in all_files:
-            if file.name.startswith(prefix):
-                # Extract index from storage key
-                parts = file.name.split('_')
-                if len(parts) >= 4:
-                    index = parts[-1]  # Last part should be index
-                    pdfs.append({
-                        'storage_key': file.name,
-                        'index': index,
-                        'size': file.size
-                    })
+        pdfs = document_pdfs(user.sub, document_id, metadata)
         
         return {'document_id': document_id, 'pdfs': pdfs}
         
@@ -166,10 +205,96 @@ async def list_imap_document_pdfs(document_id: str, user: AuthorizedUser):
         print(f"Error listing IMAP document PDFs: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to list IMAP document PDFs: {str(e)}")
 
+# Parsed PDF templates by id, re-read after the TTL or as soon as this process saves templates
+TEMPLATE_CACHE_TTL = 60  # seconds
+TEMPLATE_CACHE_SIZE = 64
+# template id -> (expires, templates version, PdfTemplate)
+_template_cache = {}
+
+def get_pdf_template(template_id: str) -> Optional[PdfTemplate]:
+    """Look up a PDF template by id, reading the templates dict only on a cache miss"""
+    version = get_templates_version()
+    cached = _template_cache.get(template_id)
+    if cached and cached[0] > time.monotonic() and cached[1] == version:
+        return cached[2]
+    
+    all_templates_dict = db.storage.json.get(TEMPLATE_MANAGER_STORAGE_KEY, default={})
+    if template_id not in all_templates_dict:
+        return None
+    template = PdfTemplate(**all_templates_dict[template_id])
+    
+    # Evict the oldest entry (dicts keep insertion order) once the cache is full
+    _template_cache.pop(template_id, None)
+    if len(_template_cache) >= TEMPLATE_CACHE_SIZE:
+        del _template_cache[next(iter(_template_cache))]
+    _template_cache[template_id] = (time.monotonic() + TEMPLATE_CACHE_TTL, version, template)
+    return template
+
+def get_prompt_prefix(chosen_template: Optional[PdfTemplate]) -> str:
+    """The extraction prompt up to the document text, memoized per template id and fields"""
+    if not (chosen_template and chosen_template.target_fields):
+        return _build_prompt_prefix(None, None, ())
+    fields = tuple((field.field_name, field.ai_hint) for field in chosen_template.target_fields)
+    return _build_prompt_prefix(chosen_template.id, chosen_template.name, fields)
+
+@functools.lru_cache(maxsize=128)
+def _build_prompt_prefix(template_id: Optional[str], template_name: Optional[str], fields: tuple) -> str:
+    # Base prompt
+    prompt_parts = [
+        "You are an expert data extraction assistant. Your task is to extract structured information from the provided text, which originates from a PDF document.",
+        "The text to parse is delimited by '--- BEGIN TEXT ---' and '--- END TEXT ---'.",
+        "Respond with a valid JSON object."
+    ]
+
+    # Schema and specific instructions based on template or generic
+    if fields:
+        prompt_parts.append(f"A specific extraction template named '{template_name}' has been selected. Focus on extracting the following fields:")
+        field_descriptions = []
+        for field_name, ai_hint in fields:
+            field_desc = f"  - '{field_name}'"
+            if ai_hint:
+                field_desc += f" (Hint: {ai_hint})"
+            field_descriptions.append(field_desc)
+        json_schema_fields = "{" + ", ".join(f'"{field_name}": "string or number or array or null"' for field_name, _ in fields) + "}"
+        prompt_parts.append("\n".join(field_descriptions))
+        prompt_parts.append(f"The JSON output should strictly follow this structure: {json_schema_fields}.")
+        prompt_parts.append("If a field is not found or not applicable, use a JSON 'null' value for it.")
+    else:
+        prompt_parts.append("No specific template was selected, or the selected template has no target fields. Perform a generic extraction.")
+        prompt_parts.append("Identify and extract common business document fields such as: OrderNumber, OrderDate, CustomerName, DeliveryAddress, Items (with ProductName, Quantity, UnitPrice, TotalPrice), TotalAmount, Currency, etc.")
+        prompt_parts.append("The JSON output should be a flat object where keys are descriptive names for the data points and values are the extracted information. For lists like 'Items', use an array of objects.")
+        prompt_parts.append("If a commonly expected field is not found, you may omit it or use a JSON 'null' value.")
+
+    prompt_parts.append("\nText to parse:")
+    prompt_parts.append("--- BEGIN TEXT ---")
+    return "\n".join(prompt_parts) + "\n"
+
+# Characters of PDF text extracted for the prompt, twice the 4000 sent to OpenAI
+PROMPT_TEXT_LIMIT = 8000
+
+# Templates with at most this many fields get only the first SMALL_TEMPLATE_TEXT_LIMIT
+# characters of the document; generic extraction counts as GENERIC_FIELD_COUNT fields
+SMALL_TEMPLATE_FIELDS = 5
+SMALL_TEMPLATE_TEXT_LIMIT = 1500
+GENERIC_FIELD_COUNT = 10
+# Answer length allowed per extracted field, and overall
+COMPLETION_TOKENS_PER_FIELD = 60
+MAX_COMPLETION_TOKENS = 1024
+
 class ProcessImapDocumentRequest(BaseModel):
     template_id: Optional[str] = None
     email_template_id: Optional[str] = None
 
+def record_document_error(user_id: str, document_id: str, error_message: str):
+    """Mark an IMAP document as failed in its metadata and the user's index"""
+    metadata_key = sanitize_storage_key(f"email_doc_{user_id}_{document_id}")
+    metadata = get_json_document(metadata_key, default={})
+    metadata['status'] = 'error'
+    metadata['error_message'] = error_message
+    put_json_document(metadata_key, metadata)
+    if metadata.get('id'):
+        update_imap_documents_index(user_id, [metadata])
+
 @router.post("/documents/{document_id}/process")
 async def process_imap_email_document(document_id: str, request: ProcessImapDocumentRequest, user: AuthorizedUser):
     """
@@ -178,45 +303,27 @@ async def process_imap_email_document(document_id: str, request: ProcessImapDocu
     try:
         # Get document metadata
         metadata_key = sanitize_storage_key(f"email_doc_{user.sub}_{document_id}")
-        metadata = db.storage.json.get(metadata_key)
+        metadata = await asyncio.to_thread(get_json_document, metadata_key)
         
         if not metadata or metadata.get('source') != 'imap':
             raise HTTPException(status_code=404, detail="IMAP document not found")
         
         # Update status to processing
         metadata['status'] = 'processing'
-        db.storage.json.put(metadata_key, metadata)
+        await asyncio.to_thread(put_json_document, metadata_key, metadata)
+        await asyncio.to_thread(update_imap_documents_index, user.sub, [metadata])
         
         # Get the first PDF for processing
-        pdf_files = db.storage.binary.list()
-        pdf_key = None
-        
-        for file in pdf_files:
-            if file.name.startswith(f"pdf_{user.sub}_{document_id}_"):
-                pdf_key = file.name
-                break
-        
-        if not pdf_key:
+        pdfs = await asyncio.to_thread(document_pdfs, user.sub, document_id, metadata)
+        if not pdfs:
             raise HTTPException(status_code=404, detail="PDF not found")
+        pdf_key = pdfs[0]['storage_key']
         
         # Get PDF content
-        pdf_content = db.storage.binary.get(pdf_key)
-        
-        # Get template info
-        template_name = None
-        if request.template_id:
-            try:
-                from app.apis.template_manager.__init__ import TEMPLATES_STORAGE_KEY as TEMPLATE_MANAGER_STORAGE_KEY
-                all_templates_dict = db.storage.json.get(TEMPLATE_MANAGER_STORAGE_KEY, default={})
-                if request.template_id in all_templates_dict:
-                    template_name = all_templates_dict[request.template_id].get('name')
-            except Exception as e:
-                print(f"Error fetching template {request.template_id}: {e}")
+        pdf_content = await asyncio.to_thread(db.storage.binary.get, pdf_key)
         
         # Process with AI (reuse PDF parser logic)
         import openai
-        import pdfplumber
-        import io
         import json
         
         # Initialize OpenAI client
@@ -224,76 +331,62 @@ async def process_imap_email_document(document_id: str, request: ProcessImapDocu
         if not client:
             raise HTTPException(status_code=500, detail="OpenAI client not initialized")
         
-        # Extract text from PDF
-        raw_text = ""
-        with pdfplumber.open(io.BytesIO(pdf_content)) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    raw_text += page_text + "\n"
+        # Extract only the text the prompt needs; the full text is just stored, so extract
+        # that in the background while OpenAI runs
+        prompt_text = await asyncio.to_thread(extract_pdf_text, pdf_content, PROMPT_TEXT_LIMIT)
+        full_text = None
+        if len(prompt_text) >= PROMPT_TEXT_LIMIT:
+            full_text = asyncio.get_running_loop().run_in_executor(None, extract_pdf_text_parallel, pdf_content)
         
         # Get template and build proper AI prompt (using same logic as pdf_parser)
         chosen_template = None
         if request.template_id:
             try:
-                from app.apis.template_manager.__init__ import TEMPLATES_STORAGE_KEY as TEMPLATE_MANAGER_STORAGE_KEY
-                from app.apis.template_manager.__init__ import PdfTemplate
-                all_templates_dict = db.storage.json.get(TEMPLATE_MANAGER_STORAGE_KEY, default={})
-                if request.template_id in all_templates_dict:
-                    chosen_template = PdfTemplate(**all_templates_dict[request.template_id])
+                chosen_template = get_pdf_template(request.template_id)
+                if chosen_template:
                     print(f"Using template: {chosen_template.name} (ID: {request.template_id})")
                 else:
                     print(f"Template ID {request.template_id} not found in storage. Proceeding with generic extraction.")
             except Exception as e:
                 print(f"Error fetching template {request.template_id}: {e}. Proceeding with generic extraction.")
+        template_name = chosen_template.name if chosen_template else None
+        
+        # Templates with few fields need less of the document and a shorter answer
+        field_count = len(chosen_template.target_fields) if chosen_template and chosen_template.target_fields else GENERIC_FIELD_COUNT
+        text_budget = SMALL_TEMPLATE_TEXT_LIMIT if field_count <= SMALL_TEMPLATE_FIELDS else PROMPT_TEXT_LIMIT // 2
         
-        # Base prompt
-        prompt_parts = [
-            "You are an expert data extraction assistant. Your task is to extract structured information from the provided text, which originates from a PDF document.",
-            "The text to parse is delimited by '--- BEGIN TEXT ---' and '--- END TEXT ---'.",
-            "Respond with a valid JSON object."
-        ]
-
-        # Schema and specific instructions based on template or generic
-        if chosen_template and chosen_template.target_fields:
-            prompt_parts.append(f"A specific extraction template named '{chosen_template.name}' has been selected. Focus on extracting the following fields:")
-            field_descriptions = []
-            json_schema_fields = "{"
-            for i, field in enumerate(chosen_template.target_fields):
-                field_desc = f"  - '{field.field_name}'"
-                if field.ai_hint:
-                    field_desc += f" (Hint: {field.ai_hint})"
-                field_descriptions.append(field_desc)
-                json_schema_fields += f'"{field.field_name}": "string or number or array or null"'
-                if i < len(chosen_template.target_fields) - 1:
-                    json_schema_fields += ", "
-            json_schema_fields += "}"
-            prompt_parts.append("\n".join(field_descriptions))
-            prompt_parts.append(f"The JSON output should strictly follow this structure: {json_schema_fields}.")
-            prompt_parts.append("If a field is not found or not applicable, use a JSON 'null' value for it.")
-        else:
-            prompt_parts.append("No specific template was selected, or the selected template has no target fields. Perform a generic extraction.")
-            prompt_parts.append("Identify and extract common business document fields such as: OrderNumber, OrderDate, CustomerName, DeliveryAddress, Items (with ProductName, Quantity, UnitPrice, TotalPrice), TotalAmount, Currency, etc.")
-            prompt_parts.append("The JSON output should be a flat object where keys are descriptive names for the data points and values are the extracted information. For lists like 'Items', use an array of objects.")
-            prompt_parts.append("If a commonly expected field is not found, you may omit it or use a JSON 'null' value.")
-
-        prompt_parts.append("\nText to parse:")
-        prompt_parts.append("--- BEGIN TEXT ---")
-        prompt_parts.append(raw_text[:4000])  # Limit text sent to OpenAI for performance/cost
-        prompt_parts.append("--- END TEXT ---")
-        
-        final_prompt = "\n".join(prompt_parts)
+        # Everything up to the document text depends only on the template, so it's built once per template
+        final_prompt = "".join([
+            get_prompt_prefix(chosen_template),
+            prompt_text[:text_budget],  # Limit text sent to OpenAI for performance/cost
+            "\n--- END TEXT ---"
+        ])
         
         print(f"Processing IMAP email document with template: {chosen_template.name if chosen_template else 'Generic'}")
         
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are an AI assistant that extracts structured data from text and returns it as a valid JSON object according to the user's instructions."},
-                {"role": "user", "content": final_prompt}
-            ],
-            response_format={"type": "json_object"}
-        )
+        def request_completion(max_tokens: int):
+            return client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": "You are an AI assistant that extracts structured data from text and returns it as a valid JSON object according to the user's instructions."},
+                    {"role": "user", "content": final_prompt}
+                ],
+                response_format={"type": "json_object"},
+                temperature=0,
+                max_tokens=max_tokens
+            )
+        
+        # The client is synchronous; keep the event loop free while OpenAI answers
+        max_tokens = min(MAX_COMPLETION_TOKENS, COMPLETION_TOKENS_PER_FIELD * field_count)
+        completion = await asyncio.to_thread(request_completion, max_tokens)
+        # Array or long fields can need more than the per-field allowance; a cut-off answer isn't valid JSON
+        if completion.choices and completion.choices[0].finish_reason == "length":
+            if max_tokens < MAX_COMPLETION_TOKENS:
+                print(f"AI answer cut off at {max_tokens} tokens, retrying with {MAX_COMPLETION_TOKENS}")
+                completion = await asyncio.to_thread(request_completion, MAX_COMPLETION_TOKENS)
+            if completion.choices and completion.choices[0].finish_reason == "length":
+                # Not an HTTPException, so the document is marked as failed below
+                raise RuntimeError(f"AI answer was cut off at {MAX_COMPLETION_TOKENS} tokens")
         
         extracted_data = {}
         if completion.choices and completion.choices[0].message and completion.choices[0].message.content:
@@ -302,8 +395,11 @@ async def process_imap_email_document(document_id: str, request: ProcessImapDocu
             except json.JSONDecodeError:
                 extracted_data = {"AI_Extraction_Error": "Failed to parse AI response"}
         
+        raw_text = await full_text if full_text else prompt_text
+        
         # Store in unified processed documents system
-        document_id_unified = store_processed_document(
+        document_id_unified = await asyncio.to_thread(
+            store_processed_document,
             source="imap_email",
             original_filename=f"imap_email_{document_id}.pdf",
             template_id=request.template_id,
@@ -321,8 +417,9 @@ async def process_imap_email_document(document_id: str, request: ProcessImapDocu
         
         # Update email document status
         metadata['status'] = 'completed'
-        metadata['processed_at'] = datetime.now().isoformat()
-        db.storage.json.put(metadata_key, metadata)
+        metadata['processed_at'] = now_iso()
+        await asyncio.to_thread(put_json_document, metadata_key, metadata)
+        await asyncio.to_thread(update_imap_documents_index, user.sub, [metadata])
         
         print(f"Processed IMAP email document and stored with unified ID: {document_id_unified}")
         
@@ -341,202 +438,328 @@ async def process_imap_email_document(document_id: str, request: ProcessImapDocu
         
         # Update status to error
         try:
-            metadata_key = sanitize_storage_key(f"email_doc_{user.sub}_{document_id}")
-            metadata = db.storage.json.get(metadata_key, default={})
-            metadata['status'] = 'error'
-            metadata['error_message'] = str(e)
-            db.storage.json.put(metadata_key, metadata)
+            await asyncio.to_thread(record_document_error, user.sub, document_id, str(e))
         except Exception:
             pass
         
         raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
 
-@router.post("/check", response_model=ImapEmailCheckResponse)
-async def check_imap_emails(user: AuthorizedUser):
+# Messages fetched per UID FETCH round-trip, unless the user's config sets fetch_batch_size
+FETCH_BATCH_SIZE = 100
+
+def fetch_messages(mail, message_uids: List[bytes], batch_size: int = FETCH_BATCH_SIZE):
     """
-    Check for new emails using IMAP configuration and process PDF attachments
+    Yield (uid, envelope, bodystructure) for each UID, fetching batch_size messages per round-trip.
+    
+    Only the envelope and MIME structure are fetched; bodies are downloaded per part later.
     """
-    try:
-        # Get configuration from storage
-        config_data = db.storage.json.get(f"email_config_{user.sub}", default={})
-        
-        username = config_data.get("username")
-        password = config_data.get("password")
-        imap_server = config_data.get("imap_server")
-        port = config_data.get("port", 993)
-        
-        if not (username and password and imap_server):
-            raise HTTPException(status_code=400, detail="IMAP email not configured. Please configure in settings.")
-        
-        # Connect to IMAP server
-        print(f"Connecting to IMAP server: {imap_server}:{port}")
-        mail = imaplib.IMAP4_SSL(imap_server, port)
-        mail.login(username, password)
+    for start in range(0, len(message_uids), batch_size):
+        batch = message_uids[start:start + batch_size]
+        status, data = mail.uid('FETCH', b','.join(batch), '(ENVELOPE BODYSTRUCTURE)')
+        if status != 'OK':
+            print(f"Failed to fetch {len(batch)} emails: {status}")
+            continue
+        messages = parse_fetch_response(data, by_uid=True)
+        for uid in batch:
+            items = messages.get(uid, {})
+            if 'ENVELOPE' in items and 'BODYSTRUCTURE' in items:
+                yield uid, items['ENVELOPE'], items['BODYSTRUCTURE']
+
+# Emails whose PDF parts are downloaded per UID FETCH round-trip; attachments can be large
+PART_FETCH_BATCH_SIZE = 10
+# PDF attachments processed at once (and so AI extractions in flight) during a check
+ATTACHMENT_PROCESSING_CONCURRENCY = 8
+# PDF uploads to binary storage in flight at once during a check
+STORAGE_WRITE_CONCURRENCY = 16
+
+# Smallest message searched for: an email carrying even a tiny base64-encoded PDF is bigger than this.
+# Not the 20 KB often suggested: small generated PDFs (one-page invoices, order confirmations) come in
+# under that, and an email the search leaves out is never looked at by a check
+MIN_PDF_EMAIL_SIZE = 4096
+
+def pdf_search_criteria(imap_server: str) -> tuple:
+    """IMAP SEARCH criteria for unread emails that may have PDF attachments"""
+    if 'gmail' in imap_server.lower():
+        return ('X-GM-RAW', '"has:attachment filename:pdf"', 'UNSEEN')
+    return ('UNSEEN', 'LARGER', str(MIN_PDF_EMAIL_SIZE))
+
+def collect_pdf_emails(user_id: str, config_data: dict) -> List[tuple]:
+    """
+    IMAP phase of a check: find unread emails with PDF attachments and download the PDFs.
+    Emails without PDFs are marked read; the others stay unread until they're stored
+    (see mark_emails_read), so a failed check doesn't lose them.
+    
+    Blocking, so it runs in a worker thread. Returns (UID, email metadata, PDF attachments) per email.
+    """
+    username = config_data.get("username")
+    imap_server = config_data.get("imap_server")
+    port = config_data.get("port", 993)
+    
+    # Reuse a logged-in connection from earlier checks; it's dropped if anything below fails
+    print(f"Connecting to IMAP server: {imap_server}:{port}")
+    with imap_pool.connection(imap_server, port, username, config_data.get("password"), owner=user_id) as mail:
         mail.select('inbox')
         
-        # Search for unread emails
-        status, messages = mail.search(None, 'UNSEEN')
+        # Search for unread emails by UID, which stays valid if messages are expunged meanwhile.
+        # Let the server leave out mail that can't carry a PDF; the BODYSTRUCTURE check below
+        # still decides
+        status, messages = mail.uid('SEARCH', None, *pdf_search_criteria(imap_server))
         if status != 'OK':
             raise HTTPException(status_code=500, detail="Failed to search for emails")
         
         message_ids = messages[0].split()
-        processed_documents = []
-        new_emails_count = 0
-        
         print(f"Found {len(message_ids)} unread emails")
         
-        # Initialize AI template matcher
-        template_matcher = AITemplateMatcher()
-        
-        # Initialize email template matcher
-        email_template_matcher = EmailTemplateMatcher()
-        
-        for msg_id in message_ids:
+        # First pass: envelopes and MIME structures only, to find the emails with PDF attachments
+        batch_size = int(config_data.get("fetch_batch_size") or FETCH_BATCH_SIZE)
+        candidates = []
+        seen_uids = []
+        for msg_id, envelope, bodystructure in fetch_messages(mail, message_ids, batch_size):
             try:
-                # Fetch email
-                status, msg_data = mail.fetch(msg_id, '(RFC822)')
-                if status != 'OK':
-                    continue
-                    
-                # Parse email
-                email_body = msg_data[0][1]
-                email_message = email.message_from_bytes(email_body)
-                
                 # Extract basic info
-                sender = decode_mime_words(email_message.get('From', 'Unknown'))
-                subject = decode_mime_words(email_message.get('Subject', 'No Subject'))
-                received_date = email_message.get('Date', '')
+                envelope_fields = parse_envelope(envelope)
+                sender = decode_mime_words(envelope_fields['from'] or 'Unknown')
+                subject = decode_mime_words(envelope_fields['subject'] or 'No Subject')
+                received_date = envelope_fields['date']
                 
                 print(f"Processing email from {sender}: {subject}")
                 
-                # Look for PDF attachments
-                pdf_attachments = []
-                for part in email_message.walk():
-                    if part.get_content_disposition() == 'attachment':
-                        filename = part.get_filename()
-                        if filename and filename.lower().endswith('.pdf'):
-                            pdf_content = part.get_payload(decode=True)
-                            if pdf_content:
-                                pdf_attachments.append({
-                                    'filename': filename,
-                                    'content': pdf_content
-                                })
+                pdf_parts = [part for part in message_parts(bodystructure) if is_pdf_part(part)]
+                if pdf_parts:
+                    candidates.append((msg_id, sender, subject, received_date, pdf_parts))
+                else:
+                    seen_uids.append(msg_id)
+            
+            except Exception as e:
+                print(f"Error processing email {msg_id}: {str(e)}")
+                continue
+        
+        # Second pass: download just the PDF parts, a few emails per round-trip
+        pdf_emails = []
+        for start in range(0, len(candidates), PART_FETCH_BATCH_SIZE):
+            batch = candidates[start:start + PART_FETCH_BATCH_SIZE]
+            try:
+                payloads = fetch_message_parts(mail, {candidate[0]: candidate[4] for candidate in batch})
+            except Exception as e:
+                # Left unread, so the next check tries these emails again
+                print(f"Error fetching PDF attachments of {len(batch)} emails: {str(e)}")
+                continue
+            
+            for msg_id, sender, subject, received_date, pdf_parts in batch:
+                pdf_attachments = [
+                    {'filename': part['filename'], 'content': payloads[msg_id][part['part']]}
+                    for part in pdf_parts
+                    if payloads[msg_id][part['part']]
+                ]
                 
                 if pdf_attachments:
-                    new_emails_count += 1
-                    email_doc_id = str(uuid.uuid4())
-                    
-                    # Store email metadata
+                    # Email metadata
                     email_doc = {
-                        'id': email_doc_id,
+                        'id': str(uuid.uuid4()),
                         'sender': sender,
                         'subject': subject,
                         'received_date': received_date,
                         'pdf_count': len(pdf_attachments),
                         'status': 'new',
                         'source': 'imap',
-                        'email_address': username
+                        'email_address': username,
+                        'pdfs': []
                     }
-                    
-                    # Store email document
-                    db.storage.json.put(
-                        sanitize_storage_key(f"email_doc_{user.sub}_{email_doc_id}"),
-                        email_doc
+                    pdf_emails.append((msg_id, email_doc, pdf_attachments))
+                else:
+                    seen_uids.append(msg_id)
+        
+        # Mark the emails without PDFs as read, a batch of UIDs per STORE
+        store_seen_flags(mail, seen_uids, batch_size)
+        
+        # Deselect the mailbox but keep the session for the next check
+        mail.close()
+    
+    return pdf_emails
+
+def store_seen_flags(mail, message_uids: List[bytes], batch_size: int = FETCH_BATCH_SIZE):
+    for start in range(0, len(message_uids), batch_size):
+        mail.uid('STORE', b','.join(message_uids[start:start + batch_size]), '+FLAGS', '\\Seen')
+
+def mark_emails_read(user_id: str, config_data: dict, message_uids: List[bytes]):
+    """Mark emails read once they're stored, so the next check doesn't fetch them again. Blocking."""
+    if not message_uids:
+        return
+    batch_size = int(config_data.get("fetch_batch_size") or FETCH_BATCH_SIZE)
+    with imap_pool.connection(config_data.get("imap_server"), config_data.get("port", 993), config_data.get("username"), config_data.get("password"), owner=user_id) as mail:
+        mail.select('inbox')
+        store_seen_flags(mail, message_uids, batch_size)
+        mail.close()
+
+def record_imap_check(user_id: str, new_emails_count: int, checked_at: str):
+    status_data = db.storage.json.get(f"imap_email_status_{user_id}", default={
+        "total_processed": 0,
+        "enabled": True
+    })
+    status_data['last_check'] = checked_at
+    status_data['total_processed'] = status_data.get('total_processed', 0) + new_emails_count
+    db.storage.json.put(f"imap_email_status_{user_id}", status_data)
+
+@router.post("/check", response_model=ImapEmailCheckResponse)
+async def check_imap_emails(user: AuthorizedUser):
+    """
+    Check for new emails using IMAP configuration and process PDF attachments
+    """
+    try:
+        # Get configuration from storage
+        config_data = await asyncio.to_thread(load_user_email_config, user.sub)
+        
+        if not (config_data.get("username") and config_data.get("password") and config_data.get("imap_server")):
+            raise HTTPException(status_code=400, detail="IMAP email not configured. Please configure in settings.")
+        
+        # IMAP commands are blocking and stay serial, as imaplib isn't thread-safe; run them
+        # in a worker thread so other requests aren't held up meanwhile
+        pdf_emails = await asyncio.to_thread(collect_pdf_emails, user.sub, config_data)
+        new_emails_count = len(pdf_emails)
+        
+        # One timestamp for everything recorded by this check
+        checked_at = now_iso()
+    
+        # Initialize AI template matcher
+        template_matcher = AITemplateMatcher()
+    
+        # Initialize email template matcher
+        email_template_matcher = EmailTemplateMatcher()
+    
+        # AI extraction and storage of attachments is network-bound, so run several at a time
+        semaphore = asyncio.Semaphore(ATTACHMENT_PROCESSING_CONCURRENCY)
+        storage_semaphore = asyncio.Semaphore(STORAGE_WRITE_CONCURRENCY)
+        
+        async def process_attachment(email_doc: dict, i: int, attachment: dict, email_match) -> Optional[str]:
+            """Store and process one PDF attachment, returning an error message if it failed"""
+            email_doc_id = email_doc['id']
+            sender, subject, received_date = email_doc['sender'], email_doc['subject'], email_doc['received_date']
+            pdf_key = sanitize_storage_key(f"pdf_{user.sub}_{email_doc_id}_{i}")
+            # The bytes decoded once by fetch_message_parts() are passed as-is to storage and extraction
+            try:
+                # Store PDF in binary storage; uploads don't wait for a slot among the AI extractions
+                async with storage_semaphore:
+                    await asyncio.to_thread(db.storage.binary.put, pdf_key, attachment['content'])
+                email_doc['pdfs'].append({'index': i, 'filename': attachment['filename'], 'storage_key': pdf_key, 'size': len(attachment['content'])})
+            except Exception as e:
+                print(f"Error storing PDF {attachment['filename']}: {str(e)}")
+                return f"Error processing {attachment['filename']}: {str(e)}"
+            
+            async with semaphore:
+                try:
+                    # Extract data from PDF using AI
+                    extraction_result = await asyncio.to_thread(
+                        template_matcher.extract_and_match_data,
+                        attachment['content'],
+                        attachment['filename']
                     )
                     
-                    # Process each PDF attachment
-                    for i, attachment in enumerate(pdf_attachments):
-                        try:
-                            # Store PDF in binary storage
-                            pdf_key = sanitize_storage_key(f"pdf_{user.sub}_{email_doc_id}_{i}")
-                            db.storage.binary.put(pdf_key, attachment['content'])
-                            
-                            # Extract data from PDF using AI
-                            extraction_result = template_matcher.extract_and_match_data(
-                                attachment['content'],
-                                attachment['filename']
-                            )
-                            
-                            # Check for email template match
-                            email_match = email_template_matcher.find_matching_template(
-                                sender, subject
-                            )
-                            
-                            # Create document metadata
-                            document_data = {
-                                'id': f"{email_doc_id}_{i}",
-                                'filename': attachment['filename'],
-                                'user_id': user.sub,
-                                'extracted_data': extraction_result['extracted_data'],
-                                'template_match': extraction_result.get('template_match'),
-                                'email_template_match': email_match,
-                                'confidence_score': extraction_result.get('confidence_score', 0),
-                                'processing_notes': extraction_result.get('notes', ''),
-                                'email_metadata': {
-                                    'sender': sender,
-                                    'subject': subject,
-                                    'received_date': received_date,
-                                    'email_doc_id': email_doc_id
-                                },
-                                'source': 'imap_email',
-                                'created_at': datetime.now().isoformat()
-                            }
-                            
-                            # Store processed document
-                            store_processed_document(
-                                source="email",
-                                original_filename=attachment['filename'],
-                                template_id=extraction_result.get('template_match', {}).get('template_id'),
-                                template_name=extraction_result.get('template_match', {}).get('template_name'),
-                                extracted_data=extraction_result['extracted_data'],
-                                raw_text=extraction_result.get('raw_text', ''),
-                                user_id=user.sub,
-                                user_email=user.email if hasattr(user, 'email') else 'unknown@example.com',
-                                pdf_storage_key=pdf_key,
-                                email_sender=sender,
-                                email_subject=subject,
-                                email_received_date=received_date,
-                                email_address="emailparser@digitool.no"
-                            )
-                            
-                            print(f"Processed PDF: {attachment['filename']} from email {email_doc_id}")
-                            
-                        except Exception as e:
-                            print(f"Error processing PDF {attachment['filename']}: {str(e)}")
-                            # Update email doc with error
-                            email_doc['status'] = 'error'
-                            email_doc['error_message'] = f"Error processing {attachment['filename']}: {str(e)}"
-                    
-                    # Update email document status
-                    if email_doc['status'] != 'error':
-                        email_doc['status'] = 'completed'
+                    # Create document metadata
+                    document_data = {
+                        'id': f"{email_doc_id}_{i}",
+                        'filename': attachment['filename'],
+                        'user_id': user.sub,
+                        'extracted_data': extraction_result['extracted_data'],
+                        'template_match': extraction_result.get('template_match'),
+                        'email_template_match': email_match,
+                        'confidence_score': extraction_result.get('confidence_score', 0),
+                        'processing_notes': extraction_result.get('notes', ''),
+                        'email_metadata': {
+                            'sender': sender,
+                            'subject': subject,
+                            'received_date': received_date,
+                            'email_doc_id': email_doc_id
+                        },
+                        'source': 'imap_email',
+                        'created_at': checked_at
+                    }
                     
-                    db.storage.json.put(
-                        sanitize_storage_key(f"email_doc_{user.sub}_{email_doc_id}"),
-                        email_doc
+                    # Store processed document
+                    await asyncio.to_thread(
+                        store_processed_document,
+                        source="email",
+                        original_filename=attachment['filename'],
+                        template_id=extraction_result.get('template_match', {}).get('template_id'),
+                        template_name=extraction_result.get('template_match', {}).get('template_name'),
+                        extracted_data=extraction_result['extracted_data'],
+                        raw_text=extraction_result.get('raw_text', ''),
+                        user_id=user.sub,
+                        user_email=user.email if hasattr(user, 'email') else 'unknown@example.com',
+                        pdf_storage_key=pdf_key,
+                        email_sender=sender,
+                        email_subject=subject,
+                        email_received_date=received_date,
+                        email_address="emailparser@digitool.no"
                     )
                     
-                    processed_documents.append(ImapEmailDocument(**email_doc))
-                    
-                # Mark email as read
-                mail.store(msg_id, '+FLAGS', '\\Seen')
+                    print(f"Processed PDF: {attachment['filename']} from email {email_doc_id}")
+                    return None
+                
+                except Exception as e:
+                    print(f"Error processing PDF {attachment['filename']}: {str(e)}")
+                    return f"Error processing {attachment['filename']}: {str(e)}"
+        
+        async def process_email_attachments(email_doc: dict, pdf_attachments: List[dict]) -> Optional[dict]:
+            """Process all PDFs of an email at once and store its final status
+
+            Returns None if the email couldn't be stored, so one bad email doesn't fail the
+            whole check; it's left unread and tried again by the next check.
+            """
+            try:
+                # The email template match depends only on the email, so it's the same for every PDF
+                try:
+                    email_match = await asyncio.to_thread(
+                        email_template_matcher.find_matching_template,
+                        email_doc['sender'], email_doc['subject']
+                    )
+                except Exception as e:
+                    print(f"Error matching email template for {email_doc['id']}: {str(e)}")
+                    email_match = None
+                
+                errors = await asyncio.gather(*(
+                    process_attachment(email_doc, i, attachment, email_match)
+                    for i, attachment in enumerate(pdf_attachments)
+                ), return_exceptions=True)
+                email_doc['pdfs'].sort(key=lambda pdf: pdf['index'])
+                
+                # Update email document status
+                failed = [str(error) for error in errors if error]
+                if failed:
+                    email_doc['status'] = 'error'
+                    email_doc['error_message'] = failed[-1]
+                else:
+                    email_doc['status'] = 'completed'
                 
+                await asyncio.to_thread(
+                    put_json_document,
+                    sanitize_storage_key(f"email_doc_{user.sub}_{email_doc['id']}"),
+                    email_doc
+                )
+                return email_doc
             except Exception as e:
-                print(f"Error processing email {msg_id}: {str(e)}")
-                continue
+                print(f"Error processing email {email_doc.get('id')}: {str(e)}")
+                return None
         
-        # Close connection
-        mail.close()
-        mail.logout()
+        results = await asyncio.gather(*(
+            process_email_attachments(email_doc, pdf_attachments)
+            for _, email_doc, pdf_attachments in pdf_emails
+        ))
+        stored = [(msg_id, email_doc) for (msg_id, _, _), email_doc in zip(pdf_emails, results) if email_doc is not None]
+        processed_documents = [ImapEmailDocument(**email_doc) for _, email_doc in stored]
+        
+        # Add the new documents to the user's index in one write
+        if processed_documents:
+            await asyncio.to_thread(update_imap_documents_index, user.sub, [document.model_dump() for document in processed_documents])
+        
+        # Only emails whose document was stored are marked read
+        try:
+            await asyncio.to_thread(mark_emails_read, user.sub, config_data, [msg_id for msg_id, _ in stored])
+        except Exception as e:
+            # Left unread, so the next check fetches them again
+            print(f"Error marking {len(stored)} emails read: {str(e)}")
         
         # Update status
-        status_data = db.storage.json.get(f"imap_email_status_{user.sub}", default={
-            "total_processed": 0,
-            "enabled": True
-        })
-        status_data['last_check'] = datetime.now().isoformat()
-        status_data['total_processed'] = status_data.get('total_processed', 0) + new_emails_count
-        db.storage.json.put(f"imap_email_status_{user.sub}", status_data)
+        await asyncio.to_thread(record_imap_check, user.sub, new_emails_count, checked_at)
         
         return ImapEmailCheckResponse(
             message=f"Processed {new_emails_count} emails with PDF attachments",
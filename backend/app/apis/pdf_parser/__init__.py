@@ -1,22 +1,31 @@
-from fastapi import APIRouter, HTTPException, UploadFile, Form, Depends
+from fastapi import APIRouter, BackgroundTasks, HTTPException, UploadFile, Form, Depends, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Optional # Added Optional
+import asyncio
+import functools
+import hashlib
 import openai
-import pdfplumber
 import re
+import threading
+import time
 import io
-import json
+import orjson
 from app.auth import AuthorizedUser
 # Attempt to import from template_manager - this relies on PYTHONPATH including src/
 # and template_manager being an importable module/package structure.
 # If direct import causes issues, we'll use db.storage.json.get directly later.
-from app.apis.template_manager.__init__ import PdfTemplate, TargetField, TEMPLATES_STORAGE_KEY as TEMPLATE_MANAGER_STORAGE_KEY
+from app.apis.template_manager.__init__ import PdfTemplate, TargetField, TEMPLATES_STORAGE_KEY as TEMPLATE_MANAGER_STORAGE_KEY, render_prompt_prefix
 from app.libs.document_processor import store_processed_document, sanitize_storage_key as lib_sanitize_storage_key
+from app.libs.pdf_text import extract_pdf_text_parallel
+from app.libs.prompt_tokens import truncate_to_tokens
+from app.libs.request_batcher import RequestBatcher
+from app.libs.extraction_cache import pdf_cache_key, get_cached_result, put_cached_result
 
 # Initialize OpenAI client
 # Make sure to request the OPENAI_API_KEY from the user and store it as a secret
 try:
-    client = openai.OpenAI(api_key=db.secrets.get("OPENAI_API_KEY"))
+    client = openai.AsyncOpenAI(api_key=db.secrets.get("OPENAI_API_KEY"))
 except Exception as e:
     print(f"Error initializing OpenAI client: {e}. OPENAI_API_KEY might be missing.")
     client = None
@@ -38,16 +47,418 @@ class ExtractionResponse(BaseModel):
     raw_text_sample: str | None = None # First N characters of raw text for preview
 
 
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9._-]')
+# Deletes every ASCII character other than letters, digits and ._-; keys are nearly always ASCII,
+# and str.translate with a small table beats a regex substitution on them
+_SANITIZE_ASCII_TABLE = {c: None for c in range(128) if not (chr(c).isalnum() or chr(c) in '._-')}
+
 def sanitize_storage_key(key: str) -> str:
     """Sanitize storage key to only allow alphanumeric and ._- symbols"""
-    return re.sub(r'[^a-zA-Z0-9._-]', '', key)
+    if key.isascii():
+        return key.translate(_SANITIZE_ASCII_TABLE)
+    return _SANITIZE_RE.sub('', key)
 
 @router.get("/test-auth")
 async def test_auth_endpoint(user: AuthorizedUser):
     return {"message": "Auth test successful", "user_id": user.sub}
 
+def load_template(template_id: Optional[str]) -> Optional[PdfTemplate]:
+    """The template to extract with, or None for a generic extraction"""
+    if not template_id:
+        return None
+    try:
+        # Fetch the specific template using its ID directly from storage
+        all_templates_dict = db.storage.json.get(TEMPLATE_MANAGER_STORAGE_KEY, default={})
+        if template_id in all_templates_dict:
+            chosen_template = PdfTemplate(**all_templates_dict[template_id])
+            print(f"Using template: {chosen_template.name} (ID: {template_id})")
+            return chosen_template
+        print(f"Template ID {template_id} not found in storage. Proceeding with generic extraction.")
+    except Exception as e:
+        print(f"Error fetching template {template_id}: {e}. Proceeding with generic extraction.")
+    return None
+
+EXTRACTION_SYSTEM_PROMPT = "You are an AI assistant that extracts structured data from text and returns it as a valid JSON object according to the user's instructions."
+
+def build_extraction_instructions(chosen_template: Optional[PdfTemplate]) -> str:
+    """Instructions asking for the template's fields, or a generic extraction; the same for every PDF"""
+    # Base prompt
+    prompt_parts = [
+        EXTRACTION_SYSTEM_PROMPT,
+        "You are an expert data extraction assistant. Your task is to extract structured information from the provided text, which originates from a PDF document.",
+        "The text to parse is delimited by '--- BEGIN TEXT ---' and '--- END TEXT ---'.",
+        "Respond with a valid JSON object."
+    ]
+
+    # Schema and specific instructions based on template or generic
+    if chosen_template and chosen_template.target_fields:
+        # Rendered when the template is saved; templates saved before that have it rendered here
+        prompt_parts.append(chosen_template.prompt_prefix or render_prompt_prefix(chosen_template))
+    else:
+        prompt_parts.append("No specific template was selected, or the selected template has no target fields. Perform a generic extraction.")
+        prompt_parts.append("Identify and extract common business document fields such as: OrderNumber, OrderDate, CustomerName, DeliveryAddress, Items (with ProductName, Quantity, UnitPrice, TotalPrice), TotalAmount, Currency, etc.")
+        prompt_parts.append("The JSON output should be a flat object where keys are descriptive names for the data points and values are the extracted information. For lists like 'Items', use an array of objects.")
+        prompt_parts.append("If a commonly expected field is not found, you may omit it or use a JSON 'null' value.")
+
+    return "\n".join(prompt_parts)
+
+def template_field_patterns(chosen_template: Optional[PdfTemplate]) -> tuple:
+    """(field name, regex) of each template field that has a regex"""
+    if not chosen_template:
+        return ()
+    return tuple((field.field_name, field.regex) for field in chosen_template.target_fields if field.regex)
+
+@functools.lru_cache(maxsize=128)
+def compile_field_patterns(patterns: tuple):
+    """
+    One pattern finding all of a template's regex fields in a single scan of the text, with group
+    f<i> for the i-th of patterns, plus each field's own compiled pattern. None if they don't combine.
+    """
+    try:
+        combined = re.compile("|".join(f"(?P<f{i}>{regex})" for i, (_, regex) in enumerate(patterns)))
+        return combined, [re.compile(regex) for _, regex in patterns]
+    except re.error as e:
+        # Such as two fields using the same group name
+        print(f"Template field regexes can't be combined: {e}")
+        return None
+
+def regex_extract(chosen_template: Optional[PdfTemplate], raw_text: str) -> dict:
+    """Values of the template fields whose regex matches the text: the first group, or else the whole first match"""
+    patterns = template_field_patterns(chosen_template)
+    compiled = compile_field_patterns(patterns) if patterns else None
+    if not compiled:
+        return {}
+    combined, field_patterns = compiled
+    
+    found = {}
+    for match in combined.finditer(raw_text):
+        # The f<i> group encloses any groups of the field's own pattern, so it's the last to close
+        i = int(match.lastgroup[1:])
+        field_name = patterns[i][0]
+        if field_name in found:
+            continue
+        matched = match.group(match.lastgroup)
+        own_match = field_patterns[i].fullmatch(matched) if field_patterns[i].groups else None
+        value = (own_match.group(1) if own_match else matched) or ""
+        if value.strip():
+            found[field_name] = value.strip()
+            if len(found) == len(patterns):
+                break
+    return found
+
+# Tokens of PDF text sent to OpenAI per document, about what the earlier 4000-character cut gave on average
+PROMPT_TOKEN_LIMIT = 1000
+# Characters tokenized to find them, comfortably more than PROMPT_TOKEN_LIMIT tokens
+PROMPT_TEXT_LIMIT = PROMPT_TOKEN_LIMIT * 8
+
+def prompt_text(raw_text: str) -> str:
+    return truncate_to_tokens(raw_text[:PROMPT_TEXT_LIMIT], PROMPT_TOKEN_LIMIT)
+
+def extraction_messages(chosen_template: Optional[PdfTemplate], raw_text: str) -> list[dict]:
+    """
+    Chat messages for an extraction. Everything that doesn't depend on the PDF is in the system
+    message and the PDF text comes last, so repeat calls for a template share a prompt prefix that
+    OpenAI can serve from its prompt cache.
+    """
+    text_parts = [
+        "Text to parse:",
+        "--- BEGIN TEXT ---",
+        prompt_text(raw_text), # Limit text sent to OpenAI for performance/cost
+        "--- END TEXT ---"
+    ]
+    return [
+        {"role": "system", "content": build_extraction_instructions(chosen_template)},
+        {"role": "user", "content": "\n".join(text_parts)}
+    ]
+
+# Most PDFs extracted in one /extract-batch request, and so in one AI call
+BATCH_MAX_FILES = 16
+# Tokens the AI may answer with per document, bounding how long an answer takes to generate
+COMPLETION_TOKEN_LIMIT = 1200
+# Most output tokens gpt-4o-mini returns in one answer
+MODEL_MAX_COMPLETION_TOKENS = 16384
+
+def batch_extraction_messages(chosen_template: Optional[PdfTemplate], raw_texts: list[str]) -> list[dict]:
+    """Chat messages extracting several documents in one call, answered as {"results": [...]} in document order"""
+    instructions = "\n".join([
+        build_extraction_instructions(chosen_template),
+        "Several documents are given. Each starts with a '--- DOC n ---' line followed by its own delimited text.",
+        'Extract each document on its own and respond with a JSON object {"results": [...]} holding one JSON object per document, in the order the documents are given, each as described above.'
+    ])
+    text_parts = ["Documents to parse:"]
+    for i, raw_text in enumerate(raw_texts, 1):
+        text_parts.extend([
+            f"--- DOC {i} ---",
+            "--- BEGIN TEXT ---",
+            prompt_text(raw_text), # Limit text sent to OpenAI for performance/cost
+            "--- END TEXT ---"
+        ])
+    return [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": "\n".join(text_parts)}
+    ]
+
+def log_prompt_cache_usage(usage):
+    """Log how much of the prompt OpenAI served from its prompt cache"""
+    if not usage or not usage.prompt_tokens:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
+    print(f"Prompt cache: {cached_tokens}/{usage.prompt_tokens} prompt tokens cached ({cached_tokens / usage.prompt_tokens:.0%})")
+
+def text_value(value) -> str | None:
+    return None if value is None else str(value)
+
+def flatten_generic_fields(data: dict):
+    """(field name, value) rows of a generic extraction, with each entry of an "items" list spread into Item_<n>_<key> rows"""
+    for key, value in data.items():
+        if isinstance(value, list) and key.lower() == "items": # Handle items list separately
+            for i, item_obj in enumerate(value, 1):
+                if isinstance(item_obj, dict):
+                    yield from ((f"Item_{i}_{sub_key}", text_value(sub_value)) for sub_key, sub_value in item_obj.items())
+                else:
+                    yield f"Item_{i}", text_value(item_obj)
+        elif isinstance(value, (dict, list)):
+            yield key, orjson.dumps(value).decode() # Compact JSON for nested values
+        else:
+            yield key, text_value(value)
+
+def map_extracted_fields(data: dict, chosen_template: Optional[PdfTemplate]) -> list[ExtractedField]:
+    """Turn the JSON object returned by the AI into ExtractedField rows"""
+    if chosen_template and chosen_template.target_fields:
+        # If a template was used, try to map directly from its fields
+        rows = ((field_template.field_name, text_value(data.get(field_template.field_name))) for field_template in chosen_template.target_fields)
+    else:
+        # Generic extraction: iterate through AI's response keys
+        rows = flatten_generic_fields(data)
+    
+    # The rows are built here from strings, so they skip pydantic validation
+    extracted_fields = [ExtractedField.model_construct(field_name=field_name, value=value, confidence=None) for field_name, value in rows]
+    if extracted_fields:
+        return extracted_fields
+    if data: # If data was returned but not mapped
+        status = "Completed, AI returned data, but it was not mapped to the expected structure. Check raw AI response."
+    else: # No data and no fields
+        status = "Completed, but AI did not return any extractable data fields."
+    return [ExtractedField.model_construct(field_name="AI_Extraction_Status", value=status, confidence=None)]
+
+def extraction_response(file_name: str, raw_text: str, extracted_fields: list[ExtractedField]) -> ExtractionResponse:
+    return ExtractionResponse.model_construct(
+        message="File processed and data extracted by AI.",
+        file_name=file_name,
+        extracted_data=extracted_fields,
+        raw_text_sample=raw_text[:500] # Get a sample for the response
+    )
+
+# Uploads stored in the last few minutes, so a retried request doesn't store its document twice
+STORED_UPLOAD_TTL = 10 * 60  # seconds
+# upload digest -> expires
+_stored_uploads = {}
+_stored_uploads_lock = threading.Lock()
+
+def claim_upload(upload_digest: str) -> bool:
+    """Whether this upload still needs storing; if so it counts as stored until released"""
+    now = time.monotonic()
+    with _stored_uploads_lock:
+        for digest in [digest for digest, expires in _stored_uploads.items() if expires <= now]:
+            del _stored_uploads[digest]
+        if upload_digest in _stored_uploads:
+            return False
+        _stored_uploads[upload_digest] = now + STORED_UPLOAD_TTL
+        return True
+
+def release_upload(upload_digest: str):
+    with _stored_uploads_lock:
+        _stored_uploads.pop(upload_digest, None)
+
+def store_extraction(user: AuthorizedUser, file_name: str, pdf_content: bytes, raw_text: str, template_id: Optional[str], chosen_template: Optional[PdfTemplate], extracted_fields: list[ExtractedField]):
+    """
+    Store the PDF and its extracted data in the unified processed documents system.
+    
+    Runs as a background task once the response is sent, so failures are only logged.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (user.sub, file_name, template_id or ""):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    digest.update(pdf_content)
+    upload_digest = digest.hexdigest()
+    if not claim_upload(upload_digest):
+        print(f"Skipping repeat upload of {file_name}, stored already")
+        return
+    
+    try:
+        _store_extraction(user, file_name, pdf_content, raw_text, template_id, chosen_template, extracted_fields)
+    except Exception as e:
+        # Let a retry store it
+        release_upload(upload_digest)
+        print(f"Error storing extraction of {file_name}: {e}")
+        import traceback
+        traceback.print_exc()
+
+def _store_extraction(user: AuthorizedUser, file_name: str, pdf_content: bytes, raw_text: str, template_id: Optional[str], chosen_template: Optional[PdfTemplate], extracted_fields: list[ExtractedField]):
+    # Store the PDF file for later reference
+    sanitized_filename = lib_sanitize_storage_key(file_name)
+    pdf_storage_key = f"processed_pdfs.{lib_sanitize_storage_key(user.sub)}.{sanitized_filename}"
+    db.storage.binary.put(pdf_storage_key, pdf_content)
+    
+    # Convert extracted fields to dictionary format
+    extracted_data = {}
+    for field in extracted_fields:
+        extracted_data[field.field_name] = field.value
+    
+    # Store in unified processed documents system
+    template_name = chosen_template.name if chosen_template else None
+    document_id = store_processed_document(
+        source="file_upload",
+        original_filename=file_name,
+        template_id=template_id,
+        template_name=template_name,
+        extracted_data=extracted_data,
+        raw_text=raw_text,
+        user_id=user.sub,
+        user_email=user.email if hasattr(user, 'email') else 'unknown@example.com',
+        pdf_storage_key=pdf_storage_key
+    )
+    
+    print(f"Stored processed document with ID: {document_id}")
+
+def cache_extraction(cache_key: str, extracted_fields: list[ExtractedField], raw_text: str):
+    """Keep an extraction for repeat uploads of the same PDF; raw_text is kept too, as it's stored with each upload"""
+    put_cached_result(cache_key, {"extracted_fields": [field.model_dump() for field in extracted_fields], "raw_text": raw_text})
+
+async def request_extraction(messages: list[dict]) -> dict:
+    """Ask the AI to extract one document and parse its JSON answer"""
+    # Log the final prompt for debugging (optional, can be verbose)
+    # print(f"\nMessages being sent to OpenAI:\n{messages}\n")
+    print("Sending request to OpenAI...")
+    completion = await client.chat.completions.create(
+        model="gpt-4o-mini", # Using a cost-effective and capable model
+        messages=messages,
+        response_format={"type": "json_object"}, # Enable JSON mode
+        max_tokens=COMPLETION_TOKEN_LIMIT,
+        seed=0
+    )
+    log_prompt_cache_usage(completion.usage)
+    
+    if not (completion.choices and completion.choices[0].message and completion.choices[0].message.content):
+        print("OpenAI response was empty or not as expected.")
+        raise HTTPException(status_code=500, detail="AI model returned an empty or unexpected response.")
+    extracted_json_str = completion.choices[0].message.content
+    print(f"Received from OpenAI: {extracted_json_str}")
+    
+    # Attempt to parse the JSON string from OpenAI
+    try:
+        return orjson.loads(extracted_json_str)
+    except orjson.JSONDecodeError as e:
+        print(f"Error decoding JSON from OpenAI: {e}")
+        raise HTTPException(status_code=500, detail="Failed to decode JSON response from AI model.")
+
+async def request_batch_extraction(chosen_template: Optional[PdfTemplate], raw_texts: list[str]) -> list[dict]:
+    """Ask the AI to extract several documents in one call; documents it skipped are extracted on their own"""
+    print(f"Sending batch of {len(raw_texts)} documents to OpenAI...")
+    completion = await client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=batch_extraction_messages(chosen_template, raw_texts),
+        response_format={"type": "json_object"},
+        max_tokens=min(COMPLETION_TOKEN_LIMIT * len(raw_texts), MODEL_MAX_COMPLETION_TOKENS),
+        seed=0
+    )
+    log_prompt_cache_usage(completion.usage)
+
+    if not (completion.choices and completion.choices[0].message and completion.choices[0].message.content):
+        print("OpenAI response was empty or not as expected.")
+        raise HTTPException(status_code=500, detail="AI model returned an empty or unexpected response.")
+    try:
+        results = orjson.loads(completion.choices[0].message.content).get("results")
+    except (orjson.JSONDecodeError, AttributeError) as e:
+        print(f"Error decoding JSON from OpenAI: {e}")
+        raise HTTPException(status_code=500, detail="Failed to decode JSON response from AI model.")
+    if not isinstance(results, list):
+        raise HTTPException(status_code=500, detail="AI model returned an unexpected response.")
+    if len(results) != len(raw_texts):
+        print(f"OpenAI returned {len(results)} results for {len(raw_texts)} documents")
+    results = [results[i] if i < len(results) and isinstance(results[i], dict) else None for i in range(len(raw_texts))]
+    # A missing answer isn't an empty extraction, so those documents are retried with the single-document prompt
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        print(f"Retrying {len(missing)} documents missing from the batch one at a time")
+        retried = await asyncio.gather(*(request_extraction(extraction_messages(chosen_template, raw_texts[i])) for i in missing))
+        for i, result in zip(missing, retried):
+            results[i] = result
+    return results
+
+async def run_coalesced_extractions(instructions: str, items: list[tuple]) -> list[dict]:
+    """Extract (template, raw text) items that share instructions, in one call; a lone item gets the single-document prompt"""
+    if len(items) == 1:
+        ai_template, raw_text = items[0]
+        return [await request_extraction(extraction_messages(ai_template, raw_text))]
+    return await request_batch_extraction(items[0][0], [raw_text for _, raw_text in items])
+
+# /extract-data requests wait this long for others with the same instructions, to share an AI call
+COALESCE_WAIT = 0.05  # seconds
+# Most /extract-data requests sharing one AI call
+COALESCE_MAX_BATCH = 8
+
+extraction_batcher = RequestBatcher(run_coalesced_extractions, max_batch_size=COALESCE_MAX_BATCH, max_wait=COALESCE_WAIT)
+
+def sse_event(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+async def stream_extraction(background_tasks: BackgroundTasks, user: AuthorizedUser, file_name: str, pdf_content: bytes, raw_text: str, template_id: Optional[str], chosen_template: Optional[PdfTemplate], messages: list[dict], cache_key: str, local_data: dict):
+    """
+    Server-sent events for an extraction: a "delta" event (JSON string) per piece of the AI's answer
+    as it's generated, then a "result" event with the ExtractionResponse once it's parsed.
+    
+    The response has started by the time anything can fail, so failures are sent as an "error" event.
+    """
+    buffer = io.StringIO()
+    try:
+        print("Streaming request to OpenAI...")
+        stream = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            response_format={"type": "json_object"},
+            max_tokens=COMPLETION_TOKEN_LIMIT,
+            seed=0,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        async for chunk in stream:
+            # The last chunk has no choices, just the usage
+            log_prompt_cache_usage(chunk.usage)
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                buffer.write(delta)
+                yield sse_event("delta", orjson.dumps(delta).decode())
+        
+        try:
+            data = orjson.loads(buffer.getvalue())
+        except orjson.JSONDecodeError as e:
+            print(f"Error decoding JSON from OpenAI: {e}")
+            yield sse_event("error", orjson.dumps({"detail": "Failed to decode JSON response from AI model."}).decode())
+            return
+        
+        extracted_fields = map_extracted_fields({**data, **local_data}, chosen_template)
+        await asyncio.to_thread(cache_extraction, cache_key, extracted_fields, raw_text)
+        # Stored once the stream has ended
+        background_tasks.add_task(store_extraction, user, file_name, pdf_content, raw_text, template_id, chosen_template, extracted_fields)
+        yield sse_event("result", extraction_response(file_name, raw_text, extracted_fields).model_dump_json())
+    
+    except Exception as e:
+        print(f"Unexpected error streaming extraction of {file_name}: {e}")
+        import traceback
+        traceback.print_exc()
+        yield sse_event("error", orjson.dumps({"detail": f"An unexpected error occurred: {str(e)}"}).decode())
+
 @router.post("/extract-data", response_model=ExtractionResponse)
-async def extract_data_from_pdf(user: AuthorizedUser, file: UploadFile, template_id: Optional[str] = Form(None)):
+async def extract_data_from_pdf(request: Request, background_tasks: BackgroundTasks, user: AuthorizedUser, file: UploadFile, template_id: Optional[str] = Form(None)):
+    """
+    Extract data from a PDF with AI and store it once the response has been sent.
+    
+    Clients that send `Accept: text/event-stream` get the AI's answer streamed as it's generated
+    (see stream_extraction); everyone else gets the ExtractionResponse as JSON.
+    """
     if not file.filename:
         raise HTTPException(status_code=400, detail="No file name provided.")
 
@@ -56,127 +467,59 @@ async def extract_data_from_pdf(user: AuthorizedUser, file: UploadFile, template
 
     try:
         pdf_content = await file.read()
+        streaming = "text/event-stream" in request.headers.get("accept", "")
         
-        raw_text = ""
-        with pdfplumber.open(io.BytesIO(pdf_content)) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    raw_text += page_text + "\n"
+        chosen_template = await asyncio.to_thread(load_template, template_id)
+        
+        def respond(raw_text: str, extracted_fields: list[ExtractedField]):
+            """Answer without calling the AI, storing the upload after responding"""
+            background_tasks.add_task(store_extraction, user, file.filename, pdf_content, raw_text, template_id, chosen_template, extracted_fields)
+            response = extraction_response(file.filename, raw_text, extracted_fields)
+            if streaming:
+                return StreamingResponse(iter([sse_event("result", response.model_dump_json())]), media_type="text/event-stream")
+            return response
+        
+        # The same PDF extracted with the same instructions and field regexes before: skip parsing and the AI call
+        cache_key = pdf_cache_key(pdf_content, "pdf-parser/extract-data", build_extraction_instructions(chosen_template), orjson.dumps(template_field_patterns(chosen_template)).decode())
+        cached = await asyncio.to_thread(get_cached_result, cache_key)
+        if cached is not None:
+            print(f"Using cached extraction for {file.filename}")
+            return respond(cached["raw_text"], [ExtractedField.model_construct(**field) for field in cached["extracted_fields"]])
+        
+        # Long PDFs have their pages spread over the process pool; wait for that in a thread
+        raw_text = await asyncio.to_thread(extract_pdf_text_parallel, pdf_content)
+        
+        # Fields the template's regexes find in the text aren't asked of the AI
+        local_data = regex_extract(chosen_template, raw_text)
+        ai_template = chosen_template
+        if local_data:
+            ai_template = chosen_template.model_copy(update={
+                "target_fields": [field for field in chosen_template.target_fields if field.field_name not in local_data],
+                # Rendered for the remaining fields instead
+                "prompt_prefix": None,
+            })
+            if not ai_template.target_fields:
+                print(f"All template fields of {file.filename} found by regex; skipping the AI")
+                extracted_fields = map_extracted_fields(local_data, chosen_template)
+                await asyncio.to_thread(cache_extraction, cache_key, extracted_fields, raw_text)
+                return respond(raw_text, extracted_fields)
         
-        raw_text_sample = raw_text[:500] # Get a sample for the response
-
         if not client:
             raise HTTPException(status_code=500, detail="OpenAI client not initialized. API key may be missing.")
 
-        chosen_template: Optional[PdfTemplate] = None
-        if template_id:
-            try:
-                # Fetch the specific template using its ID directly from storage
-                all_templates_dict = db.storage.json.get(TEMPLATE_MANAGER_STORAGE_KEY, default={})
-                if template_id in all_templates_dict:
-                    chosen_template = PdfTemplate(**all_templates_dict[template_id])
-                    print(f"Using template: {chosen_template.name} (ID: {template_id})")
-                else:
-                    print(f"Template ID {template_id} not found in storage. Proceeding with generic extraction.")
-            except Exception as e:
-                print(f"Error fetching template {template_id}: {e}. Proceeding with generic extraction.")
-        
-        # Base prompt
-        prompt_parts = [
-            "You are an expert data extraction assistant. Your task is to extract structured information from the provided text, which originates from a PDF document.",
-            "The text to parse is delimited by '--- BEGIN TEXT ---' and '--- END TEXT ---'.",
-            "Respond with a valid JSON object."
-        ]
-
-        # Schema and specific instructions based on template or generic
-        if chosen_template and chosen_template.target_fields:
-            prompt_parts.append(f"A specific extraction template named '{chosen_template.name}' has been selected. Focus on extracting the following fields:")
-            field_descriptions = []
-            json_schema_fields = "{"
-            for i, field in enumerate(chosen_template.target_fields):
-                field_desc = f"  - '{field.field_name}'"
-                if field.ai_hint:
-                    field_desc += f" (Hint: {field.ai_hint})"
-                field_descriptions.append(field_desc)
-                json_schema_fields += f'\"{field.field_name}\": \"string or number or array or null\"' # Broad type for schema
-                if i < len(chosen_template.target_fields) - 1:
-                    json_schema_fields += ", "
-            json_schema_fields += "}"
-            prompt_parts.append("\n".join(field_descriptions))
-            prompt_parts.append(f"The JSON output should strictly follow this structure: {json_schema_fields}.")
-            prompt_parts.append("If a field is not found or not applicable, use a JSON 'null' value for it.")
-        else:
-            prompt_parts.append("No specific template was selected, or the selected template has no target fields. Perform a generic extraction.")
-            prompt_parts.append("Identify and extract common business document fields such as: OrderNumber, OrderDate, CustomerName, DeliveryAddress, Items (with ProductName, Quantity, UnitPrice, TotalPrice), TotalAmount, Currency, etc.")
-            prompt_parts.append("The JSON output should be a flat object where keys are descriptive names for the data points and values are the extracted information. For lists like 'Items', use an array of objects.")
-            prompt_parts.append("If a commonly expected field is not found, you may omit it or use a JSON 'null' value.")
-
-        prompt_parts.append("\nText to parse:")
-        prompt_parts.append("--- BEGIN TEXT ---")
-        prompt_parts.append(raw_text[:4000]) # Limit text sent to OpenAI for performance/cost
-        prompt_parts.append("--- END TEXT ---")
-        
-        final_prompt = "\n".join(prompt_parts)
+        messages = extraction_messages(ai_template, raw_text)
 
-        # Log the final prompt for debugging (optional, can be verbose)
-        # print(f"\nFinal prompt being sent to OpenAI:\n{final_prompt}\n")
+        if streaming:
+            return StreamingResponse(
+                stream_extraction(background_tasks, user, file.filename, pdf_content, raw_text, template_id, chosen_template, messages, cache_key, local_data),
+                media_type="text/event-stream"
+            )
 
-        extracted_fields = []
         try:
-            print("Sending request to OpenAI...")
-            completion = client.chat.completions.create(
-                model="gpt-4o-mini", # Using a cost-effective and capable model
-                messages=[
-                    {"role": "system", "content": "You are an AI assistant that extracts structured data from text and returns it as a valid JSON object according to the user's instructions."},
-                    {"role": "user", "content": final_prompt}
-                ],
-                response_format={"type": "json_object"} # Enable JSON mode
-            )
-            
-            if completion.choices and completion.choices[0].message and completion.choices[0].message.content:
-                extracted_json_str = completion.choices[0].message.content
-                print(f"Received from OpenAI: {extracted_json_str}")
-                
-                # Attempt to parse the JSON string from OpenAI
-                try:
-                    data = json.loads(extracted_json_str)
-                except json.JSONDecodeError as e:
-                    print(f"Error decoding JSON from OpenAI: {e}")
-                    raise HTTPException(status_code=500, detail="Failed to decode JSON response from AI model.")
-
-                # This part needs to be adapted based on the actual JSON structure returned by OpenAI
-                # For now, we'll iterate through top-level keys as an example.
-                if chosen_template and chosen_template.target_fields:
-                    # If a template was used, try to map directly from its fields
-                    for field_template in chosen_template.target_fields:
-                        value = data.get(field_template.field_name)
-                        extracted_fields.append(ExtractedField(field_name=field_template.field_name, value=str(value) if value is not None else None))
-                    if not extracted_fields and data:
-                         extracted_fields.append(ExtractedField(field_name="AI_Extraction_Note", value="Template was used, AI returned data, but no template fields matched the AI response keys directly. Raw AI JSON might be available in logs or if parsing is adjusted."))
-                else:
-                    # Generic extraction: iterate through AI's response keys
-                    for key, value in data.items():
-                        if isinstance(value, list) and key.lower() == "items": # Handle items list separately
-                            for i, item_obj in enumerate(value):
-                                if isinstance(item_obj, dict):
-                                    for sub_key, sub_value in item_obj.items():
-                                        extracted_fields.append(ExtractedField(field_name=f"Item_{i+1}_{sub_key}", value=str(sub_value) if sub_value is not None else None))
-                                else:
-                                    extracted_fields.append(ExtractedField(field_name=f"Item_{i+1}", value=str(item_obj) if item_obj is not None else None))
-                        elif isinstance(value, (dict, list)):
-                            extracted_fields.append(ExtractedField(field_name=key, value=json.dumps(value) if value is not None else None))
-                        else:
-                            extracted_fields.append(ExtractedField(field_name=key, value=str(value) if value is not None else None))
-                
-                if not extracted_fields and data: # If data was returned but not mapped
-                     extracted_fields.append(ExtractedField(field_name="AI_Extraction_Status", value="Completed, AI returned data, but it was not mapped to the expected structure. Check raw AI response."))
-                elif not extracted_fields: # No data and no fields
-                     extracted_fields.append(ExtractedField(field_name="AI_Extraction_Status", value="Completed, but AI did not return any extractable data fields."))
-
-            else:
-                print("OpenAI response was empty or not as expected.")
-                raise HTTPException(status_code=500, detail="AI model returned an empty or unexpected response.")
+            # Requests arriving together with the same instructions share one OpenAI call
+            data = await extraction_batcher.submit(messages[0]["content"], (ai_template, raw_text))
+            extracted_fields = map_extracted_fields({**data, **local_data}, chosen_template)
+            await asyncio.to_thread(cache_extraction, cache_key, extracted_fields, raw_text)
 
         except openai.APIError as e:
             print(f"OpenAI API Error: {e}")
@@ -191,38 +534,8 @@ async def extract_data_from_pdf(user: AuthorizedUser, file: UploadFile, template
                 raise e
             raise HTTPException(status_code=500, detail=f"An unexpected error occurred during AI processing: {str(e)}")
 
-        # Store the PDF file for later reference
-        sanitized_filename = lib_sanitize_storage_key(file.filename)
-        pdf_storage_key = f"processed_pdfs.{lib_sanitize_storage_key(user.sub)}.{sanitized_filename}"
-        db.storage.binary.put(pdf_storage_key, pdf_content)
-        
-        # Convert extracted fields to dictionary format
-        extracted_data = {}
-        for field in extracted_fields:
-            extracted_data[field.field_name] = field.value
-        
-        # Store in unified processed documents system
-        template_name = chosen_template.name if chosen_template else None
-        document_id = store_processed_document(
-            source="file_upload",
-            original_filename=file.filename,
-            template_id=template_id,
-            template_name=template_name,
-            extracted_data=extracted_data,
-            raw_text=raw_text,
-            user_id=user.sub,
-            user_email=user.email if hasattr(user, 'email') else 'unknown@example.com',
-            pdf_storage_key=pdf_storage_key
-        )
-        
-        print(f"Stored processed document with ID: {document_id}")
-
-        return ExtractionResponse(
-            message="File processed and data extracted by AI.",
-            file_name=file.filename,
-            extracted_data=extracted_fields,
-            raw_text_sample=raw_text_sample
-        )
+        background_tasks.add_task(store_extraction, user, file.filename, pdf_content, raw_text, template_id, chosen_template, extracted_fields)
+        return extraction_response(file.filename, raw_text, extracted_fields)
 
     except HTTPException as e:
         raise e # Re-raise HTTPExceptions to be handled by FastAPI
@@ -234,3 +547,48 @@ async def extract_data_from_pdf(user: AuthorizedUser, file: UploadFile, template
         import traceback
         traceback.print_exc() # Print full traceback for unexpected errors
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+
+@router.post("/extract-batch", response_model=list[ExtractionResponse])
+async def extract_data_from_pdfs(background_tasks: BackgroundTasks, user: AuthorizedUser, files: list[UploadFile], template_id: Optional[str] = Form(None)):
+    """
+    Extract data from several PDFs with one AI call, sharing the instructions between them, and
+    store each like /extract-data does, after responding. Responses are in the order the files were sent.
+    """
+    if not files:
+        raise HTTPException(status_code=400, detail="No files provided.")
+    if len(files) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_FILES} files can be extracted at once.")
+    for file in files:
+        if not file.filename:
+            raise HTTPException(status_code=400, detail="No file name provided.")
+        if not file.filename.lower().endswith(".pdf"):
+            raise HTTPException(status_code=400, detail=f"Invalid file type for {file.filename}. Only PDF files are accepted.")
+
+    if not client:
+        raise HTTPException(status_code=500, detail="OpenAI client not initialized. API key may be missing.")
+
+    try:
+        pdf_contents = [await file.read() for file in files]
+        raw_texts = await asyncio.gather(*(asyncio.to_thread(extract_pdf_text_parallel, pdf_content) for pdf_content in pdf_contents))
+        chosen_template = await asyncio.to_thread(load_template, template_id)
+
+        results = await request_batch_extraction(chosen_template, raw_texts)
+
+        responses = []
+        for i, file in enumerate(files):
+            data = results[i]
+            extracted_fields = map_extracted_fields(data, chosen_template)
+            background_tasks.add_task(store_extraction, user, file.filename, pdf_contents[i], raw_texts[i], template_id, chosen_template, extracted_fields)
+            responses.append(extraction_response(file.filename, raw_texts[i], extracted_fields))
+        return responses
+
+    except HTTPException as e:
+        raise e
+    except openai.APIError as e:
+        print(f"OpenAI API Error during batch PDF processing: {e}")
+        raise HTTPException(status_code=503, detail=f"OpenAI API error: {e}")
+    except Exception as e:
+        print(f"Unexpected error processing PDF batch: {e}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
@@ -1,12 +1,24 @@
-import pdfplumber
-from io import BytesIO
-from typing import Dict, Any
-from openai import OpenAI
-import json
+from typing import Dict, Any, Optional
+from openai import AsyncOpenAI
+import ahocorasick
+import asyncio
+import orjson
+import time
 import uuid
 from datetime import datetime
 from fastapi import APIRouter, UploadFile, File, HTTPException
 from pydantic import BaseModel
+from app.apis.template_manager import TEMPLATES_STORAGE_KEY, get_templates_version
+from app.libs.pdf_text import extract_pdf_text_parallel
+from app.libs.prompt_tokens import truncate_to_tokens
+from app.libs.extraction_cache import pdf_cache_key, get_cached_result, put_cached_result
+
+# Initialize OpenAI client once, so its connections are reused across requests
+try:
+    client = AsyncOpenAI(api_key=db.secrets.get("OPENAI_API_KEY"))
+except Exception as e:
+    print(f"Error initializing OpenAI client: {e}. OPENAI_API_KEY might be missing.")
+    client = None
 
 router = APIRouter(prefix="/pdf")
 
@@ -28,7 +40,7 @@ async def extract_data_from_pdf(file: UploadFile = File(...)):
         content = await file.read()
         
         # Process with existing logic
-        result = extract_data_from_pdf_bytes(content, file.filename)
+        result = await extract_data_from_pdf_bytes(content, file.filename)
         
         return PDFExtractionResponse(
             extracted_data=result.get("extracted_data", {}),
@@ -41,25 +53,26 @@ async def extract_data_from_pdf(file: UploadFile = File(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing PDF: {str(e)}")
 
-def extract_data_from_pdf_bytes(pdf_bytes: bytes, filename: str) -> Dict[str, Any]:
+async def extract_data_from_pdf_bytes(pdf_bytes: bytes, filename: str) -> Dict[str, Any]:
     """Extract data from PDF bytes using AI and template matching"""
     try:
-        # Extract text from PDF
-        with pdfplumber.open(BytesIO(pdf_bytes)) as pdf:
-            text = ""
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-        
-        if not text.strip():
-            raise Exception("No text found in PDF")
-        
-        # Use AI to extract structured data
-        extracted_data = extract_structured_data_with_ai(text, filename)
+        # The prompt names the file, so the same PDF under another name is extracted again
+        cache_key = pdf_cache_key(pdf_bytes, "pdf/extract", filename)
+        cached = await asyncio.to_thread(get_cached_result, cache_key)
+        if cached is not None:
+            extracted_data, text = cached["extracted_data"], cached["raw_text"]
+        else:
+            # Extract text from PDF, spreading the pages of long ones over worker processes
+            text = await asyncio.to_thread(extract_pdf_text_parallel, pdf_bytes)
+            
+            if not text.strip():
+                raise Exception("No text found in PDF")
+            
+            # Use AI to extract structured data
+            extracted_data = await extract_structured_data_with_ai(text, filename, cache_key)
         
         # Try to match against existing templates
-        template_match = match_against_templates(extracted_data)
+        template_match = await asyncio.to_thread(match_against_templates, extracted_data)
         
         return {
             "extracted_data": extracted_data,
@@ -71,10 +84,19 @@ def extract_data_from_pdf_bytes(pdf_bytes: bytes, filename: str) -> Dict[str, An
     except Exception as e:
         raise Exception(f"PDF processing failed: {str(e)}")
 
-def extract_structured_data_with_ai(text: str, filename: str) -> Dict[str, Any]:
-    """Use OpenAI to extract structured data from text"""
+# Tokens of PDF text sent to OpenAI; longer documents are cut
+PROMPT_TOKEN_LIMIT = 2500
+# Characters tokenized to find them, comfortably more than PROMPT_TOKEN_LIMIT tokens
+PROMPT_TEXT_LIMIT = PROMPT_TOKEN_LIMIT * 8
+# Tokens the AI may answer with, bounding how long an answer takes to generate
+COMPLETION_TOKEN_LIMIT = 800
+
+async def extract_structured_data_with_ai(text: str, filename: str, cache_key: Optional[str] = None) -> Dict[str, Any]:
+    """Use OpenAI to extract structured data from text, caching it under cache_key if the AI's answer parses"""
     try:
-        client = OpenAI(api_key=db.secrets.get("OPENAI_API_KEY"))
+        if not client:
+            raise Exception("OpenAI client not initialized. API key may be missing.")
+        prompt_text = await asyncio.to_thread(truncate_to_tokens, text[:PROMPT_TEXT_LIMIT], PROMPT_TOKEN_LIMIT)
         
         prompt = f"""
 Du er en ekspert på å trekke ut strukturert informasjon fra PDF-dokumenter med bestillinger og oppdrag.
@@ -82,7 +104,7 @@ Du er en ekspert på å trekke ut strukturert informasjon fra PDF-dokumenter med
 Dokument: {filename}
 
 Tekst fra PDF:
-{text}
+{prompt_text}
 
 Oppgave: Trekk ut all relevant bestillingsinformasjon og strukturer det som JSON.
 
@@ -100,27 +122,24 @@ Søk etter følgende informasjon (bruk null hvis ikke funnet):
 
 Returner kun gyldig JSON uten forklaringer:"""
         
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "Du er en ekspert på å trekke ut strukturert data fra dokumenter. Returner alltid gyldig JSON."},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0.1
+            temperature=0.1,
+            response_format={"type": "json_object"},
+            max_tokens=COMPLETION_TOKEN_LIMIT,
+            seed=0
         )
         
-        # Parse AI response
-        ai_response = response.choices[0].message.content.strip()
-        
-        # Clean up response to ensure valid JSON
-        if ai_response.startswith('```json'):
-            ai_response = ai_response[7:]
-        if ai_response.endswith('```'):
-            ai_response = ai_response[:-3]
-        
+        # Parse AI response; JSON mode returns a bare object, but one cut off at max_tokens won't parse
         try:
-            extracted_data = json.loads(ai_response)
-        except json.JSONDecodeError:
+            extracted_data = orjson.loads(response.choices[0].message.content)
+            if cache_key:
+                await asyncio.to_thread(put_cached_result, cache_key, {"extracted_data": extracted_data, "raw_text": text[:1000]})
+        except orjson.JSONDecodeError:
             # Fallback: create basic structure
             extracted_data = {
                 "Beskrivelse": text[:200] + "..." if len(text) > 200 else text,
@@ -138,14 +157,54 @@ Returner kun gyldig JSON uten forklaringer:"""
             "error": str(e)
         }
 
+# Templates as parallel lists for matching, rebuilt after the TTL or as soon as this process saves templates
+TEMPLATE_INDEX_TTL = 60  # seconds
+# (expires, templates version, index)
+_template_index = None
+
+def build_name_automaton(names_lower: list):
+    """Aho-Corasick automaton finding every template name in a text in one pass, valued with the templates' positions"""
+    positions_by_name = {}
+    for i, name in enumerate(names_lower):
+        if name:
+            positions_by_name.setdefault(name, []).append(i)
+    if not positions_by_name:
+        return None
+    automaton = ahocorasick.Automaton()
+    for name, positions in positions_by_name.items():
+        automaton.add_word(name, positions)
+    automaton.make_automaton()
+    return automaton
+
+def get_template_index() -> Dict[str, Any]:
+    """Ids, lowercase names, field name sets and a name automaton of all templates, in storage order"""
+    global _template_index
+    version = get_templates_version()
+    if _template_index and _template_index[0] > time.monotonic() and _template_index[1] == version:
+        return _template_index[2]
+    
+    templates_dict = db.storage.json.get(TEMPLATES_STORAGE_KEY, default={})
+    index = {
+        "ids": list(templates_dict),
+        "names": [template_data.get('name', 'Ukjent mal') for template_data in templates_dict.values()],
+        "names_lower": [template_data.get('name', '').lower() for template_data in templates_dict.values()],
+        "fields": [
+            frozenset(field.get('field_name', '') for field in template_data.get('target_fields', []))
+            for template_data in templates_dict.values()
+        ],
+    }
+    index["name_automaton"] = build_name_automaton(index["names_lower"])
+    # An empty name is "in" any text
+    index["unnamed"] = [i for i, name in enumerate(index["names_lower"]) if not name]
+    _template_index = (time.monotonic() + TEMPLATE_INDEX_TTL, version, index)
+    return index
+
 def match_against_templates(extracted_data: Dict[str, Any]) -> Dict[str, str]:
     """Try to match extracted data against existing templates"""
     try:
-        # Load existing templates
-        from app.apis.template_manager import TEMPLATES_STORAGE_KEY
-        templates_dict = db.storage.json.get(TEMPLATES_STORAGE_KEY, default={})
+        index = get_template_index()
         
-        if not templates_dict:
+        if not index["ids"]:
             return {"template_id": None, "template_name": "Ingen mal"}
         
         # Simple keyword-based matching
@@ -154,25 +213,23 @@ def match_against_templates(extracted_data: Dict[str, Any]) -> Dict[str, str]:
         
         # Create searchable text from extracted data
         search_text = ' '.join(str(v) for v in extracted_data.values() if v).lower()
+        extracted_fields = frozenset(extracted_data)
         
-        for template_id, template_data in templates_dict.items():
-            template_name = template_data.get('name', '').lower()
-            score = 0
-            
-            # Check if template name appears in extracted data
-            if template_name in search_text:
-                score += 10
-            
-            # Check field overlap
-            template_fields = [field.get('field_name', '') for field in template_data.get('target_fields', [])]
-            matching_fields = sum(1 for field in template_fields if field in extracted_data)
-            score += matching_fields * 2
+        # Templates whose name appears in the extracted data, found in one scan of the text
+        named = set(index["unnamed"])
+        if index["name_automaton"] is not None:
+            for _, positions in index["name_automaton"].iter(search_text):
+                named.update(positions)
+        
+        for i, fields in enumerate(index["fields"]):
+            # Template name appearing in the extracted data, plus field overlap
+            score = (10 if i in named else 0) + len(fields & extracted_fields) * 2
             
             if score > best_score:
                 best_score = score
                 best_match = {
-                    "template_id": template_id,
-                    "template_name": template_data.get('name', 'Ukjent mal')
+                    "template_id": index["ids"][i],
+                    "template_name": index["names"][i]
                 }
         
         return best_match or {"template_id": None, "template_name": "Ingen mal"}
@@ -1,12 +1,47 @@
 from fastapi import APIRouter, HTTPException, UploadFile, File
+from fastapi.responses import Response
 from app.auth import AuthorizedUser
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 from datetime import datetime
+import bisect
+import re
+import threading
+import time
 import uuid
+import xlsxwriter
+from app.libs.json_store import get_json_document, put_json_document
 
 router = APIRouter()
 
+# Documents keyed by id, in the order they were added, stored as {"version": ..., "documents": {...}}
+PROCESSED_DOCS_KEY = "processed_documents_v2"
+# The list all documents used to be kept in; documents still appended there are read from it
+# and moved over by the next write
+LEGACY_PROCESSED_DOCS_KEY = "processed_documents"
+# Ids of the documents with each value of the fields the list filters match exactly: {field: {value: [doc ids]}},
+# and under DATE_INDEX a sorted list of [processed date, doc id] for the date range filters
+PROCESSED_DOCS_INDEX_KEY = "processed_documents_v2_index"
+INDEXED_FIELDS = ('source', 'status', 'template_id', 'user_id')
+DATE_INDEX = 'processed_date'
+# The documents and the index are two writes, so each write stamps both with a new version. An index
+# whose version isn't the documents' (a write interleaved with another, or failed in between) is rebuilt
+VERSION_KEY = 'version'
+# Documents and index as this process last read or wrote them, reused by reads for a short while;
+# writes always read storage, so other processes' changes aren't overwritten
+PROCESSED_DOCS_CACHE_TTL = 2.0  # seconds
+# (expires, docs, index or None, version)
+_docs_cache = (0.0, None, None, None)
+_docs_cache_lock = threading.Lock()
+# Document metadata columns leading each export row: (header, document key, default)
+EXPORT_METADATA_COLUMNS = (
+    ('Document ID', 'id', None),
+    ('Filename', 'original_filename', ''),
+    ('Processed Date', 'processed_date', ''),
+    ('Export Count', 'export_count', 0),
+    ('Last Exported', 'last_exported_date', ''),
+)
+
 class ProcessedDocument(BaseModel):
     id: str
     source: str  # 'file_upload' or 'email'
@@ -45,6 +80,167 @@ class UpdateDocumentRequest(BaseModel):
 class BatchExportRequest(BaseModel):
     document_ids: List[str]
 
+
+# --- Storage Helpers ---
+
+def index_document(index: dict, doc: dict):
+    """Add a document's id under each of its indexed field values, and to the date index"""
+    for field in INDEXED_FIELDS:
+        value = doc.get(field)
+        if value is not None:
+            ids = index.setdefault(field, {}).setdefault(value, [])
+            if doc['id'] not in ids:
+                ids.append(doc['id'])
+    by_date = index.setdefault(DATE_INDEX, [])
+    entry = [doc.get('processed_date') or '', doc['id']]
+    position = bisect.bisect_left(by_date, entry)
+    if position == len(by_date) or by_date[position] != entry:
+        by_date.insert(position, entry)
+
+def unindex_document(index: dict, doc: dict):
+    """Remove a document's id from under each of its indexed field values, and from the date index"""
+    for field in INDEXED_FIELDS:
+        values = index.get(field, {})
+        ids = values.get(doc.get(field))
+        if ids and doc['id'] in ids:
+            ids.remove(doc['id'])
+            if not ids:
+                del values[doc.get(field)]
+    by_date = index.get(DATE_INDEX, [])
+    entry = [doc.get('processed_date') or '', doc['id']]
+    position = bisect.bisect_left(by_date, entry)
+    if position < len(by_date) and by_date[position] == entry:
+        del by_date[position]
+
+def build_index(docs: dict, version: Optional[str] = None) -> dict:
+    index = {field: {} for field in INDEXED_FIELDS}
+    index[DATE_INDEX] = []
+    index[VERSION_KEY] = version
+    for doc in docs.values():
+        index_document(index, doc)
+    return index
+
+def remember_documents(docs: Optional[dict], index: Optional[dict], version: Optional[str] = None):
+    global _docs_cache
+    with _docs_cache_lock:
+        _docs_cache = (time.monotonic() + PROCESSED_DOCS_CACHE_TTL, docs, index, version)
+
+def read_legacy_documents() -> list:
+    return db.storage.json.get(LEGACY_PROCESSED_DOCS_KEY, default=[])
+
+def drop_legacy_documents(doc_ids: set):
+    """Remove documents from the old list, re-reading it first so documents appended since are kept"""
+    legacy_docs = read_legacy_documents()
+    remaining_docs = [doc for doc in legacy_docs if doc.get('id') not in doc_ids]
+    if len(remaining_docs) != len(legacy_docs):
+        db.storage.json.put(LEGACY_PROCESSED_DOCS_KEY, remaining_docs)
+
+def read_documents() -> tuple:
+    """The stored documents and their version; documents stored before they had one are version None"""
+    stored = get_json_document(PROCESSED_DOCS_KEY) or {}
+    if isinstance(stored.get('documents'), dict) and VERSION_KEY in stored:
+        return stored['documents'], stored[VERSION_KEY]
+    return stored, None
+
+def read_index(docs: dict, version: Optional[str]) -> dict:
+    """The stored index if it was written with the documents of this version, or else one rebuilt from them"""
+    index = get_json_document(PROCESSED_DOCS_INDEX_KEY)
+    if version is not None and index is not None and index.get(VERSION_KEY) == version and DATE_INDEX in index:
+        return index
+    index = build_index(docs, version)
+    if version is not None:
+        # Correct for this version whatever was written since, as a newer write has another version
+        put_json_document(PROCESSED_DOCS_INDEX_KEY, index)
+    return index
+
+def save_documents(docs: dict, index: dict, legacy_ids: Optional[set] = None):
+    """
+    Store the documents and their index under a new version. legacy_ids are the documents that
+    were in the old list when docs was loaded; they're dropped from it now that docs is stored.
+    """
+    if legacy_ids:
+        # Documents moved over from the old list aren't in the stored index yet
+        index = build_index(docs)
+    version = uuid.uuid4().hex
+    index[VERSION_KEY] = version
+    try:
+        put_json_document(PROCESSED_DOCS_KEY, {VERSION_KEY: version, 'documents': docs})
+        put_json_document(PROCESSED_DOCS_INDEX_KEY, index)
+    except Exception:
+        # Storage may hold either version now
+        remember_documents(None, None)
+        raise
+    remember_documents(docs, index, version)
+    if legacy_ids:
+        drop_legacy_documents(legacy_ids)
+
+def merge_legacy_documents(docs: dict, legacy_docs: list) -> set:
+    """Add the documents only found in the old list to docs; returns the ids of all documents in the old list"""
+    legacy_ids = set()
+    for doc in legacy_docs:
+        if doc.get('id'):
+            docs.setdefault(doc['id'], doc)
+            legacy_ids.add(doc['id'])
+    return legacy_ids
+
+def load_documents() -> dict:
+    """
+    All processed documents keyed by id, including any still only in the old list, which
+    document_processor appends to. The copy read or written in the last PROCESSED_DOCS_CACHE_TTL
+    seconds may be returned, so it must not be changed; writers use load_documents_for_update.
+    """
+    expires, docs, _, _ = _docs_cache
+    if docs is not None and expires > time.monotonic():
+        return docs
+    
+    docs, version = read_documents()
+    legacy_docs = read_legacy_documents()
+    if legacy_docs:
+        # Merged for reading only; the next write moves them over
+        docs = dict(docs)
+        merge_legacy_documents(docs, legacy_docs)
+        remember_documents(docs, build_index(docs), version)
+    else:
+        remember_documents(docs, None, version)
+    return docs
+
+def load_documents_for_update() -> tuple:
+    """
+    The documents and their index read from storage, not the cache, for changing and passing to
+    save_documents along with the returned ids of the documents in the old list, which saving moves over.
+    """
+    docs, version = read_documents()
+    legacy_ids = merge_legacy_documents(docs, read_legacy_documents())
+    # With documents from the old list the index is rebuilt on saving anyway
+    index = build_index(docs) if legacy_ids else read_index(docs, version)
+    return docs, index, legacy_ids
+
+def load_index(docs: dict) -> dict:
+    """The field index of documents from load_documents, rebuilt from them if it's missing or out of date"""
+    global _docs_cache
+    _, cached_docs, cached_index, version = _docs_cache
+    if cached_docs is not docs:
+        # The cache moved on since docs was read, so its version is unknown
+        return build_index(docs)
+    if cached_index is not None:
+        return cached_index
+    
+    index = read_index(docs, version)
+    with _docs_cache_lock:
+        if _docs_cache[1] is docs:
+            _docs_cache = (_docs_cache[0], docs, index, version)
+    return index
+
+# Names export_batch_documents gives its files: the template name cut to 20 characters, with
+# spaces and slashes replaced, then the export time
+EXPORT_FILENAME_RE = re.compile(r'export_[^/\\]{0,20}_\d{8}_\d{6}\.xlsx')
+
+def set_document_status(index: dict, doc: dict, status: Optional[str]):
+    if doc.get('status') != status:
+        unindex_document(index, doc)
+        doc['status'] = status
+        index_document(index, doc)
+
 @router.get("/list")
 def list_processed_documents(filters: Optional[DocumentFilter] = None) -> List[ProcessedDocument]:
     """
@@ -52,37 +248,41 @@ def list_processed_documents(filters: Optional[DocumentFilter] = None) -> List[P
     """
     try:
         # Get all processed documents from storage
-        all_docs = db.storage.json.get("processed_documents", default=[])
+        all_docs = load_documents()
         
         # Apply filters if provided
         if filters:
-            filtered_docs = []
-            for doc in all_docs:
-                # Apply source filter
-                if filters.source and doc.get('source') != filters.source:
-                    continue
-                # Apply status filter
-                if filters.status and doc.get('status') != filters.status:
-                    continue
-                # Apply template filter
-                if filters.template_id and doc.get('template_id') != filters.template_id:
-                    continue
-                # Apply date filters (simplified - could be enhanced)
-                if filters.start_date or filters.end_date:
-                    doc_date = doc.get('processed_date', '')
-                    if filters.start_date and doc_date < filters.start_date:
-                        continue
-                    if filters.end_date and doc_date > filters.end_date:
-                        continue
-                # Apply user filter
-                if filters.user_id and doc.get('user_id') != filters.user_id:
-                    continue
-                    
-                filtered_docs.append(doc)
+            # Source, status, template and user filters: intersect the ids indexed under each value
+            matching_ids = None
+            index = None
+            for field in INDEXED_FIELDS:
+                value = getattr(filters, field)
+                if value:
+                    index = index or load_index(all_docs)
+                    ids = set(index.get(field, {}).get(value, ()))
+                    matching_ids = ids if matching_ids is None else matching_ids & ids
+            
+            if filters.start_date or filters.end_date:
+                # Date filters: the slice of the date index from start_date up to and including end_date,
+                # in date order, narrowed to the ids the other filters matched
+                index = index or load_index(all_docs)
+                by_date = index[DATE_INDEX]
+                start = bisect.bisect_left(by_date, [filters.start_date]) if filters.start_date else 0
+                # [end_date + "\0"] sorts after every entry dated end_date and before any later date
+                end = bisect.bisect_left(by_date, [filters.end_date + "\0"]) if filters.end_date else len(by_date)
+                filtered_docs = [
+                    all_docs[doc_id] for _, doc_id in by_date[start:end]
+                    if (matching_ids is None or doc_id in matching_ids) and doc_id in all_docs
+                ]
+            elif matching_ids is not None:
+                filtered_docs = [doc for doc_id, doc in all_docs.items() if doc_id in matching_ids]
+            else:
+                filtered_docs = all_docs.values()
             
-            return [ProcessedDocument(**doc) for doc in filtered_docs]
+            return [ProcessedDocument.model_construct(**doc) for doc in filtered_docs]
         
-        return [ProcessedDocument(**doc) for doc in all_docs]
+        # Stored documents were validated when they were added, so they're not validated again
+        return [ProcessedDocument.model_construct(**doc) for doc in all_docs.values()]
         
     except Exception as e:
         print(f"Error listing processed documents: {e}")
@@ -94,13 +294,12 @@ def get_processed_document(document_id: str) -> ProcessedDocument:
     Get a specific processed document by ID
     """
     try:
-        all_docs = db.storage.json.get("processed_documents", default=[])
-        doc = next((d for d in all_docs if d.get('id') == document_id), None)
+        doc = load_documents().get(document_id)
         
         if not doc:
             raise HTTPException(status_code=404, detail="Document not found")
             
-        return ProcessedDocument(**doc)
+        return ProcessedDocument.model_construct(**doc)
         
     except HTTPException:
         raise
@@ -114,21 +313,21 @@ def update_processed_document(document_id: str, update_data: UpdateDocumentReque
     Update extracted data for a processed document
     """
     try:
-        all_docs = db.storage.json.get("processed_documents", default=[])
-        doc_index = next((i for i, d in enumerate(all_docs) if d.get('id') == document_id), None)
+        all_docs, index, legacy_ids = load_documents_for_update()
+        doc = all_docs.get(document_id)
         
-        if doc_index is None:
+        if doc is None:
             raise HTTPException(status_code=404, detail="Document not found")
         
         # Update the document
-        all_docs[doc_index]['extracted_data'] = update_data.extracted_data
-        all_docs[doc_index]['corrections'] = update_data.corrections
-        all_docs[doc_index]['status'] = 'corrected'
+        doc['extracted_data'] = update_data.extracted_data
+        doc['corrections'] = update_data.corrections
+        set_document_status(index, doc, 'corrected')
         
         # Save back to storage
-        db.storage.json.put("processed_documents", all_docs)
+        save_documents(all_docs, index, legacy_ids)
         
-        return ProcessedDocument(**all_docs[doc_index])
+        return ProcessedDocument.model_construct(**doc)
         
     except HTTPException:
         raise
@@ -142,11 +341,11 @@ def export_batch_documents(request: BatchExportRequest):
     Export multiple documents to Excel with template-based structure
     """
     try:
-        import pandas as pd
         from io import BytesIO
         
-        all_docs = db.storage.json.get("processed_documents", default=[])
-        selected_docs = [doc for doc in all_docs if doc.get('id') in request.document_ids]
+        all_docs, index, legacy_ids = load_documents_for_update()
+        # In the order requested, each document once
+        selected_docs = [all_docs[doc_id] for doc_id in dict.fromkeys(request.document_ids) if doc_id in all_docs]
         
         if not selected_docs:
             raise HTTPException(status_code=404, detail="No documents found")
@@ -173,80 +372,69 @@ def export_batch_documents(request: BatchExportRequest):
         template_fields = []
         if template_id:
             try:
-                from app.apis.template_manager import TEMPLATES_STORAGE_KEY
-                templates_dict = db.storage.json.get(TEMPLATES_STORAGE_KEY, default={})
-                if template_id in templates_dict:
-                    template_data = templates_dict[template_id]
+                from app.apis.template_manager import load_template_data
+                template_data = load_template_data(template_id)
+                if template_data is not None:
                     target_fields = template_data.get('target_fields', [])
                     template_fields = [field.get('field_name') for field in target_fields if field.get('field_name')]
             except Exception as e:
                 print(f"Error loading template fields: {e}")
         
+        # Use corrected data if available, otherwise use original extracted data
+        docs_data = [
+            (doc, doc['corrections'] if doc.get('corrections') is not None else doc.get('extracted_data', {}))
+            for doc in selected_docs
+        ]
+        
         # If no template fields found, fall back to unique fields from documents
         if not template_fields:
             all_field_names = set()
-            for doc in selected_docs:
-                corrections = doc.get('corrections')
-                if corrections is not None:
-                    data_to_export = corrections
-                else:
-                    data_to_export = doc.get('extracted_data', {})
+            for _, data_to_export in docs_data:
                 if isinstance(data_to_export, dict):
                     all_field_names.update(data_to_export.keys())
-            template_fields = sorted(list(all_field_names))
+            template_fields = all_field_names
         
-        # Prepare data for Excel export
-        export_data = []
+        # Template-specific field columns in alphabetical order, after the document metadata columns
+        sorted_fields = sorted(template_fields)
+        header = [column for column, _, _ in EXPORT_METADATA_COLUMNS] + sorted_fields
         
-        for doc in selected_docs:
-            # Use corrected data if available, otherwise use original extracted data
-            corrections = doc.get('corrections')
-            if corrections is not None:
-                data_to_export = corrections
-            else:
-                data_to_export = doc.get('extracted_data', {})
-            
+        # Write the rows straight into the workbook; constant_memory flushes each row once the next is started
+        buffer = BytesIO()
+        workbook = xlsxwriter.Workbook(buffer, {'constant_memory': True, 'in_memory': True})
+        # Use template name in sheet name
+        sheet_name = f"{template_name}" if len(template_name) <= 31 else template_name[:31]
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, header)
+        
+        for row_number, (doc, data_to_export) in enumerate(docs_data, 1):
             # Start with document metadata columns
-            row = {
-                'Document ID': doc.get('id'),
-                'Filename': doc.get('original_filename', ''),
-                'Processed Date': doc.get('processed_date', ''),
-                'Export Count': doc.get('export_count', 0),
-                'Last Exported': doc.get('last_exported_date', ''),
-            }
-            
-            # Add template-specific field columns in alphabetical order
+            row = [doc.get(key, default) for _, key, default in EXPORT_METADATA_COLUMNS]
             if isinstance(data_to_export, dict):
-                for field_name in sorted(template_fields):
-                    row[field_name] = data_to_export.get(field_name, '')
+                row.extend(data_to_export.get(field_name, '') for field_name in sorted_fields)
             
-            export_data.append(row)
+            for column, value in enumerate(row):
+                # Nested values such as item lists go into the cell as text
+                worksheet.write(row_number, column, str(value) if isinstance(value, (dict, list)) else value)
         
-        # Create DataFrame and Excel file
-        df = pd.DataFrame(export_data)
-        
-        # Save to BytesIO buffer
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-            # Use template name in sheet name
-            sheet_name = f"{template_name}" if len(template_name) <= 31 else template_name[:31]
-            df.to_excel(writer, index=False, sheet_name=sheet_name)
+        workbook.close()
         
         # Store the Excel file with template name
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         template_safe = template_name.replace(' ', '_').replace('/', '_')[:20]
         filename = f"export_{template_safe}_{timestamp}.xlsx"
         
+        # Stored before responding, as the client downloads it right away
         db.storage.binary.put(f"exports.{filename}", buffer.getvalue())
         
-        # Update export status for the documents
-        for doc in all_docs:
-            if doc.get('id') in request.document_ids:
-                doc['status'] = 'exported' if doc.get('status') == 'processed' else doc.get('status')
-                doc['export_count'] = doc.get('export_count', 0) + 1
-                doc['last_exported_date'] = datetime.now().isoformat()
+        # Update export status for the documents; they're the same dicts as in all_docs
+        exported_date = datetime.now().isoformat()
+        for doc in selected_docs:
+            if doc.get('status') == 'processed':
+                set_document_status(index, doc, 'exported')
+            doc['export_count'] = doc.get('export_count', 0) + 1
+            doc['last_exported_date'] = exported_date
         
-        db.storage.json.put("processed_documents", all_docs)
+        save_documents(all_docs, index, legacy_ids)
         
         return {
             "message": f"Successfully exported {len(selected_docs)} documents using template '{template_name}'",
@@ -267,8 +455,7 @@ def download_document_pdf(document_id: str):
     Download the original PDF for a processed document
     """
     try:
-        all_docs = db.storage.json.get("processed_documents", default=[])
-        doc = next((d for d in all_docs if d.get('id') == document_id), None)
+        doc = load_documents().get(document_id)
         
         if not doc:
             raise HTTPException(status_code=404, detail="Document not found")
@@ -280,7 +467,6 @@ def download_document_pdf(document_id: str):
         # Get PDF from storage
         pdf_data = db.storage.binary.get(pdf_key)
         
-        from fastapi.responses import Response
         return Response(
             content=pdf_data,
             media_type="application/pdf",
@@ -299,18 +485,16 @@ def download_export_file(filename: str, user: AuthorizedUser):
     Download an exported Excel file
     """
     try:
-        # Validate filename format for security
-        if not filename.startswith("export_") or not filename.endswith(".xlsx"):
+        # Validate filename format for security, before touching storage
+        if not EXPORT_FILENAME_RE.fullmatch(filename):
             raise HTTPException(status_code=400, detail="Invalid filename")
         
-        # Get file from storage
+        # Get file from storage; other storage errors are reported as such, not as a missing file
         storage_key = f"exports.{filename}"
-        try:
-            excel_data = db.storage.binary.get(storage_key)
-        except:
+        excel_data = db.storage.binary.get(storage_key, default=None)
+        if excel_data is None:
             raise HTTPException(status_code=404, detail="Export file not found")
         
-        from fastapi.responses import Response
         return Response(
             content=excel_data,
             media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
@@ -329,14 +513,12 @@ def delete_processed_document(document_id: str, user: AuthorizedUser):
     Delete a processed document and its associated PDF file
     """
     try:
-        all_docs = db.storage.json.get("processed_documents", default=[])
-        doc_index = next((i for i, d in enumerate(all_docs) if d.get('id') == document_id), None)
+        all_docs, index, legacy_ids = load_documents_for_update()
+        document = all_docs.get(document_id)
         
-        if doc_index is None:
+        if document is None:
             raise HTTPException(status_code=404, detail="Document not found")
         
-        document = all_docs[doc_index]
-        
         # Delete PDF file from storage if it exists
         pdf_key = document.get('pdf_storage_key')
         if pdf_key:
@@ -350,11 +532,12 @@ def delete_processed_document(document_id: str, user: AuthorizedUser):
                 # File doesn't exist, which is fine
                 pass
         
-        # Remove document from list
-        all_docs.pop(doc_index)
+        # Remove document
+        del all_docs[document_id]
+        unindex_document(index, document)
         
         # Save back to storage
-        db.storage.json.put("processed_documents", all_docs)
+        save_documents(all_docs, index, legacy_ids)
         
         print(f"Document {document_id} deleted by user {user.sub}")
         
@@ -372,29 +555,28 @@ def delete_batch_documents(request: BatchExportRequest, user: AuthorizedUser):
     Delete multiple documents at once
     """
     try:
-        all_docs = db.storage.json.get("processed_documents", default=[])
-        initial_count = len(all_docs)
+        all_docs, index, legacy_ids = load_documents_for_update()
         
         # Track which documents were found and deleted
         deleted_count = 0
         pdf_keys_to_cleanup = []
         
-        # Filter out documents to delete and collect PDF keys
-        remaining_docs = []
-        for doc in all_docs:
-            if doc.get('id') in request.document_ids:
-                deleted_count += 1
-                pdf_key = doc.get('pdf_storage_key')
-                if pdf_key:
-                    pdf_keys_to_cleanup.append(pdf_key)
-            else:
-                remaining_docs.append(doc)
+        # Remove the documents to delete and collect PDF keys
+        for doc_id in set(request.document_ids):
+            doc = all_docs.pop(doc_id, None)
+            if doc is None:
+                continue
+            unindex_document(index, doc)
+            deleted_count += 1
+            pdf_key = doc.get('pdf_storage_key')
+            if pdf_key:
+                pdf_keys_to_cleanup.append(pdf_key)
         
         if deleted_count == 0:
             raise HTTPException(status_code=404, detail="No documents found to delete")
         
-        # Save the updated document list
-        db.storage.json.put("processed_documents", remaining_docs)
+        # Save the updated documents
+        save_documents(all_docs, index, legacy_ids)
         
         # Log PDF cleanup info (since we can't actually delete from storage)
         if pdf_keys_to_cleanup:
@@ -426,13 +608,16 @@ def add_processed_document(doc_data: dict) -> str:
         doc_data['processed_date'] = datetime.now().isoformat()
         doc_data['status'] = 'processed'
         doc_data['export_count'] = 0
+        # Validated once here, so reads can trust what's stored
+        stored_doc = ProcessedDocument(**doc_data).model_dump()
         
         # Get existing documents
-        all_docs = db.storage.json.get("processed_documents", default=[])
-        all_docs.append(doc_data)
+        all_docs, index, legacy_ids = load_documents_for_update()
+        all_docs[doc_id] = stored_doc
+        index_document(index, stored_doc)
         
         # Save back to storage
-        db.storage.json.put("processed_documents", all_docs)
+        save_documents(all_docs, index, legacy_ids)
         
         return doc_id
         
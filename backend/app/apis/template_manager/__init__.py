@@ -5,13 +5,37 @@ to be extracted from a PDF, along with hints for the AI.
 """
 from fastapi import APIRouter, HTTPException, Body
 from pydantic import BaseModel, Field
+import threading
+import time
 import uuid
 from typing import List, Optional
+from app.libs.regex_safety import find_unsafe_pattern
 
 router = APIRouter(prefix="/templates", tags=["Template Management"])
 
 # Storage key for templates
 TEMPLATES_STORAGE_KEY = "pdf_extraction_templates"
+# Each template is also stored on its own under this prefix and its id, so one can be read without the rest
+TEMPLATE_KEY_PREFIX = "pdf_extraction_template."
+
+# Bumped on every save so other modules can tell when their cached templates are stale
+_templates_version = 0
+# Changes to the templates dict wait this long for more edits, so a burst of them is one storage write
+TEMPLATES_SAVE_DELAY = 0.25  # seconds
+# template id -> changed template dict, or None if deleted, not yet written to the templates dict.
+# Only the changes are kept, and they're applied to a fresh read when written, so edits other
+# processes made meanwhile aren't overwritten
+_pending_changes = {}
+_pending_timer = None
+_pending_lock = threading.Lock()
+# Templates as this process last read or saved them, reused by reads for a short while;
+# writes always read storage, so other processes' changes aren't overwritten
+TEMPLATES_CACHE_TTL = 2.0  # seconds
+TEMPLATE_DATA_CACHE_SIZE = 64
+# template id -> (expires, templates version, stored template dict)
+_template_data_cache = {}
+# (expires, templates version, templates)
+_templates_cache = (0.0, None, [])
 
 # --- Pydantic Models ---
 
@@ -20,6 +44,7 @@ class TargetField(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     field_name: str = Field(..., description="The name of the field to extract, e.g., 'Order Number', 'Customer Name'.")
     ai_hint: Optional[str] = Field(None, description="A hint or description for the AI on how to find this field or what it represents.")
+    regex: Optional[str] = Field(None, description="Optional regular expression finding the value in the PDF text; its first group, or else the whole match, is the value. Fields it finds aren't sent to the AI.")
 
 class PdfTemplate(BaseModel):
     """Represents an extraction template for a specific PDF structure/type."""
@@ -27,6 +52,7 @@ class PdfTemplate(BaseModel):
     name: str = Field(..., description="A user-friendly name for this template, e.g., 'Statsbygg Standard Order'.")
     description: Optional[str] = Field(None, description="A more detailed description of the template or the PDF type it targets.")
     target_fields: List[TargetField] = Field(default_factory=list, description="A list of fields to be extracted using this template.")
+    prompt_prefix: Optional[str] = Field(None, description="The template's part of the AI extraction instructions, rendered from its fields when it's saved.")
 
 class PdfTemplateCreate(BaseModel):
     """Schema for creating a new template. ID is generated automatically."""
@@ -43,32 +69,185 @@ class PdfTemplateUpdate(BaseModel):
 
 # --- Helper Functions ---
 
+def template_from_storage(data: dict) -> PdfTemplate:
+    """A stored template as a PdfTemplate; it was validated when it was saved, so it's not validated again."""
+    target_fields = [TargetField.model_construct(**field) for field in data.get('target_fields', [])]
+    return PdfTemplate.model_construct(**{**data, 'target_fields': target_fields})
+
 def get_all_templates() -> List[PdfTemplate]:
-    """Retrieves all templates from db.storage."""
+    """Retrieves all templates from db.storage, or as read or saved within the cache TTL."""
+    global _templates_cache
+    expires, version, templates = _templates_cache
+    if time.monotonic() >= expires or version != _templates_version:
+        templates = [template_from_storage(data) for data in load_templates_dict().values()]
+        _templates_cache = (time.monotonic() + TEMPLATES_CACHE_TTL, _templates_version, templates)
+    # A new list, so callers can add and replace templates in it
+    return list(templates)
+
+def render_prompt_prefix(template: PdfTemplate) -> Optional[str]:
+    """The template's fields with their hints and the JSON structure to answer with, as put in the extraction instructions"""
+    if not template.target_fields:
+        return None
+    field_descriptions = []
+    for field in template.target_fields:
+        field_desc = f"  - '{field.field_name}'"
+        if field.ai_hint:
+            field_desc += f" (Hint: {field.ai_hint})"
+        field_descriptions.append(field_desc)
+    json_schema_fields = "{" + ", ".join(f'"{field.field_name}": "string or number or array or null"' for field in template.target_fields) + "}" # Broad type for schema
+    return "\n".join([
+        f"A specific extraction template named '{template.name}' has been selected. Focus on extracting the following fields:",
+        "\n".join(field_descriptions),
+        f"The JSON output should strictly follow this structure: {json_schema_fields}.",
+        "If a field is not found or not applicable, use a JSON 'null' value for it.",
+    ])
+
+def load_templates_dict() -> dict:
+    """The stored templates as plain dicts keyed by id, with changes still waiting to be written applied."""
     templates_dict = db.storage.json.get(TEMPLATES_STORAGE_KEY, default={})
-    return [PdfTemplate(**data) for data in templates_dict.values()]
+    with _pending_lock:
+        changes = dict(_pending_changes)
+    if changes:
+        templates_dict = apply_template_changes(templates_dict, changes)
+    return templates_dict
+
+def apply_template_changes(templates_dict: dict, changes: dict) -> dict:
+    templates_dict = dict(templates_dict)
+    for template_id, template_data in changes.items():
+        if template_data is None:
+            templates_dict.pop(template_id, None)
+        else:
+            templates_dict[template_id] = template_data
+    return templates_dict
+
+def _schedule_flush():
+    """Start the timer that writes pending changes, unless one is running; call with _pending_lock held."""
+    global _pending_timer
+    if _pending_timer is None:
+        _pending_timer = threading.Timer(TEMPLATES_SAVE_DELAY, _flush_in_background)
+        _pending_timer.daemon = True
+        _pending_timer.start()
+
+def _flush_in_background():
+    try:
+        flush_templates()
+    except Exception:
+        # Logged and retried by flush_templates
+        pass
+
+def flush_templates():
+    """Writes the pending template changes to the templates dict in storage, if there are any."""
+    global _pending_changes, _pending_timer, _templates_version, _templates_cache
+    with _pending_lock:
+        changes, _pending_changes = _pending_changes, {}
+        if _pending_timer is not None:
+            _pending_timer.cancel()
+            _pending_timer = None
+    if not changes:
+        return
+    try:
+        # Re-read, so only this process's changes replace what's stored
+        templates_dict = apply_template_changes(db.storage.json.get(TEMPLATES_STORAGE_KEY, default={}), changes)
+        db.storage.json.put(TEMPLATES_STORAGE_KEY, templates_dict)
+    except Exception as e:
+        print(f"Error saving templates, retrying in {TEMPLATES_SAVE_DELAY}s: {e}")
+        with _pending_lock:
+            # Changes made since this flush started are newer
+            _pending_changes = {**changes, **_pending_changes}
+            _schedule_flush()
+        raise
+    # Deleted templates lose their own key only now, so other processes don't find
+    # them again in the templates dict
+    for template_id, template_data in changes.items():
+        if template_data is None and db.storage.json.get(template_key(template_id), default=None) is not None:
+            db.storage.json.delete(template_key(template_id))
+    # Only now do other modules' template caches re-read storage
+    _templates_version += 1
+    _templates_cache = (0.0, None, [])
+
+def save_template_change(template_id: str, template_data: Optional[dict]):
+    """Changes one template in the templates dict (None deletes it) after TEMPLATES_SAVE_DELAY, together with other changes made meanwhile."""
+    global _templates_cache
+    with _pending_lock:
+        _pending_changes[template_id] = template_data
+        _schedule_flush()
+    _template_data_cache.pop(template_id, None)
+    # Rebuilt with the pending changes on the next read
+    _templates_cache = (0.0, None, [])
+
+def template_key(template_id: str) -> str:
+    return f"{TEMPLATE_KEY_PREFIX}{template_id}"
+
+def put_template(templates_dict: dict, template: PdfTemplate):
+    """Adds or replaces one template in the templates dict, rendering its prompt prefix, and saves it."""
+    template.prompt_prefix = render_prompt_prefix(template)
+    templates_dict[template.id] = template.model_dump()
+    db.storage.json.put(template_key(template.id), templates_dict[template.id])
+    save_template_change(template.id, templates_dict[template.id])
+
+def load_template_data(template_id: str) -> Optional[dict]:
+    """
+    One stored template as a plain dict, or None, read from its own key and kept for the cache TTL.
+    Templates last saved before they had their own key are found in the templates dict.
+    """
+    with _pending_lock:
+        if template_id in _pending_changes:
+            return _pending_changes[template_id]
+    cached = _template_data_cache.get(template_id)
+    if cached and cached[0] > time.monotonic() and cached[1] == _templates_version:
+        return cached[2]
+    
+    template_data = db.storage.json.get(template_key(template_id), default=None)
+    if template_data is None:
+        template_data = load_templates_dict().get(template_id)
+    if template_data is not None:
+        # Evict the oldest entry (dicts keep insertion order) once the cache is full
+        _template_data_cache.pop(template_id, None)
+        if len(_template_data_cache) >= TEMPLATE_DATA_CACHE_SIZE:
+            _template_data_cache.pop(next(iter(_template_data_cache)), None)
+        _template_data_cache[template_id] = (time.monotonic() + TEMPLATES_CACHE_TTL, _templates_version, template_data)
+    return template_data
 
 def save_templates(templates: List[PdfTemplate]):
-    """Saves the list of templates to db.storage."""
+    """Replaces all templates in db.storage right away, rendering each one's prompt prefix."""
+    global _templates_version, _templates_cache
+    for template in templates:
+        template.prompt_prefix = render_prompt_prefix(template)
     templates_dict = {template.id: template.model_dump() for template in templates}
+    for template_id, template_data in templates_dict.items():
+        db.storage.json.put(template_key(template_id), template_data)
+    with _pending_lock:
+        # Replaced by this write
+        _pending_changes.clear()
     db.storage.json.put(TEMPLATES_STORAGE_KEY, templates_dict)
+    _templates_version += 1
+    _templates_cache = (time.monotonic() + TEMPLATES_CACHE_TTL, _templates_version, list(templates))
 
-# --- API Endpoints ---
+def get_templates_version() -> int:
+    """Counter that changes whenever this process saves the templates."""
+    return _templates_version
+
+def check_field_patterns(fields: List[TargetField]):
+    """Reject target fields whose regex doesn't compile as part of a larger pattern, or could backtrack catastrophically"""
+    # Field patterns are combined into one, so global inline flags like (?i) can't be used
+    problem = find_unsafe_pattern(((field.field_name, field.regex) for field in fields), "regex", as_group=True)
+    if problem:
+        raise HTTPException(status_code=400, detail=problem)
 
 # --- API Endpoints ---
 
 @router.post("/", response_model=PdfTemplate, status_code=201)
 def create_template(template_data: PdfTemplateCreate = Body(...)):
     """Creates a new PDF extraction template."""
-    templates = get_all_templates()
+    check_field_patterns(template_data.target_fields)
+    templates_dict = load_templates_dict()
     
     # Check for duplicate names, if desired (optional)
-    if any(t.name == template_data.name for t in templates):
+    if any(data.get('name') == template_data.name for data in templates_dict.values()):
         raise HTTPException(status_code=409, detail=f"A template with the name '{template_data.name}' already exists.")
 
     new_template = PdfTemplate(**template_data.model_dump())
-    templates.append(new_template)
-    save_templates(templates)
+    put_template(templates_dict, new_template)
     return new_template
 
 @router.get("/", response_model=List[PdfTemplate])
@@ -90,17 +269,11 @@ def update_template(template_id: str, template_update_data: PdfTemplateUpdate =
     """Updates an existing template.
     Allows partial updates: only provided fields will be changed.
     """
-    templates = get_all_templates()
-    template_index = -1
-    current_template = None
-
-    for i, t in enumerate(templates):
-        if t.id == template_id:
-            template_index = i
-            current_template = t
-            break
+    if template_update_data.target_fields is not None:
+        check_field_patterns(template_update_data.target_fields)
+    templates_dict = load_templates_dict()
     
-    if not current_template:
+    if template_id not in templates_dict:
         raise HTTPException(status_code=404, detail=f"Template with ID '{template_id}' not found for update.")
 
     # Perform the update
@@ -109,23 +282,27 @@ def update_template(template_id: str, template_update_data: PdfTemplateUpdate =
     # If target_fields are being updated, we replace the whole list as per Pydantic model.
     # If you need finer-grained control (e.g., add/remove individual fields), 
     # this endpoint would need to be more complex or have dedicated sub-routes.
-    updated_template = current_template.model_copy(update=update_data)
+    # Validated again so updated target fields are TargetField models, as rendering the prompt prefix needs
+    updated_template = PdfTemplate(**{**templates_dict[template_id], **update_data})
     
-    templates[template_index] = updated_template
-    save_templates(templates)
+    put_template(templates_dict, updated_template)
     return updated_template
 
 @router.delete("/{template_id}", status_code=204) # 204 No Content for successful deletion
 def delete_template(template_id: str):
     """Deletes a template by its ID."""
-    templates = get_all_templates()
-    initial_length = len(templates)
-    
-    templates_to_keep = [t for t in templates if t.id != template_id]
+    templates_dict = load_templates_dict()
     
-    if len(templates_to_keep) == initial_length:
+    if template_id not in templates_dict:
         raise HTTPException(status_code=404, detail=f"Template with ID '{template_id}' not found for deletion.")
     
-    save_templates(templates_to_keep)
+    # Its own key is deleted once the templates dict without it is written
+    save_template_change(template_id, None)
     # No body should be returned for 204
     return
+
+@router.post("/flush", status_code=204)
+def flush_template_saves():
+    """Writes template changes still waiting to be saved right away."""
+    flush_templates()
+    return
@@ -0,0 +1,29 @@
+"""Cached wall-clock timestamps for hot request paths.
+
+Usage:
+
+    from app.libs.clock import now_iso
+
+    config_data["last_updated"] = now_iso()
+"""
+
+import time
+from datetime import datetime
+
+_cached_timestamp = (0, "")
+
+
+def now_iso() -> str:
+    """Local time as an ISO 8601 string at second resolution, formatted at most once per second"""
+    global _cached_timestamp
+    second = int(time.time())
+    cached_second, cached_value = _cached_timestamp
+    if second != cached_second:
+        cached_value = datetime.fromtimestamp(second).isoformat()
+        _cached_timestamp = (second, cached_value)
+    return cached_value
+
+
+__all__ = [
+    "now_iso",
+]
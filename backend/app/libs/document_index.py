@@ -0,0 +1,110 @@
+"""Per-user indexes of document summaries, so listing a user's documents is one read.
+
+Usage:
+
+    from app.libs.document_index import DocumentIndex
+
+    def scan_user_documents(user_id):
+        for metadata in scan_documents("email_documents."):
+            if metadata.get("user_id") == user_id:
+                yield metadata
+
+    index = DocumentIndex(lambda user_id: f"email_documents_index_{user_id}", scan_user_documents, ("id", "subject"))
+    summaries = index.load(user_id)  # {document id: summary}
+    index.update(user_id, [metadata])
+
+Updates for a user are serialized and re-read the index right before writing
+it, so overlapping requests in this process don't drop each other's entries.
+An entry can still go missing, for example if another process writes the index
+at the same time or a request fails between storing a document and indexing
+it. So the index is rebuilt from a storage scan once it is older than
+rebuild_interval. Indexes stored as a plain dict of summaries, before they
+recorded when they were built, are rebuilt on first use.
+"""
+
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List
+
+from app.libs.json_store import get_json_document, put_json_document
+
+# Seconds before an index is rebuilt from a storage scan, bounding how long a lost entry stays unlisted
+INDEX_REBUILD_INTERVAL = 15 * 60
+
+
+def scan_documents(prefix: str) -> Iterator[dict]:
+    """Every stored JSON document whose key starts with prefix, in binary storage or the older db.storage.json"""
+    names = {file.name for file in db.storage.binary.list() if file.name.startswith(prefix)}
+    names.update(file.name for file in db.storage.json.list() if file.name.startswith(prefix))
+    for name in sorted(names):
+        try:
+            metadata = get_json_document(name)
+        except Exception as e:
+            print(f"Error reading document metadata {name}: {e}")
+            continue
+        if isinstance(metadata, dict) and metadata.get('id'):
+            yield metadata
+
+
+class DocumentIndex:
+    def __init__(self, index_key: Callable[[str], str], scan: Callable[[str], Iterable[dict]], summary_fields: tuple, rebuild_interval: float = INDEX_REBUILD_INTERVAL):
+        self.index_key = index_key
+        self.scan = scan
+        self.summary_fields = summary_fields
+        self.rebuild_interval = rebuild_interval
+        # user id -> lock serializing that user's index writes
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def summary(self, metadata: dict) -> dict:
+        return {field: metadata.get(field) for field in self.summary_fields}
+
+    def _lock(self, user_id: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(user_id, threading.Lock())
+
+    def _read(self, user_id: str):
+        """(summaries, built_at) as stored, or None if the index is missing, in the old format or due a rebuild"""
+        stored = get_json_document(self.index_key(user_id))
+        if not (isinstance(stored, dict) and isinstance(stored.get('documents'), dict)):
+            return None
+        built_at = stored.get('built_at', 0)
+        if time.time() - built_at >= self.rebuild_interval:
+            return None
+        return stored['documents'], built_at
+
+    def _write(self, user_id: str, documents: dict, built_at: float):
+        put_json_document(self.index_key(user_id), {'built_at': built_at, 'documents': documents})
+
+    def _rebuild(self, user_id: str):
+        print(f"Rebuilding document index {self.index_key(user_id)} from storage")
+        # Stamped before the scan, so documents stored during it are picked up by the next rebuild
+        built_at = time.time()
+        documents = {metadata['id']: self.summary(metadata) for metadata in self.scan(user_id)}
+        self._write(user_id, documents, built_at)
+        return documents, built_at
+
+    def load(self, user_id: str) -> dict:
+        """The user's document summaries keyed by id"""
+        stored = self._read(user_id)
+        if stored is None:
+            with self._lock(user_id):
+                # Another request may have rebuilt it while this one waited
+                stored = self._read(user_id) or self._rebuild(user_id)
+        return stored[0]
+
+    def update(self, user_id: str, documents: List[dict]):
+        """Add or replace the index entries for the given document metadata"""
+        with self._lock(user_id):
+            # Re-read right before writing, so entries written meanwhile aren't dropped
+            summaries, built_at = self._read(user_id) or self._rebuild(user_id)
+            for metadata in documents:
+                summaries[metadata['id']] = self.summary(metadata)
+            self._write(user_id, summaries, built_at)
+
+
+__all__ = [
+    "DocumentIndex",
+    "INDEX_REBUILD_INTERVAL",
+    "scan_documents",
+]
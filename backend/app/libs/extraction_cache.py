@@ -0,0 +1,97 @@
+"""Cache of AI extraction results keyed by PDF content, in memory and in storage.
+
+Usage:
+
+    from app.libs.extraction_cache import pdf_cache_key, get_cached_result, put_cached_result
+
+    cache_key = pdf_cache_key(pdf_content, instructions)
+    result = get_cached_result(cache_key)
+    if result is None:
+        result = {"extracted_data": ..., "raw_text": ...}
+        put_cached_result(cache_key, result)
+
+Keys combine the SHA-256 of the PDF with a digest of whatever else decides the
+result, such as the prompt instructions built from a template, so editing a
+template misses the cache instead of returning stale fields. Entries expire
+EXTRACTION_CACHE_TTL seconds after they're written, and a stored entry found
+expired is deleted, so storage doesn't keep every PDF ever extracted. The EXTRACTION_CACHE_SIZE
+most recently used entries are also kept in memory, which saves the storage
+read when the same PDF is uploaded to this process again.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from app.libs.json_store import delete_json_document, get_json_document, put_json_document
+
+EXTRACTION_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+EXTRACTION_CACHE_SIZE = 128
+
+# cache key -> (expires, result), least recently used first
+_memory_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def pdf_cache_key(pdf_content: bytes, *variant: str) -> str:
+    """Storage key for the result of extracting pdf_content with the given prompt variant"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in variant:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return f"pdf_extract_cache.{hashlib.sha256(pdf_content).hexdigest()}.{digest.hexdigest()}"
+
+
+def _remember(cache_key: str, expires: float, result: dict):
+    with _memory_lock:
+        _memory_cache[cache_key] = (expires, result)
+        _memory_cache.move_to_end(cache_key)
+        while len(_memory_cache) > EXTRACTION_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def get_cached_result(cache_key: str) -> Optional[dict]:
+    """The result stored for this key within the TTL, or None"""
+    now = time.time()
+    with _memory_lock:
+        entry = _memory_cache.get(cache_key)
+        if entry is not None:
+            if entry[0] >= now:
+                _memory_cache.move_to_end(cache_key)
+                return entry[1]
+            del _memory_cache[cache_key]
+
+    try:
+        stored = get_json_document(cache_key)
+    except Exception as e:
+        print(f"Error reading extraction cache: {e}")
+        return None
+    if not stored:
+        return None
+    if stored.get("expires", 0) < now:
+        try:
+            delete_json_document(cache_key)
+        except Exception as e:
+            print(f"Error deleting expired extraction cache entry: {e}")
+        return None
+    _remember(cache_key, stored["expires"], stored["result"])
+    return stored["result"]
+
+
+def put_cached_result(cache_key: str, result: dict):
+    """Store a result for reuse until EXTRACTION_CACHE_TTL has passed"""
+    expires = time.time() + EXTRACTION_CACHE_TTL
+    _remember(cache_key, expires, result)
+    try:
+        put_json_document(cache_key, {"result": result, "expires": expires})
+    except Exception as e:
+        print(f"Error writing extraction cache: {e}")
+
+
+__all__ = [
+    "get_cached_result",
+    "pdf_cache_key",
+    "put_cached_result",
+]
@@ -0,0 +1,257 @@
+"""Parse IMAP FETCH responses so messages can be fetched part by part.
+
+Usage:
+
+    from app.libs.imap_fetch import parse_fetch_response, message_parts, decode_part
+
+    status, data = mail.uid('FETCH', b'101,102', '(BODY.PEEK[HEADER] BODYSTRUCTURE)')
+    for uid, items in parse_fetch_response(data, by_uid=True).items():
+        for part in message_parts(items['BODYSTRUCTURE']):
+            print(part['part'], part['content_type'], part['filename'])
+
+Parsed values are nested lists of bytes, with NIL as None. Each part returned
+by message_parts() is a dict with the section number to use in BODY.PEEK[...],
+its lowercase content type, transfer encoding, charset, disposition and
+filename. fetch_parts() downloads and decodes just the parts asked for, or
+fetch_message_parts() those of several messages at once, and
+parse_envelope() reads the date, subject and sender out of an ENVELOPE.
+"""
+
+import binascii
+import imaplib
+import quopri
+import re
+from email.utils import collapse_rfc2231_value, decode_params, unquote
+
+_OPEN = ord('(')
+_CLOSE = ord(')')
+_QUOTE = ord('"')
+_BACKSLASH = ord('\\')
+_LITERAL = ord('{')
+_SECTION = ord('[')
+_WHITESPACE = b' \r\n'
+_ATOM_END = b' ()\r\n'
+
+
+def _parse_values(buf: bytes) -> list:
+    """Parse a run of IMAP values (atoms, strings, literals and lists)"""
+    stack = [[]]
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        c = buf[pos]
+        if c in _WHITESPACE:
+            pos += 1
+        elif c == _OPEN:
+            values = []
+            stack[-1].append(values)
+            stack.append(values)
+            pos += 1
+        elif c == _CLOSE:
+            if len(stack) > 1:
+                stack.pop()
+            pos += 1
+        elif c == _QUOTE:
+            value = bytearray()
+            pos += 1
+            while pos < end and buf[pos] != _QUOTE:
+                if buf[pos] == _BACKSLASH:
+                    pos += 1
+                value.append(buf[pos])
+                pos += 1
+            stack[-1].append(bytes(value))
+            pos += 1
+        elif c == _LITERAL:
+            size_end = buf.index(b'}', pos)
+            size = int(buf[pos + 1:size_end])
+            stack[-1].append(buf[size_end + 1:size_end + 1 + size])
+            pos = size_end + 1 + size
+        else:
+            start = pos
+            while pos < end and buf[pos] not in _ATOM_END:
+                # Section specs such as BODY[HEADER.FIELDS (FROM)] may contain spaces and parens
+                if buf[pos] == _SECTION:
+                    pos = buf.index(b']', pos)
+                pos += 1
+            atom = buf[start:pos]
+            stack[-1].append(None if atom.upper() == b'NIL' else atom)
+    return stack[0]
+
+
+def parse_fetch_response(data: list, by_uid: bool = False) -> dict:
+    """
+    Map each message in imaplib FETCH data to its items, e.g. {b'1': {'BODYSTRUCTURE': [...]}}
+
+    Messages are keyed by sequence number, or by UID with by_uid=True (for UID FETCH).
+    """
+    # imaplib splits a response around its literals; glue it back together in order
+    buf = b''.join(
+        piece
+        for item in data if item
+        for piece in (item if isinstance(item, tuple) else (item,))
+    )
+    values = _parse_values(buf)
+    responses = {}
+    for msg_id, items in zip(values[::2], values[1::2]):
+        if not isinstance(items, list):
+            continue
+        merged = responses.setdefault(msg_id, {})
+        for name, value in zip(items[::2], items[1::2]):
+            merged[name.decode('ascii', errors='replace').upper()] = value
+    if by_uid:
+        return {items['UID']: items for items in responses.values() if 'UID' in items}
+    return responses
+
+
+def _text(value) -> str:
+    return value.decode('utf-8', errors='replace') if isinstance(value, bytes) else ''
+
+
+def _param(params, name: str):
+    """Look up a body parameter, decoding RFC 2231 continuations and charsets"""
+    if not isinstance(params, list):
+        return None
+    pairs = [(_text(key).lower(), _text(value)) for key, value in zip(params[::2], params[1::2])]
+    for key, value in decode_params([('', '')] + pairs)[1:]:
+        if key == name:
+            return unquote(collapse_rfc2231_value(value))
+    return None
+
+
+def _first_atom(body: list) -> int:
+    return next((i for i, value in enumerate(body) if not isinstance(value, list)), len(body))
+
+
+def _walk(body: list, number: str, parts: list):
+    if body and isinstance(body[0], list):
+        # Multipart: child bodies first, then the subtype and extension data
+        children = body[:_first_atom(body)]
+        for i, child in enumerate(children, 1):
+            _walk(child, f"{number}.{i}" if number else str(i), parts)
+        return
+    content_type = f"{_text(body[0])}/{_text(body[1])}".lower()
+    if content_type == 'message/rfc822':
+        extension_start = 10
+    elif content_type.startswith('text/'):
+        extension_start = 8
+    else:
+        extension_start = 7
+    disposition = body[extension_start + 1] if len(body) > extension_start + 1 else None
+    disposition_type = _text(disposition[0]).lower() if isinstance(disposition, list) and disposition else None
+    disposition_params = disposition[1] if isinstance(disposition, list) and len(disposition) > 1 else None
+    parts.append({
+        'part': number or '1',
+        'content_type': content_type,
+        'encoding': _text(body[5]).lower(),
+        'charset': _param(body[2], 'charset'),
+        'disposition': disposition_type,
+        'filename': _param(disposition_params, 'filename') or _param(body[2], 'name'),
+    })
+    # Parts of an attached message are numbered under the attachment's own number
+    if content_type == 'message/rfc822' and len(body) > 8 and isinstance(body[8], list):
+        inner = body[8]
+        _walk(inner, number if inner and isinstance(inner[0], list) else f"{number or '1'}.1", parts)
+
+
+def message_parts(bodystructure: list) -> list:
+    """List the leaf MIME parts of a parsed BODYSTRUCTURE in document order"""
+    parts = []
+    if isinstance(bodystructure, list) and bodystructure:
+        _walk(bodystructure, '', parts)
+    return parts
+
+
+def decode_part(content: bytes, encoding: str) -> bytes:
+    """Undo a part's Content-Transfer-Encoding"""
+    if not content:
+        return b''
+    try:
+        if encoding == 'base64':
+            # What b64decode() calls, minus its argument checks; skips the CRLFs between lines
+            return binascii.a2b_base64(content)
+        if encoding == 'quoted-printable':
+            return quopri.decodestring(content)
+    except (binascii.Error, ValueError):
+        pass
+    return content
+
+
+
+# Matches a .pdf extension in any case without lowercasing the whole filename
+_PDF_EXT_RE = re.compile(r'\.pdf\Z', re.IGNORECASE)
+
+
+def is_pdf_part(part: dict) -> bool:
+    """Whether a part from message_parts() is a PDF attachment"""
+    filename = part['filename']
+    if not filename:
+        return False
+    return part['content_type'] == 'application/pdf' or (part['disposition'] == 'attachment' and _PDF_EXT_RE.search(filename) is not None)
+
+
+def fetch_parts(mail, uid: bytes, parts: list) -> dict:
+    """Fetch and decode only the given MIME parts of a message, keyed by part number"""
+    return fetch_message_parts(mail, {uid: parts})[uid]
+
+
+def fetch_message_parts(mail, parts_by_uid: dict) -> dict:
+    """
+    Fetch and decode the given MIME parts of several messages, keyed by UID and then part number.
+
+    Messages wanting the same sections, typically just the attachment at part 2,
+    are fetched together in one UID FETCH.
+    """
+    uids_by_sections = {}
+    for uid, parts in parts_by_uid.items():
+        uids_by_sections.setdefault(tuple(part['part'] for part in parts), []).append(uid)
+    payloads = {}
+    for sections, uids in uids_by_sections.items():
+        items = ' '.join(f"BODY.PEEK[{section}]" for section in sections)
+        status, data = mail.uid('FETCH', b','.join(uids), f'({items})')
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"Failed to fetch parts of emails {b','.join(uids)!r}: {status}")
+        responses = parse_fetch_response(data, by_uid=True)
+        for uid in uids:
+            fetched = responses.get(uid, {})
+            payloads[uid] = {
+                part['part']: decode_part(fetched.get(f"BODY[{part['part']}]"), part['encoding'])
+                for part in parts_by_uid[uid]
+            }
+    return payloads
+
+
+def _address(address) -> str:
+    """Format an ENVELOPE address (name, route, mailbox, host) as 'Name <mailbox@host>'"""
+    if not isinstance(address, list) or len(address) < 4:
+        return ''
+    name, _, mailbox, host = address[:4]
+    addr_spec = f"{_text(mailbox)}@{_text(host)}" if host else _text(mailbox)
+    return f"{_text(name)} <{addr_spec}>" if name else addr_spec
+
+
+def parse_envelope(envelope: list) -> dict:
+    """
+    Read the date, subject and sender of a parsed ENVELOPE.
+
+    Values are the raw header text, so encoded words in the subject and sender
+    name still need decoding. Missing values are empty strings.
+    """
+    if not isinstance(envelope, list) or len(envelope) < 3:
+        return {'date': '', 'subject': '', 'from': ''}
+    senders = envelope[2] if isinstance(envelope[2], list) else []
+    return {
+        'date': _text(envelope[0]),
+        'subject': _text(envelope[1]),
+        'from': ', '.join(filter(None, (_address(sender) for sender in senders))),
+    }
+
+
+__all__ = [
+    "decode_part",
+    "fetch_message_parts",
+    "fetch_parts",
+    "is_pdf_part",
+    "message_parts",
+    "parse_envelope",
+    "parse_fetch_response",
+]
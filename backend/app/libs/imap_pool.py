@@ -0,0 +1,186 @@
+"""Pool of logged-in IMAP connections, a few idle connections per account.
+
+Usage:
+
+    from app.libs.imap_pool import imap_pool
+
+    with imap_pool.connection(server, port, username, password, use_ssl=True) as mail:
+        mail.select('inbox')
+
+The connection is returned to the pool when the block exits normally and is
+logged out and dropped if the block raises. When a connection has to stay
+checked out across several steps, use acquire() and then release() or
+discard() explicitly.
+
+Pass owner (e.g. the app user id) to keep sessions of different app users
+apart even when they point at the same mailbox.
+"""
+
+import hashlib
+import imaplib
+import threading
+import time
+from contextlib import contextmanager
+
+# Providers such as Gmail and iCloud drop sessions after ~30 minutes idle
+KEEPALIVE_INTERVAL = 20 * 60  # seconds
+# Idle connections older than this are checked with NOOP before being handed out
+REVALIDATE_AFTER = 60  # seconds
+# Idle connections unused for this long are logged out instead of kept alive
+MAX_IDLE = 60 * 60  # seconds
+MAX_IDLE_PER_ACCOUNT = 2
+
+
+def _password_digest(password: str) -> str:
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+def _logout_quietly(mail):
+    try:
+        mail.logout()
+    except Exception:
+        pass
+
+
+class ImapConnectionPool:
+    def __init__(self, keepalive_interval: int = KEEPALIVE_INTERVAL, max_idle_per_account: int = MAX_IDLE_PER_ACCOUNT):
+        # (owner, server, port, username, use_ssl) -> [(connection, password digest, last used)]
+        self._idle = {}
+        # id(connection) -> (key, password digest) for connections handed out by acquire()
+        self._checked_out = {}
+        self._lock = threading.Lock()
+        self._keepalive_interval = keepalive_interval
+        self._max_idle_per_account = max_idle_per_account
+        self._keepalive_thread = None
+
+    def acquire(self, server: str, port: int, username: str, password: str, use_ssl: bool = True, owner: str = None):
+        """Return a logged-in connection for the account, reusing an idle one if possible"""
+        key = (owner, server, port, username, use_ssl)
+        digest = _password_digest(password)
+        mail = self._checkout(key, digest)
+        if mail is None:
+            mail = imaplib.IMAP4_SSL(server, port) if use_ssl else imaplib.IMAP4(server, port)
+            try:
+                mail.login(username, password)
+            except Exception:
+                _logout_quietly(mail)
+                raise
+        with self._lock:
+            self._checked_out[id(mail)] = (key, digest)
+        return mail
+
+    def release(self, mail):
+        """Hand a connection from acquire() back to the pool"""
+        with self._lock:
+            entry = self._checked_out.pop(id(mail), None)
+        if entry is None:
+            _logout_quietly(mail)
+            return
+        key, digest = entry
+        self._checkin(key, digest, mail)
+
+    def discard(self, mail):
+        """Log out a connection from acquire() that may be in a bad state"""
+        with self._lock:
+            self._checked_out.pop(id(mail), None)
+        _logout_quietly(mail)
+
+    @contextmanager
+    def connection(self, server: str, port: int, username: str, password: str, use_ssl: bool = True, owner: str = None):
+        """Yield a logged-in connection for the account and return it to the pool afterwards"""
+        mail = self.acquire(server, port, username, password, use_ssl=use_ssl, owner=owner)
+        try:
+            yield mail
+        except BaseException:
+            self.discard(mail)
+            raise
+        self.release(mail)
+
+    def discard_all(self):
+        """Log out and drop every idle connection"""
+        with self._lock:
+            entries = [entry for entries in self._idle.values() for entry in entries]
+            self._idle.clear()
+        for mail, _, _ in entries:
+            _logout_quietly(mail)
+
+    def _checkout(self, key, digest):
+        while True:
+            with self._lock:
+                entries = self._idle.get(key)
+                if not entries:
+                    return None
+                # Most recently used first, it is the most likely to still be alive
+                mail, pooled_digest, last_used = entries.pop()
+                if not entries:
+                    del self._idle[key]
+            # A session logged in with another password must not vouch for new credentials
+            if pooled_digest != digest:
+                _logout_quietly(mail)
+                continue
+            if time.monotonic() - last_used > REVALIDATE_AFTER:
+                try:
+                    status, _ = mail.noop()
+                except Exception:
+                    status = None
+                if status != 'OK':
+                    _logout_quietly(mail)
+                    continue
+            return mail
+
+    def _checkin(self, key, digest, mail, last_used=None):
+        with self._lock:
+            entries = self._idle.setdefault(key, [])
+            if len(entries) >= self._max_idle_per_account:
+                extra = mail
+            else:
+                entries.append((mail, digest, time.monotonic() if last_used is None else last_used))
+                extra = None
+            self._ensure_keepalive()
+        if extra is not None:
+            _logout_quietly(extra)
+
+    def _ensure_keepalive(self):
+        if self._keepalive_thread is None or not self._keepalive_thread.is_alive():
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, name="imap-keepalive", daemon=True)
+            self._keepalive_thread.start()
+
+    def _keepalive_loop(self):
+        """NOOP connections idle for a keepalive interval and log out those idle past MAX_IDLE"""
+        while True:
+            time.sleep(self._keepalive_interval / 4)
+            now = time.monotonic()
+            stale = []
+            with self._lock:
+                for key in list(self._idle):
+                    keep = []
+                    for entry in self._idle[key]:
+                        if now - entry[2] >= self._keepalive_interval:
+                            stale.append((key, entry))
+                        else:
+                            keep.append(entry)
+                    if keep:
+                        self._idle[key] = keep
+                    else:
+                        del self._idle[key]
+            for key, (mail, digest, last_used) in stale:
+                if now - last_used >= MAX_IDLE:
+                    _logout_quietly(mail)
+                    continue
+                try:
+                    status, _ = mail.noop()
+                except Exception:
+                    status = None
+                if status == 'OK':
+                    # Keep the original last-used time so MAX_IDLE still applies
+                    self._checkin(key, digest, mail, last_used=last_used)
+                else:
+                    _logout_quietly(mail)
+
+
+imap_pool = ImapConnectionPool()
+
+__all__ = [
+    "ImapConnectionPool",
+    "imap_pool",
+]
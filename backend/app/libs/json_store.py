@@ -0,0 +1,46 @@
+"""JSON documents stored as orjson-encoded bytes in binary storage.
+
+Usage:
+
+    from app.libs.json_store import get_json_document, put_json_document
+
+    metadata = get_json_document(f"email_documents.{doc_id}")
+    metadata["status"] = "completed"
+    put_json_document(f"email_documents.{doc_id}", metadata)
+
+Encoding and decoding with orjson skips the stdlib json round-trip of
+db.storage.json. Reads fall back to db.storage.json, so documents written
+there before a key moved over are still found; the next write stores them
+in binary storage.
+"""
+
+import orjson
+
+
+def get_json_document(key: str, default=None):
+    """Read a document written by put_json_document, falling back to db.storage.json for older ones"""
+    raw = db.storage.binary.get(key, default=None)
+    if raw is not None:
+        return orjson.loads(raw)
+    return db.storage.json.get(key, default=default)
+
+
+def put_json_document(key: str, value):
+    """Store a JSON document as orjson-encoded bytes"""
+    db.storage.binary.put(key, orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS))
+
+
+def delete_json_document(key: str):
+    """Delete a document from binary storage and any older copy in db.storage.json"""
+    # Deletes are rare; check first rather than rely on how a missing key is reported
+    if db.storage.binary.get(key, default=None) is not None:
+        db.storage.binary.delete(key)
+    if db.storage.json.get(key, default=None) is not None:
+        db.storage.json.delete(key)
+
+
+__all__ = [
+    "delete_json_document",
+    "get_json_document",
+    "put_json_document",
+]
@@ -0,0 +1,103 @@
+"""Extract text from PDF bytes with pdfplumber, spreading long PDFs over worker processes.
+
+Usage:
+
+    from app.libs.pdf_text import extract_pdf_text, extract_pdf_text_parallel
+
+    prompt_text = extract_pdf_text(pdf_content, max_chars=8000)
+    full_text = extract_pdf_text_parallel(pdf_content)
+
+Both return the text of each page that has any, each followed by a newline.
+extract_pdf_text_parallel() gives the same result as extract_pdf_text()
+without max_chars; PDFs of more than PARALLEL_MIN_PAGES pages are written to
+a temporary file and their page ranges extracted in a process pool, as
+pdfplumber's layout work is CPU-bound and holds the GIL.
+
+pdfplumber (with pdfminer and Pillow) is imported on first use.
+"""
+
+import functools
+import io
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+# Shorter PDFs are extracted in the calling thread; starting work in the pool costs more than it saves
+PARALLEL_MIN_PAGES = 5
+
+
+def open_pdf(pdf):
+    """Open PDF bytes, or a path, with pdfplumber"""
+    import pdfplumber
+    # BytesIO over bytes shares the buffer until written to, so this doesn't copy the PDF.
+    # The content comes from storage as bytes, so spilling it to a file to mmap would add a copy
+    return pdfplumber.open(io.BytesIO(pdf) if isinstance(pdf, bytes) else pdf)
+
+
+def _page_text(page) -> Optional[str]:
+    # Scanned pages are just images; with no characters there's no text to lay out
+    if not page.chars:
+        return None
+    return page.extract_text()
+
+
+def extract_pdf_text(pdf_content: bytes, max_chars: Optional[int] = None) -> str:
+    """Extract a PDF's text page by page, stopping once max_chars characters have been collected"""
+    # Collect the pages and join once; growing one string would copy it for every page
+    page_texts = []
+    length = 0
+    with open_pdf(pdf_content) as pdf:
+        for page in pdf.pages:
+            page_text = _page_text(page)
+            if page_text:
+                page_texts.append(page_text)
+                length += len(page_text) + 1
+                if max_chars is not None and length >= max_chars:
+                    break
+    return "".join(page_text + "\n" for page_text in page_texts)
+
+
+def _extract_page_range(path: str, start: int, stop: int) -> List[Optional[str]]:
+    """Worker process: text of pages start..stop-1 of the PDF at path"""
+    with open_pdf(path) as pdf:
+        return [_page_text(page) for page in pdf.pages[start:stop]]
+
+
+@functools.lru_cache(maxsize=1)
+def get_page_pool() -> ProcessPoolExecutor:
+    """Process pool for page extraction, started on first use"""
+    return ProcessPoolExecutor(max_workers=os.cpu_count())
+
+
+def extract_pdf_text_parallel(pdf_content: bytes) -> str:
+    """Extract all of a PDF's text, splitting the pages of long PDFs over the process pool"""
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete_on_close=False) as pdf_file:
+        pdf_file.write(pdf_content)
+        pdf_file.close()
+        with open_pdf(pdf_file.name) as pdf:
+            page_count = len(pdf.pages)
+        if page_count < PARALLEL_MIN_PAGES:
+            return extract_pdf_text(pdf_content)
+
+        # One contiguous range per worker, so each opens the PDF once
+        workers = min(page_count, os.cpu_count() or 1)
+        step = -(-page_count // workers)
+        pool = get_page_pool()
+        futures = [
+            pool.submit(_extract_page_range, pdf_file.name, start, min(start + step, page_count))
+            for start in range(0, page_count, step)
+        ]
+        return "".join(
+            page_text + "\n"
+            for future in futures
+            for page_text in future.result()
+            if page_text
+        )
+
+
+__all__ = [
+    "extract_pdf_text",
+    "extract_pdf_text_parallel",
+    "open_pdf",
+]
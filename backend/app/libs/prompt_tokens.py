@@ -0,0 +1,38 @@
+"""Cut prompt text to a token budget of the extraction model.
+
+Usage:
+
+    from app.libs.prompt_tokens import truncate_to_tokens
+
+    prompt_text = truncate_to_tokens(raw_text, 1000)
+
+A character cut gives anywhere from a few hundred to well over a thousand
+tokens for the same length, depending on the text; cutting by tokens keeps
+every prompt at the budget it was given. tiktoken and the model's encoding
+are loaded on first use.
+"""
+
+import functools
+
+
+@functools.lru_cache(maxsize=1)
+def get_token_encoding() -> "tiktoken.Encoding":
+    """Tokenizer of the extraction model, loaded once per process"""
+    import tiktoken
+    return tiktoken.encoding_for_model("gpt-4o-mini")
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to at most max_tokens tokens of the extraction model"""
+    encoding = get_token_encoding()
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    print(f"PDF text for prompt cut from {len(tokens)} to {max_tokens} tokens")
+    return encoding.decode(tokens[:max_tokens])
+
+
+__all__ = [
+    "get_token_encoding",
+    "truncate_to_tokens",
+]
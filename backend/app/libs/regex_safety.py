@@ -0,0 +1,200 @@
+"""Checks for user-supplied regular expressions before they are stored.
+
+Usage:
+
+    from app.libs.regex_safety import find_unsafe_pattern
+
+    problem = find_unsafe_pattern(((field.field_name, field.regex) for field in fields), "regex")
+    if problem:
+        raise HTTPException(status_code=400, detail=problem)
+
+A pattern is rejected if it doesn't compile, or if a repeated group holds a
+quantifier whose characters can also be matched by what follows it inside the
+loop, e.g. (a+)+, (\\w*)* or (.*a)*. Such a group can split the same text into
+iterations in exponentially many ways, and re tries them all on input that
+almost matches. A literal separator, as in (\\d+,)*\\d+ or ([A-Z]+-)+\\d+, leaves
+only one way, so those patterns are accepted.
+"""
+
+import re
+from re import _constants as sre_constants, _parser as sre_parser
+from typing import Iterable, Optional, Tuple
+
+# Characters the character sets of a pattern are compared on, besides every literal and range
+# endpoint in the pattern itself: ASCII and a few non-ASCII letters, digits and spaces
+_SAMPLE_CHARS = frozenset(chr(c) for c in range(128)) | frozenset('éØßµ٣中  ')
+
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT, getattr(sre_constants, 'POSSESSIVE_REPEAT', None))
+_ZERO_WIDTH = (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT)
+
+
+def _category_matches(category, c: str) -> bool:
+    if category == sre_constants.CATEGORY_DIGIT:
+        return c.isdecimal()
+    if category == sre_constants.CATEGORY_NOT_DIGIT:
+        return not c.isdecimal()
+    if category == sre_constants.CATEGORY_SPACE:
+        return c.isspace()
+    if category == sre_constants.CATEGORY_NOT_SPACE:
+        return not c.isspace()
+    if category == sre_constants.CATEGORY_WORD:
+        return c.isalnum() or c == '_'
+    if category == sre_constants.CATEGORY_NOT_WORD:
+        return not (c.isalnum() or c == '_')
+    return True
+
+
+class _Analyzer:
+    def __init__(self, parsed):
+        self.ignore_case = bool(parsed.state.flags & re.IGNORECASE)
+        self.universe = set(_SAMPLE_CHARS)
+        self._collect_chars(parsed)
+
+    def _collect_chars(self, items):
+        for op, av in items:
+            if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL):
+                self.universe.add(chr(av))
+            elif op == sre_constants.IN:
+                for item_op, item_av in av:
+                    if item_op == sre_constants.LITERAL:
+                        self.universe.add(chr(item_av))
+                    elif item_op == sre_constants.RANGE:
+                        self.universe.update((chr(item_av[0]), chr(item_av[1])))
+            else:
+                for sub in self._subsequences(op, av):
+                    self._collect_chars(sub)
+
+    @staticmethod
+    def _subsequences(op, av) -> list:
+        if op == sre_constants.SUBPATTERN:
+            return [av[3]]
+        if op in _REPEATS:
+            return [av[2]]
+        if op == sre_constants.BRANCH:
+            return av[1]
+        if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            return [av[1]]
+        if op == getattr(sre_constants, 'ATOMIC_GROUP', None):
+            return [av]
+        if op == sre_constants.GROUPREF_EXISTS:
+            return [sub for sub in av[1:] if sub is not None]
+        return []
+
+    def _literal(self, code: int) -> set:
+        c = chr(code)
+        return {c, c.lower(), c.upper()} if self.ignore_case else {c}
+
+    def _char_set(self, op, av) -> set:
+        """Characters a single-character node can match"""
+        if op == sre_constants.LITERAL:
+            return self._literal(av)
+        if op == sre_constants.NOT_LITERAL:
+            return self.universe - self._literal(av)
+        if op == sre_constants.ANY:
+            return set(self.universe)
+        # IN
+        negate = False
+        matched = set()
+        for item_op, item_av in av:
+            if item_op == sre_constants.NEGATE:
+                negate = True
+            elif item_op == sre_constants.LITERAL:
+                matched |= self._literal(item_av)
+            elif item_op == sre_constants.RANGE:
+                matched |= {c for c in self.universe if item_av[0] <= ord(c) <= item_av[1]}
+                if self.ignore_case:
+                    matched |= {c for c in self.universe if item_av[0] <= ord(c.lower()) <= item_av[1] or item_av[0] <= ord(c.upper()) <= item_av[1]}
+            elif item_op == sre_constants.CATEGORY:
+                matched |= {c for c in self.universe if _category_matches(item_av, c)}
+            else:
+                # Anything unrecognised counts as matching everything, erring towards rejecting
+                matched = set(self.universe)
+        return self.universe - matched if negate else matched
+
+    def first(self, items) -> Tuple[set, bool]:
+        """Characters that can start a match of the sequence, and whether it can match empty text"""
+        chars = set()
+        for op, av in items:
+            node_chars, nullable = self._first_of_node(op, av)
+            chars |= node_chars
+            if not nullable:
+                return chars, False
+        return chars, True
+
+    def _first_of_node(self, op, av) -> Tuple[set, bool]:
+        if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN):
+            return self._char_set(op, av), False
+        if op in _ZERO_WIDTH:
+            return set(), True
+        if op in _REPEATS:
+            chars, nullable = self.first(av[2])
+            return chars, nullable or av[0] == 0
+        if op == sre_constants.BRANCH:
+            chars, nullable = set(), False
+            for alternative in av[1]:
+                alternative_chars, alternative_nullable = self.first(alternative)
+                chars |= alternative_chars
+                nullable = nullable or alternative_nullable
+            return chars, nullable
+        subsequences = self._subsequences(op, av)
+        if op == sre_constants.SUBPATTERN or op == getattr(sre_constants, 'ATOMIC_GROUP', None):
+            return self.first(subsequences[0])
+        # Backreferences and conditionals: could be anything
+        return set(self.universe), True
+
+    def ambiguous(self, items, follow: set, in_loop: bool) -> bool:
+        """
+        Whether the sequence, followed by text starting with a character in follow, has an
+        unbounded quantifier inside an unbounded loop whose characters the following text can also match
+        """
+        for i, (op, av) in enumerate(items):
+            rest_chars, rest_nullable = self.first(items[i + 1:])
+            node_follow = rest_chars | follow if rest_nullable else rest_chars
+            if op in _REPEATS:
+                body = av[2]
+                body_chars, _ = self.first(body)
+                unbounded = av[1] == sre_constants.MAXREPEAT
+                if unbounded and in_loop and body_chars & node_follow:
+                    return True
+                # A repeated body can be followed by its own start
+                body_follow = node_follow | body_chars if av[1] > 1 else node_follow
+                if self.ambiguous(body, body_follow, in_loop or unbounded):
+                    return True
+            elif op not in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+                for sub in self._subsequences(op, av):
+                    if self.ambiguous(sub, node_follow, in_loop):
+                        return True
+        return False
+
+
+def can_backtrack_catastrophically(pattern: str) -> bool:
+    """Whether a repeated group in the pattern can split the same text into iterations in many ways"""
+    parsed = sre_parser.parse(pattern)
+    analyzer = _Analyzer(parsed)
+    return analyzer.ambiguous(list(parsed), set(), False)
+
+
+def find_unsafe_pattern(patterns: Iterable[Tuple[str, Optional[str]]], label: str, as_group: bool = False) -> Optional[str]:
+    """
+    Error message for the first (field name, pattern) whose pattern doesn't compile or could
+    backtrack catastrophically, or None if all are fine. Empty patterns are skipped.
+
+    With as_group the pattern is compiled as a non-capturing group, for patterns that are
+    combined into a larger one.
+    """
+    for field_name, pattern in patterns:
+        if not pattern:
+            continue
+        try:
+            re.compile(f"(?:{pattern})" if as_group else pattern)
+        except re.error as e:
+            return f"Invalid {label} for field '{field_name}': {e}"
+        if can_backtrack_catastrophically(pattern):
+            return f"{label.capitalize()} for field '{field_name}' has a repeated group that can match the same text in many ways, which can make matching very slow"
+    return None
+
+
+__all__ = [
+    "can_backtrack_catastrophically",
+    "find_unsafe_pattern",
+]
@@ -0,0 +1,76 @@
+"""Coalesce concurrent requests into batches handled by one call.
+
+Usage:
+
+    from app.libs.request_batcher import RequestBatcher
+
+    async def run_batch(key, items):
+        ...  # one call for all items
+        return results  # one per item, in order
+
+    batcher = RequestBatcher(run_batch, max_batch_size=8, max_wait=0.05)
+    result = await batcher.submit(key, item)
+
+Items submitted with the same key within max_wait seconds of the first one
+are handed to run_batch together, up to max_batch_size at a time; a full
+batch starts right away. If run_batch raises, every submitter in that batch
+gets the exception. A request that arrives alone waits max_wait and is run
+as a batch of one.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+
+class RequestBatcher:
+    def __init__(self, run_batch: Callable[[Hashable, List[Any]], Awaitable[List[Any]]], max_batch_size: int = 8, max_wait: float = 0.05):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # key -> [(item, future)] waiting for their batch to start
+        self._pending: Dict[Hashable, list] = {}
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        # Running batches, referenced so they aren't garbage collected mid-call
+        self._running = set()
+
+    async def submit(self, key: Hashable, item: Any) -> Any:
+        """Add item to the next batch for key and wait for its result"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(key, [])
+        pending.append((item, future))
+        if len(pending) >= self.max_batch_size:
+            self._start(key)
+        elif len(pending) == 1:
+            self._timers[key] = loop.call_later(self.max_wait, self._start, key)
+        return await future
+
+    def _start(self, key: Hashable):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(key, batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, key: Hashable, batch: list):
+        try:
+            results = await self.run_batch(key, [item for item, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"Batch of {len(batch)} returned {len(results)} results")
+        except Exception as e:
+            for _, future in batch:
+                # Submitters whose request was cancelled no longer wait
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+__all__ = [
+    "RequestBatcher",
+]